@@ -1,51 +1,360 @@
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Literal
+
+import auth
+import cache
+import categories
 import db
+import db_setup
+import exchange_rates
+import images
+import notifications
+import order_book
+import orjson
+import passwords
 import psycopg2
-from fastapi import FastAPI, HTTPException
+import purge
+import rate_limit
+import schemas
+import view_counter
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
+from fastapi.responses import ORJSONResponse
+from fastapi.staticfiles import StaticFiles
 from psycopg2.errors import (
     DataError,
     ForeignKeyViolation,
     UniqueViolation,
 )
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError
+
+
+class RowsResponse(ORJSONResponse):
+    """
+    Sends rows from db.py as they are. Returning it from a hot read route
+    skips validating the rows against the route's response_model, which
+    then only documents them, since db.py selects exactly its columns.
+    Decimals and datetimes are written the way pydantic writes them.
+    """
+
+    def render(self, content):
+        return orjson.dumps(
+            content,
+            default=_json_default,
+            option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS,
+        )
+
+
+def warm_up():
+    """
+    Opens pooled connections, prepares hot statements, loads the lookup
+    tables, category tree, exchange rates, revoked tokens and the order books
+    of auctions ending soon, and runs the JSON encoder once, before the first
+    request.
+    """
+    try:
+        db.warm_up()
+        auth.refresh()
+        exchange_rates.refresh()
+        order_book.rebuild()
+        categories.get_tree()
+        ORJSONResponse(db.get_lookups())
+    except psycopg2.Error:
+        logger.exception("Warm-up failed, continuing with a cold start.")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db_setup.start()
+    cache.start()
+    view_counter.start()
+    await run_in_threadpool(warm_up)
+    auth.start()
+    exchange_rates.start()
+    order_book.start()
+    purge.start()
+    notifications.start()
+    yield
+    notifications.stop()
+    purge.stop()
+    auth.stop()
+    exchange_rates.stop()
+    order_book.stop()
+    view_counter.stop()
+    images.stop()
+    passwords.stop()
+    cache.stop()
+    db_setup.stop()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.mount(
+    "/media",
+    StaticFiles(directory=images.MEDIA_ROOT, check_dir=False),
+    name="media",
+)
+
+
+@app.middleware("http")
+async def route_reads(request: Request, call_next):
+    """
+    Tells db_setup who is asking, so their reads go to the primary for a
+    few seconds after they wrote something, and renews the cookie that
+    does the same in other worker processes.
+    """
+    try:
+        primary_until = float(
+            request.cookies.get(db_setup.READ_YOUR_WRITES_COOKIE, 0)
+        )
+    except ValueError:
+        primary_until = 0.0
+    # A client can't keep itself on the primary for longer than a write would.
+    primary_until = min(primary_until, time.time() + db_setup.READ_YOUR_WRITES_SECONDS)
+    reads = db_setup.begin_request(
+        auth.verify_token(
+            auth.bearer_token(request.headers.get("authorization")) or ""
+        ),
+        primary_until,
+    )
+
+    response = await call_next(request)
+    if reads.wrote:
+        response.set_cookie(
+            db_setup.READ_YOUR_WRITES_COOKIE,
+            str(reads.primary_until),
+            max_age=int(db_setup.READ_YOUR_WRITES_SECONDS) + 1,
+            httponly=True,
+            samesite="lax",
+        )
+    return response
+
 
-app = FastAPI()
+@app.middleware("http")
+async def limit_write_requests(request: Request, call_next):
+    """
+    Rate limits write endpoints per client and sheds load when too many are
+    running, before they open a database connection.
+    """
+    route = (request.method, request.url.path)
+    if route not in rate_limit.LIMITED_ROUTES:
+        return await call_next(request)
+
+    # Logged in users are limited per user, whichever address they use.
+    user_id = auth.verify_token(
+        auth.bearer_token(request.headers.get("authorization")) or ""
+    )
+    if user_id is not None:
+        client = f"user:{user_id}"
+    else:
+        client = request.client.host if request.client else "unknown"
+    rejected_status = rate_limit.admit(client, route)
+    if rejected_status == 429:
+        return ORJSONResponse(
+            {"detail": "Too many requests, slow down."},
+            status_code=429,
+            headers={"Retry-After": "1"},
+        )
+    if rejected_status == 503:
+        return ORJSONResponse(
+            {"detail": "Server is busy, try again shortly."},
+            status_code=503,
+            headers={"Retry-After": "1"},
+        )
+
+    try:
+        return await call_next(request)
+    finally:
+        rate_limit.release()
+
+
+def authenticated_user(authorization: str = Header(default=None)):
+    """
+    Returns the user_id of the request's bearer token. The token is checked
+    in memory, without a database round trip.
+    """
+    user_id = auth.verify_token(auth.bearer_token(authorization) or "")
+    if user_id is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Missing, invalid or expired token.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user_id
+
+
+def authorize_user(user_id: int, current_user: int = Depends(authenticated_user)):
+    """
+    Only lets users reach their own /users/{user_id} resources.
+    """
+    if user_id != current_user:
+        raise HTTPException(status_code=403, detail="Not allowed for this user.")
+
+
+def authorize_admin(current_user: int = Depends(authenticated_user)):
+    """
+    Only lets users listed in ADMIN_USER_IDS through.
+    """
+    if current_user not in auth.ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Admins only.")
+
+
+def check_acting_user(user_id: int, current_user: int):
+    """
+    Rejects requests acting as another user than the logged in one.
+    """
+    if user_id != current_user:
+        raise HTTPException(
+            status_code=403, detail="Can only act as the logged in user."
+        )
+
+
+def viewer_currency(
+    currency_id: int = None, authorization: str = Header(default=None)
+):
+    """
+    Returns the currency to show prices in: 'currency_id' when given, else
+    the logged in user's currency, else the base currency. Prices are shown
+    in the base currency when the user's currency has no rate.
+    """
+    if currency_id is None:
+        user_id = auth.verify_token(auth.bearer_token(authorization) or "")
+        user = None
+        if user_id is not None:
+            try:
+                user = db.get_user_by_id(user_id)
+            except psycopg2.OperationalError:
+                raise HTTPException(
+                    status_code=503, detail="No database connection found."
+                )
+            except psycopg2.DatabaseError:
+                raise HTTPException(status_code=500, detail="Database error occured.")
+        currency_id = (user or {}).get("currency_id")
+        if currency_id is None or exchange_rates.get_rate(currency_id) is None:
+            currency_id = exchange_rates.BASE_CURRENCY_ID
+    elif exchange_rates.get_rate(currency_id) is None:
+        raise HTTPException(
+            status_code=400, detail="No exchange rate for the given currency."
+        )
+    return currency_id
 
 
 @app.get("/listings")
-def get_all_listings():
+def get_all_listings(currency_id: int = Depends(viewer_currency)):
     """
     Fetches all active listings in database.
     """
     try:
-        listings = db.get_all_listings()
-        if not listings:
+        listings = db.get_all_listings(
+            currency_id, exchange_rates.get_rate(currency_id)
+        )
+        if listings == "[]":
             raise HTTPException(status_code=404, detail="No active listings found.")
 
-        return listings
+        return Response(content=listings, media_type="application/json")
 
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
     except psycopg2.DatabaseError:
         raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/lookups")
+def get_lookups():
+    """
+    Fetches all lookup tables (statuses, types, categories, currencies, ...).
+    """
+    try:
+        return db.get_lookups()
     except psycopg2.OperationalError:
         raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
 
 
-@app.get("/users")
-def get_all_users():
+@app.get("/categories", response_model=list[schemas.CategoryOut])
+def get_categories():
     """
-    Fetches all users in database.
+    Fetches the category tree.
     """
     try:
-        users = db.get_all_users()
-        return users
+        return categories.get_tree().roots
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get(
+    "/categories/{category_id}/listings", response_model=list[schemas.ListingOut]
+)
+def get_category_listings(
+    category_id: int,
+    before_listing_id: int = None,
+    limit: int = Query(default=20, gt=0, le=100),
+    currency_id: int = Depends(viewer_currency),
+):
+    """
+    Fetches active listings in a category and all its subcategories, newest
+    first. For the next page pass 'before_listing_id' from the last listing
+    of the previous page.
+    """
+    try:
+        category_ids = categories.get_tree().subtree(category_id)
+        if category_ids is None:
+            raise HTTPException(status_code=404, detail="Category not found.")
+        listings = db.get_category_listings(
+            category_ids, before_listing_id=before_listing_id, limit=limit
+        )
+        return RowsResponse(exchange_rates.convert(listings, currency_id))
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
     except psycopg2.DatabaseError:
         raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/users", dependencies=[Depends(authorize_admin)])
+def get_all_users():
+    """
+    Fetches all users in database, for admins only.
+    """
+    try:
+        users = db.get_all_users()
+        return Response(content=users, media_type="application/json")
     except psycopg2.OperationalError:
         raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
 
 
-@app.get("/users/{user_id}")
+@app.get(
+    "/users/{user_id}",
+    response_model=schemas.UserOut,
+    dependencies=[Depends(authorize_user)],
+)
 def get_user_by_id(user_id: int):
     """
-    Fetches a user by user_id.
+    Fetches the logged in user.
     """
     try:
         user = db.get_user_by_id(user_id=user_id)
@@ -53,15 +362,100 @@ def get_user_by_id(user_id: int):
             raise HTTPException(
                 status_code=404, detail="No user found with given 'user_id'."
             )
-        return user
+        return RowsResponse(user)
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+
+
+@app.get("/listings/most_viewed")
+def get_most_viewed_listings(
+    limit: int = Query(default=20, gt=0, le=100),
+    currency_id: int = Depends(viewer_currency),
+):
+    """
+    Fetches the most viewed active listings.
+    """
+    try:
+        listings = db.get_most_viewed_listings(
+            limit, currency_id, exchange_rates.get_rate(currency_id)
+        )
+        return Response(content=listings, media_type="application/json")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/listings/thumbnails", response_model=list[schemas.ThumbnailOut])
+def get_primary_thumbnails(
+    listing_ids: list[int] = Query(max_length=100),
+    variant: str = Query(default="small", pattern="^(small|medium)$"),
+):
+    """
+    Fetches the primary thumbnail of many listings at once.
+    """
+    try:
+        return RowsResponse(db.get_primary_thumbnails(listing_ids, variant))
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
     except psycopg2.DatabaseError:
         raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/listings/nearby", response_model=list[schemas.NearbyListing])
+def get_nearby_listings(
+    latitude: float = Query(default=None, ge=-90, le=90),
+    longitude: float = Query(default=None, ge=-180, le=180),
+    postal_code: str = Query(default=None, max_length=10),
+    radius_km: float = Query(default=10, gt=0, le=100),
+    after_distance_km: Decimal = None,
+    after_listing_id: int = None,
+    limit: int = Query(default=20, gt=0, le=100),
+    currency_id: int = Depends(viewer_currency),
+):
+    """
+    Fetches active listings available for pick-up within 'radius_km' of a
+    coordinate or a postal code, nearest first. For the next page pass
+    'after_distance_km' and 'after_listing_id' from the last listing of the
+    previous page.
+    """
+    if (latitude is None) != (longitude is None) or (
+        (latitude is None) == (postal_code is None)
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="Provide either 'latitude' and 'longitude' or a 'postal_code'.",
+        )
+    if (after_distance_km is None) != (after_listing_id is None):
+        raise HTTPException(
+            status_code=400,
+            detail="'after_distance_km' and 'after_listing_id' must be sent together.",
+        )
+    try:
+        if postal_code is not None:
+            location = db.get_postal_code(postal_code)
+            if location is None:
+                raise HTTPException(status_code=404, detail="Postal code not found.")
+            latitude, longitude = location["latitude"], location["longitude"]
+        listings = db.get_nearby_listings(
+            latitude,
+            longitude,
+            radius_km,
+            after_distance_km=after_distance_km,
+            after_listing_id=after_listing_id,
+            limit=limit,
+        )
+        return RowsResponse(exchange_rates.convert(listings, currency_id))
     except psycopg2.OperationalError:
         raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
 
 
-@app.get("/listings/{listing_id}")
-def get_listing_by_id(listing_id: int):
+@app.get("/listings/{listing_id}", response_model=schemas.ListingOut)
+def get_listing_by_id(listing_id: int, currency_id: int = Depends(viewer_currency)):
     """
     Fetches a listing by listing_id.
     """
@@ -72,117 +466,371 @@ def get_listing_by_id(listing_id: int):
                 status_code=404,
                 detail="No listing found with given 'listing_id'.",
             )
-        return listing
+        view_counter.record_view(listing_id)
+        # The cached row may be behind on bids, the order book isn't.
+        price = order_book.get_price(listing_id)
+        if price is not None:
+            listing = {
+                **listing,
+                "current_price": price["current_price"],
+                "bid_count": price["bid_count"],
+            }
+        return RowsResponse(exchange_rates.convert([listing], currency_id)[0])
     except psycopg2.DatabaseError:
         raise HTTPException(status_code=500, detail="Database error occured.")
     except psycopg2.OperationalError:
         raise HTTPException(status_code=503, detail="No database connection found.")
 
 
+@app.get("/listings/{listing_id}/price", response_model=schemas.ListingPrice)
+async def get_listing_price(
+    listing_id: int, currency_id: int = Depends(viewer_currency)
+):
+    """
+    Fetches the current price, leader, bid count and latest bids of a
+    listing from memory. Only the first read in a process hits the database.
+    """
+    price = order_book.get_price(listing_id)
+    if price is None:
+        try:
+            price = await run_in_threadpool(order_book.load_price, listing_id)
+        except psycopg2.OperationalError:
+            raise HTTPException(
+                status_code=503, detail="No database connection found."
+            )
+        except psycopg2.DatabaseError:
+            raise HTTPException(status_code=500, detail="Database error occured.")
+    if price is None:
+        raise HTTPException(
+            status_code=404, detail="No listing found with given 'listing_id'."
+        )
+    return exchange_rates.convert([price], currency_id)[0]
+
+
 @app.get("/users/{user_id}/listings")
-def get_all_user_listings(seller_id: int):
+def get_all_user_listings(user_id: int, currency_id: int = Depends(viewer_currency)):
     """
     Fetches all listings from one user.
     """
     try:
-        listings = db - get_all_user_listings(seller_id=seller_id)
-        if not listings:
+        listings = db.get_all_user_listings(
+            user_id, currency_id, exchange_rates.get_rate(currency_id)
+        )
+        if listings == "[]":
             raise HTTPException(
                 status_code=404,
                 detail="Provided user does not have any listings.",
             )
-        return listings
+        return Response(content=listings, media_type="application/json")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get(
+    "/users/{user_id}/orders",
+    response_model=list[schemas.OrderSummary],
+    dependencies=[Depends(authorize_user)],
+)
+def get_user_orders(
+    user_id: int,
+    role: Literal["buyer", "seller"] = "buyer",
+    status_id: int = None,
+    before_created_at: datetime = None,
+    before_order_id: int = None,
+    limit: int = Query(default=20, gt=0, le=100),
+):
+    """
+    Fetches a user's order history as buyer or seller, newest first.
+    For the next page pass 'before_created_at' and 'before_order_id' from the
+    last order of the previous page.
+    """
+    if (before_created_at is None) != (before_order_id is None):
+        raise HTTPException(
+            status_code=400,
+            detail="'before_created_at' and 'before_order_id' must be sent together.",
+        )
+    try:
+        orders = db.get_user_orders(
+            user_id,
+            role,
+            status_id=status_id,
+            before_created_at=before_created_at,
+            before_order_id=before_order_id,
+            limit=limit,
+        )
+        return RowsResponse(orders)
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get(
+    "/users/{user_id}/dashboard/daily",
+    response_model=list[schemas.SellerDailyStats],
+    dependencies=[Depends(authorize_user)],
+)
+def get_seller_daily_stats(
+    user_id: int, from_day: date = None, to_day: date = None
+):
+    """
+    Fetches a seller's revenue, bids, views, conversion and reviews per day.
+    Defaults to the last 30 days.
+    """
+    to_day = to_day or date.today()
+    from_day = from_day or to_day - timedelta(days=30)
+    try:
+        return db.get_seller_daily_stats(user_id, from_day, to_day)
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get(
+    "/users/{user_id}/dashboard/listings",
+    response_model=list[schemas.SellerListingStats],
+    dependencies=[Depends(authorize_user)],
+)
+def get_seller_listing_stats(user_id: int):
+    """
+    Fetches bids, orders and conversion for each of a seller's listings.
+    """
+    try:
+        return db.get_seller_listing_stats(user_id)
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/users/{user_id}/reviews", response_model=list[schemas.ReviewOut])
+def get_user_reviews(
+    user_id: int,
+    before_created_at: datetime = None,
+    before_reviewer_id: int = None,
+    before_listing_id: int = None,
+    limit: int = Query(default=20, gt=0, le=100),
+):
+    """
+    Fetches the reviews a user has received, newest first.
+    For the next page pass 'before_created_at', 'before_reviewer_id' and
+    'before_listing_id' from the last review of the previous page.
+    """
+    cursor_given = [
+        value is not None
+        for value in (before_created_at, before_reviewer_id, before_listing_id)
+    ]
+    if any(cursor_given) and not all(cursor_given):
+        raise HTTPException(
+            status_code=400,
+            detail="'before_created_at', 'before_reviewer_id' and "
+            "'before_listing_id' must be sent together.",
+        )
+    try:
+        reviews = db.get_user_reviews(
+            user_id,
+            before_created_at=before_created_at,
+            before_reviewer_id=before_reviewer_id,
+            before_listing_id=before_listing_id,
+            limit=limit,
+        )
+        return RowsResponse(reviews)
     except psycopg2.OperationalError:
         raise HTTPException(status_code=503, detail="No database connection found.")
     except psycopg2.DatabaseError:
         raise HTTPException(status_code=500, detail="Database error occured.")
 
 
-@app.post("/new_user")
-def register_user(
-    username: str,
-    email: str,
-    password: str,
-    social_security_number: str,
-    first_name: str,
-    last_name: str,
-    city_id: int,
-    address: str,
-    postal_code: str,
-    phone_number: str,
+@app.get(
+    "/users/{user_id}/notifications",
+    response_model=list[schemas.NotificationOut],
+    dependencies=[Depends(authorize_user)],
+)
+def get_notifications(
+    user_id: int,
+    before_notification_id: int = None,
+    limit: int = Query(default=20, gt=0, le=100),
 ):
+    """
+    Fetches a user's notification digests, newest first. For the next page
+    pass 'before_notification_id' from the last digest of the previous page.
+    """
+    try:
+        notifications_page = db.get_notifications(
+            user_id, before_notification_id=before_notification_id, limit=limit
+        )
+        return RowsResponse(notifications_page)
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/users/{user_id}/reviews/summary", response_model=schemas.RatingSummary)
+def get_rating_summary(user_id: int):
+    """
+    Fetches a user's average rating, star histogram and positive/negative counts.
+    """
+    try:
+        summary = db.get_rating_summary(user_id)
+        if summary is None:
+            raise HTTPException(
+                status_code=404, detail="No user found with given 'user_id'."
+            )
+        return summary
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.post("/new_user", response_model=schemas.UserOut)
+async def register_user(user: schemas.UserCreate):
     """
     Creates a new user in database.
+    The password is hashed in a separate process pool.
     """
+    password_hash = await passwords.hash_password(user.password)
     try:
-        new_user = db.register_user(
-            username,
-            email,
-            password,
-            social_security_number,
-            first_name,
-            last_name,
-            city_id,
-            address,
-            postal_code,
-            phone_number,
+        new_user = await run_in_threadpool(
+            db.register_user,
+            **user.model_dump(exclude={"password"}),
+            password_hash=password_hash,
         )
         if not new_user:
             raise HTTPException(
                 status_code=422,
-                detail="Failed to create new listing, data provided is invalid.",
+                detail="Failed to create new user, data provided is invalid.",
             )
         return new_user
     except UniqueViolation:
         raise HTTPException(
-            status_code=409, detail="Listing already exists with same info."
+            status_code=409,
+            detail="username, email or phone_number already exists.",
         )
     except ForeignKeyViolation:
-        raise HTTPException(
-            status_code=400, detail="Invalid 'seller_id' or 'listing_type_id'"
-        )
+        raise HTTPException(status_code=400, detail="Invalid 'city_id'.")
     except DataError:
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.post("/new_city")
-def add_city(city_name: str):
+@app.post("/new_city", response_model=schemas.CityOut)
+def add_city(city: schemas.CityCreate):
     """
     Creates a new city in database.
     """
     try:
-        new_city = db.add_city(city_name=city_name)
+        new_city = db.add_city(
+            city_name=city.city_name,
+            latitude=city.latitude,
+            longitude=city.longitude,
+        )
         return new_city
     except UniqueViolation:
         raise HTTPException(status_code=409, detail="City already exists.")
 
 
-@app.post("/new_listing")
+@app.put(
+    "/cities/{city_id}/location",
+    response_model=schemas.CityOut,
+    dependencies=[Depends(authorize_admin)],
+)
+def set_city_location(city_id: int, location: schemas.Location):
+    """
+    Sets the coordinates of a city, used for sellers without a known postal
+    code in the nearby search.
+    """
+    try:
+        city = db.set_city_location(city_id, location.latitude, location.longitude)
+        if city is None:
+            raise HTTPException(status_code=404, detail="City not found.")
+        return city
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.put(
+    "/exchange_rates/{currency_id}",
+    response_model=schemas.ExchangeRateOut,
+    dependencies=[Depends(authorize_admin)],
+)
+def set_exchange_rate(currency_id: int, exchange_rate: schemas.ExchangeRateUpdate):
+    """
+    Sets how many units of a currency one unit of the base currency is worth.
+    """
+    if currency_id == exchange_rates.BASE_CURRENCY_ID:
+        raise HTTPException(
+            status_code=400, detail="The base currency's rate is always 1."
+        )
+    try:
+        return db.set_exchange_rate(currency_id, exchange_rate.rate)
+    except ForeignKeyViolation:
+        raise HTTPException(status_code=404, detail="Currency not found.")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.put(
+    "/postal_codes/{postal_code}",
+    response_model=schemas.PostalCodeOut,
+    dependencies=[Depends(authorize_admin)],
+)
+def set_postal_code(
+    location: schemas.PostalCodeLocation,
+    postal_code: str = Path(max_length=10),
+):
+    """
+    Creates or replaces the coordinates of a postal code.
+    """
+    try:
+        return db.set_postal_code(
+            postal_code, location.city_id, location.latitude, location.longitude
+        )
+    except ForeignKeyViolation:
+        raise HTTPException(status_code=400, detail="City not found.")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.post(
+    "/new_category",
+    response_model=schemas.CategoryOut,
+    dependencies=[Depends(authorize_admin)],
+)
+def add_category(category: schemas.CategoryCreate):
+    """
+    Creates a category, below 'parent_id' or at the root.
+    """
+    try:
+        return db.add_category(category.category_name, category.parent_id)
+    except ForeignKeyViolation:
+        raise HTTPException(status_code=400, detail="Parent category not found.")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.post("/new_listing", response_model=schemas.ListingOut)
 def create_listing(
-    seller_id: int,
-    listing_type_id: int,
-    product_name: str,
-    title: str,
-    description: str,
-    starting_price: float,
-    pick_up_available: bool,
-    end_date: str,
+    listing: schemas.ListingCreate,
+    current_user: int = Depends(authenticated_user),
 ):
     """
     Creates a new listing in database.
     """
-
+    check_acting_user(listing.seller_id, current_user)
     try:
-        new_listing = db.create_listing(
-            seller_id,
-            listing_type_id,
-            product_name,
-            title,
-            description,
-            starting_price,
-            pick_up_available,
-            end_date,
-        )
+        new_listing = db.create_listing(**listing.model_dump())
         if not new_listing:
             raise HTTPException(
                 status_code=422,
@@ -201,19 +849,14 @@ def create_listing(
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.post("/bids")
-def create_bid(
-    listing_id: int,
-    user_id: int,
-    bid_amount: float,
-    is_auto: bool = False,
-    max_auto_bid: int = None,
-):
+@app.post("/bids", response_model=schemas.BidOut)
+def create_bid(bid: schemas.BidCreate, current_user: int = Depends(authenticated_user)):
     """
     Creates a new bid in database.
     """
+    check_acting_user(bid.user_id, current_user)
     try:
-        new_bid = db.create_bid(listing_id, user_id, bid_amount, is_auto, max_auto_bid)
+        new_bid = db.create_bid(**bid.model_dump())
         if not new_bid:
             raise HTTPException(
                 status_code=422,
@@ -231,29 +874,100 @@ def create_bid(
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.post("/reviews")
-def create_review(
+@app.post("/listings/{listing_id}/images", response_model=schemas.ListingImageOut)
+def add_listing_image(
     listing_id: int,
-    reviewer_id: int,
-    reviewee_id: int,
-    review_text: str,
-    rating: int,
-    is_negative: bool = False,
-    is_positive: bool = False,
+    image: UploadFile,
+    current_user: int = Depends(authenticated_user),
 ):
     """
-    Creates a new review in database.
+    Uploads an image for a listing. Thumbnails are generated in the
+    background and show up in /listings/thumbnails once ready.
+    """
+    try:
+        listing = db.get_listing_by_id(listing_id)
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+    if listing is None:
+        raise HTTPException(status_code=404, detail="Couldn't find requested listing.")
+    check_acting_user(listing["seller_id"], current_user)
+
+    if image.content_type not in images.ALLOWED_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=415, detail="Only JPEG, PNG and WebP images are allowed."
+        )
+    data = image.file.read(images.MAX_IMAGE_BYTES + 1)
+    if len(data) > images.MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Image is too large.")
+    content_type = images.content_type(data)
+    if content_type is None:
+        raise HTTPException(
+            status_code=415, detail="The file is not a JPEG, PNG or WebP image."
+        )
+
+    key = images.save_original(data, content_type)
+    try:
+        new_image = db.add_listing_image(listing_id, key)
+    except ForeignKeyViolation:
+        images.delete_file(key)
+        raise HTTPException(status_code=404, detail="Couldn't find requested listing.")
+    except psycopg2.DatabaseError:
+        images.delete_file(key)
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+    images.process_image(new_image["img_id"], key)
+    return new_image
+
+
+@app.post("/orders", response_model=schemas.OrderOut)
+def create_order(
+    order: schemas.OrderCreate,
+    idempotency_key: str = Header(min_length=1, max_length=64),
+    current_user: int = Depends(authenticated_user),
+):
     """
+    Creates a new order for an auction the logged in user won, prices and
+    totals are calculated by the server. Sending the same 'Idempotency-Key'
+    header again returns the same order.
+    """
+    check_acting_user(order.buyer_id, current_user)
     try:
-        new_review = db.create_review(
-            listing_id,
-            reviewer_id,
-            reviewee_id,
-            review_text,
-            rating,
-            is_negative,
-            is_positive,
+        new_order = db.create_order(
+            **order.model_dump(), idempotency_key=idempotency_key
+        )
+        if not new_order:
+            raise HTTPException(
+                status_code=404,
+                detail="Couldn't find requested listing or shipping option.",
+            )
+        return new_order
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except UniqueViolation:
+        raise HTTPException(
+            status_code=409, detail="Idempotency-Key was used for another order."
         )
+    except ForeignKeyViolation:
+        raise HTTPException(
+            status_code=400, detail="Invalid 'buyer_id' or 'payment_id'."
+        )
+    except DataError:
+        raise HTTPException(status_code=400, detail="Invalid data format/type.")
+
+
+@app.post("/reviews", response_model=schemas.ReviewOut)
+def create_review(
+    review: schemas.ReviewCreate,
+    current_user: int = Depends(authenticated_user),
+):
+    """
+    Creates a new review in database.
+    """
+    check_acting_user(review.reviewer_id, current_user)
+    try:
+        new_review = db.create_review(**review.model_dump())
         if not new_review:
             raise HTTPException(
                 status_code=422,
@@ -273,30 +987,41 @@ def create_review(
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.put("/listings/{listing_id}")
+@app.post("/messages", response_model=schemas.MessageOut)
+def create_message(
+    message: schemas.MessageCreate, current_user: int = Depends(authenticated_user)
+):
+    """
+    Sends a message. The reciever is notified in their next digest.
+    """
+    check_acting_user(message.sender_id, current_user)
+    try:
+        new_message = db.create_message(**message.model_dump())
+        if new_message is None:
+            raise HTTPException(status_code=404, detail="Reciever not found.")
+        return new_message
+    except ForeignKeyViolation:
+        raise HTTPException(status_code=400, detail="Invalid 'listing_id'.")
+    except DataError:
+        raise HTTPException(status_code=400, detail="Invalid data format/type.")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.put("/listings/{listing_id}", response_model=schemas.ListingOut)
 def update_listing(
-    listing_type_id: int,
-    product_name: str,
-    title: str,
-    description: str,
-    starting_price: float,
-    pick_up_available: bool,
-    end_date: str,
     listing_id: int,
+    listing: schemas.ListingUpdate,
+    current_user: int = Depends(authenticated_user),
 ):
     """
-    Updates a listing.
+    Updates a listing of the logged in seller.
     """
     try:
         updated_listing = db.update_listing(
-            listing_type_id,
-            product_name,
-            title,
-            description,
-            starting_price,
-            pick_up_available,
-            end_date,
-            listing_id,
+            listing_id, listing.model_dump(), seller_id=current_user
         )
         if not updated_listing:
             raise HTTPException(
@@ -317,39 +1042,17 @@ def update_listing(
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.put("/users/{user_id}")
-def update_user(
-    language_id: int,
-    currency_id: int,
-    profile_picture_id: int,
-    city_id: int,
-    username: str,
-    email: str,
-    first_name: str,
-    last_name: str,
-    phone_number: str,
-    address: str,
-    postal_code: str,
-    user_id,
-):
+@app.put(
+    "/users/{user_id}",
+    response_model=schemas.UserOut,
+    dependencies=[Depends(authorize_user)],
+)
+def update_user(user_id: int, user: schemas.UserUpdate):
     """
     Updates a user.
     """
     try:
-        updated_user = db.update_user(
-            language_id,
-            currency_id,
-            profile_picture_id,
-            city_id,
-            username,
-            email,
-            first_name,
-            last_name,
-            phone_number,
-            address,
-            postal_code,
-            user_id,
-        )
+        updated_user = db.update_user(user_id, user.model_dump())
         if not updated_user:
             raise HTTPException(status_code=404, detail="Couldn't find requested user.")
         return updated_user
@@ -366,10 +1069,23 @@ def update_user(
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.put("/listings/{listing_id}/status")
-def update_listing_status(listing_id: int, status_id: int):
+@app.put("/listings/{listing_id}/status", response_model=schemas.ListingOut)
+def update_listing_status(
+    listing_id: int,
+    status: schemas.ListingStatusUpdate,
+    current_user: int = Depends(authenticated_user),
+):
+    """
+    Updates the status of a listing of the logged in seller.
+    """
     try:
-        updated_status = db.update_listing_status(listing_id, status_id)
+        updated_status = db.update_listing_status(
+            listing_id, status.status_id, seller_id=current_user
+        )
+        if not updated_status:
+            raise HTTPException(
+                status_code=404, detail="Couldn't find requested listing."
+            )
         return updated_status
     except ForeignKeyViolation:
         raise HTTPException(
@@ -380,19 +1096,34 @@ def update_listing_status(listing_id: int, status_id: int):
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.put("/users/{user_id}/password")
-def update_password(password_hash: str, user_id: int):
+@app.put("/users/{user_id}/password", dependencies=[Depends(authorize_user)])
+async def update_password(user_id: int, password: schemas.PasswordUpdate):
     """
-    Updates a users password.
+    Updates a users password after checking the current one. All tokens
+    issued to the user are revoked, so they have to log in again.
     """
     try:
-        updated_user = db.update_password(password_hash, user_id)
+        user = await run_in_threadpool(db.get_password_hash, user_id=user_id)
+        if user is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Could not find requested user_id for a user.",
+            )
+        if not await passwords.verify_password(
+            password.current_password, user["password_hash"]
+        ):
+            raise HTTPException(status_code=403, detail="Wrong current password.")
+
+        password_hash = await passwords.hash_password(password.new_password)
+        updated_user = await run_in_threadpool(
+            db.update_password, password_hash, user_id, auth.user_revocation()
+        )
         if not updated_user:
             raise HTTPException(
                 status_code=404,
                 detail="Could not find requested user_id for a user.",
             )
-        return {"message: Successfully changed password."}
+        return {"message": "Successfully changed password."}
     except ForeignKeyViolation:
         raise HTTPException(
             status_code=400,
@@ -402,30 +1133,58 @@ def update_password(password_hash: str, user_id: int):
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.put("/orders/{order_id}")
+@app.post("/login")
+async def login(credentials: schemas.Login):
+    """
+    Checks a username and password and issues a bearer token.
+    """
+    try:
+        user = await run_in_threadpool(
+            db.get_password_hash, username=credentials.username
+        )
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+
+    if not await passwords.verify_password(
+        credentials.password, user["password_hash"] if user else None
+    ):
+        raise HTTPException(status_code=401, detail="Wrong username or password.")
+
+    token, expires_at = auth.issue_token(user["user_id"])
+    return {
+        "user_id": user["user_id"],
+        "access_token": token,
+        "token_type": "bearer",
+        "expires_at": datetime.fromtimestamp(expires_at),
+    }
+
+
+@app.post("/logout", dependencies=[Depends(authenticated_user)])
+def logout(authorization: str = Header()):
+    """
+    Revokes the request's token in every worker.
+    """
+    try:
+        auth.revoke_token(auth.bearer_token(authorization))
+        return {"message": "Logged out."}
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.put("/orders/{order_id}", response_model=schemas.OrderOut)
 def update_order(
-    shipping_option_id: int,
-    order_status_id: int,
-    shipping_address: str,
-    shipping_city: str,
-    shipping_postal_code: str,
-    final_price: float,
-    discount_amount: float,
     order_id: int,
+    order: schemas.OrderUpdate,
+    current_user: int = Depends(authenticated_user),
 ):
     """
-    Updates a order.
+    Updates a order the logged in user bought or sold.
     """
     try:
         updated_order = db.update_order(
-            shipping_option_id,
-            order_status_id,
-            shipping_address,
-            shipping_city,
-            shipping_postal_code,
-            final_price,
-            discount_amount,
-            order_id,
+            order_id, order.model_dump(), user_id=current_user
         )
         if not updated_order:
             raise HTTPException(
@@ -433,6 +1192,8 @@ def update_order(
                 detail="Could not find requested order_id for a order.",
             )
         return updated_order
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
     except UniqueViolation:
         raise HTTPException(
             status_code=409, detail="Order already exists with same info."
@@ -446,55 +1207,51 @@ def update_order(
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.delete("/listings/{listing_id}")
-def delete_listing(listing_id: int):
+@app.delete("/listings/{listing_id}", response_model=schemas.ListingDeleted)
+def delete_listing(listing_id: int, current_user: int = Depends(authenticated_user)):
     """
-    Updates a listings.
+    Deletes a listing of the logged in seller. Its bids, images and other
+    related rows are removed later in the background.
     """
     try:
-        deleted_listing = db.delete_listing(listing_id)
+        deleted_listing = db.delete_listing(listing_id, current_user)
         if not deleted_listing:
             raise HTTPException(
                 status_code=404, detail="Couldn't find the requested listing."
             )
         return deleted_listing
-    except ForeignKeyViolation:
-        raise HTTPException(
-            status_code=400,
-            detail="Cannot delete listing, has active relations.",
-        )
     except DataError:
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.delete("/users/{user_id}")
+@app.delete(
+    "/users/{user_id}",
+    response_model=schemas.UserDeleted,
+    dependencies=[Depends(authorize_user)],
+)
 def delete_user(user_id: int):
     """
-    Deletes a user.
+    Deletes a user with their listings and revokes their tokens. Related
+    rows are removed later in the background.
     """
     try:
-        deleted_user = db.delete_user(user_id)
+        deleted_user = db.delete_user(user_id, auth.user_revocation())
         if not deleted_user:
             raise HTTPException(
                 status_code=404, detail="Couldn't find the requested user."
             )
         return deleted_user
-    except ForeignKeyViolation:
-        raise HTTPException(
-            status_code=400,
-            detail="Cannot delete user, has active relations.",
-        )
     except DataError:
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.delete("/messages/{message_id}")
-def delete_message(message_id: int):
+@app.delete("/messages/{message_id}", response_model=schemas.MessageDeleted)
+def delete_message(message_id: int, current_user: int = Depends(authenticated_user)):
     """
-    Deletes a message.
+    Deletes a message sent by the logged in user.
     """
     try:
-        deleted_message = db.delete_message(message_id)
+        deleted_message = db.delete_message(message_id, current_user)
         if not deleted_message:
             raise HTTPException(
                 status_code=404, detail="Couldn't find the requested message."
@@ -509,7 +1266,11 @@ def delete_message(message_id: int):
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.delete("/payment_methods/{method_id}")
+@app.delete(
+    "/payment_methods/{method_id}",
+    response_model=schemas.PaymentMethodDeleted,
+    dependencies=[Depends(authorize_admin)],
+)
 def delete_payment_method(method_id: int):
     """
     Deletes a payment_method.
@@ -526,13 +1287,13 @@ def delete_payment_method(method_id: int):
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.delete("/orders/{order_id}")
-def delete_order(order_id: int):
+@app.delete("/orders/{order_id}", response_model=schemas.OrderDeleted)
+def delete_order(order_id: int, current_user: int = Depends(authenticated_user)):
     """
-    Deletes a order.
+    Deletes a order the logged in user bought or sold.
     """
     try:
-        deleted_order = db.delete_order(order_id)
+        deleted_order = db.delete_order(order_id, current_user)
         if not deleted_order:
             raise HTTPException(
                 status_code=404, detail="Couldn't find the requested order."
@@ -547,43 +1308,17 @@ def delete_order(order_id: int):
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
 
 
-@app.patch("/users/{user_id}")
-def partial_update_user(
-    user_id: int,
-    username: str = None,
-    email: str = None,
-    first_name: str = None,
-    last_name: str = None,
-    phone_number: str = None,
-    address: str = None,
-    postal_code: str = None,
-    language_id: int = None,
-    currency_id: int = None,
-    city_id: int = None,
-    profile_picture_id: int = None,
-    translation_on: bool = None,
-    vacation_mode: bool = None,
-):
+@app.patch(
+    "/users/{user_id}",
+    response_model=schemas.UserOut,
+    dependencies=[Depends(authorize_user)],
+)
+def partial_update_user(user_id: int, user: schemas.UserPatch):
     """
     Partially updates a user based on the input.
     """
     try:
-        updated_user = db.partial_update_user(
-            user_id,
-            username,
-            email,
-            first_name,
-            last_name,
-            phone_number,
-            address,
-            postal_code,
-            language_id,
-            currency_id,
-            city_id,
-            profile_picture_id,
-            translation_on,
-            vacation_mode,
-        )
+        updated_user = db.update_user(user_id, user.model_dump(exclude_unset=True))
         if not updated_user:
             raise HTTPException(status_code=404, detail="Couldn't find user.")
 
@@ -600,3 +1335,158 @@ def partial_update_user(
         )
     except DataError:
         raise HTTPException(status_code=400, detail="Invalid data format/type.")
+
+
+@app.patch("/listings/{listing_id}", response_model=schemas.ListingOut)
+def partial_update_listing(
+    listing_id: int,
+    listing: schemas.ListingPatch,
+    current_user: int = Depends(authenticated_user),
+):
+    """
+    Partially updates a listing of the logged in seller based on the input.
+    """
+    try:
+        updated_listing = db.update_listing(
+            listing_id, listing.model_dump(exclude_unset=True), seller_id=current_user
+        )
+        if not updated_listing:
+            raise HTTPException(status_code=404, detail="Couldn't find listing.")
+
+        return updated_listing
+    except ForeignKeyViolation:
+        raise HTTPException(status_code=400, detail="Invalid 'listing_type_id'.")
+    except DataError:
+        raise HTTPException(status_code=400, detail="Invalid data format/type.")
+
+
+@app.patch("/orders/{order_id}", response_model=schemas.OrderOut)
+def partial_update_order(
+    order_id: int,
+    order: schemas.OrderPatch,
+    current_user: int = Depends(authenticated_user),
+):
+    """
+    Partially updates a order the logged in user bought or sold.
+    """
+    try:
+        updated_order = db.update_order(
+            order_id, order.model_dump(exclude_unset=True), user_id=current_user
+        )
+        if not updated_order:
+            raise HTTPException(status_code=404, detail="Couldn't find order.")
+
+        return updated_order
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except ForeignKeyViolation:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid 'shipping_option_id' or 'order_status_id'.",
+        )
+    except DataError:
+        raise HTTPException(status_code=400, detail="Invalid data format/type.")
+
+
+@app.put(
+    "/admin/listings/status",
+    response_model=schemas.BulkUpdateResult,
+    dependencies=[Depends(authorize_admin)],
+)
+def bulk_update_listing_status(update: schemas.BulkListingStatusUpdate):
+    """
+    Updates the status of many listings, by id or for all of a seller's listings.
+    """
+    try:
+        updated = db.bulk_update_listing_status(
+            update.status_id,
+            listing_ids=update.listing_ids,
+            seller_id=update.seller_id,
+            from_status_id=update.from_status_id,
+            batch_size=update.batch_size or db.BULK_BATCH_SIZE,
+        )
+        return {"updated": updated}
+    except ForeignKeyViolation:
+        raise HTTPException(status_code=400, detail="Invalid 'status_id'.")
+    except DataError:
+        raise HTTPException(status_code=400, detail="Invalid data format/type.")
+
+
+@app.put(
+    "/admin/orders/status",
+    response_model=schemas.BulkUpdateResult,
+    dependencies=[Depends(authorize_admin)],
+)
+def bulk_update_order_status(update: schemas.BulkOrderStatusUpdate):
+    """
+    Updates the status of many orders, by id or for all of a seller's orders.
+    """
+    try:
+        updated = db.bulk_update_order_status(
+            update.order_status_id,
+            order_ids=update.order_ids,
+            seller_id=update.seller_id,
+            from_status_id=update.from_status_id,
+            batch_size=update.batch_size or db.BULK_BATCH_SIZE,
+        )
+        return {"updated": updated}
+    except ForeignKeyViolation:
+        raise HTTPException(status_code=400, detail="Invalid 'order_status_id'.")
+    except DataError:
+        raise HTTPException(status_code=400, detail="Invalid data format/type.")
+
+
+@app.post("/admin/dashboard/rebuild", dependencies=[Depends(authorize_admin)])
+def rebuild_seller_stats():
+    """
+    Recomputes the seller dashboard rollups from the base tables.
+    """
+    try:
+        db.rebuild_seller_stats()
+        return {"message": "Rebuilt seller dashboard rollups."}
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/changes", dependencies=[Depends(authorize_admin)])
+def get_changes(
+    since: str = Query(default="0.0", pattern=r"^\d+\.\d+$"),
+    limit: int = Query(default=500, gt=0, le=5000),
+    entity: list[Literal["listing", "bid", "order"]] = Query(default=None),
+):
+    """
+    Fetches listing, bid and order changes in the order they were committed,
+    for incremental sync. Pass the returned 'next' as 'since' to get the
+    following batch, an empty batch means the consumer has caught up.
+    """
+    after_txid, after_seq = map(int, since.split("."))
+    try:
+        changes = db.get_changes(after_txid, after_seq, limit, entities=entity)
+        return Response(content=changes, media_type="application/json")
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
+
+
+@app.get("/metrics/rate_limit", dependencies=[Depends(authorize_admin)])
+def get_rate_limit_metrics():
+    """
+    Shows admitted and rejected requests on rate limited routes.
+    """
+    return rate_limit.metrics()
+
+
+@app.get("/metrics/notifications", dependencies=[Depends(authorize_admin)])
+def get_notification_metrics():
+    """
+    Shows notification pipeline throughput and backlog.
+    """
+    try:
+        return notifications.metrics()
+    except psycopg2.OperationalError:
+        raise HTTPException(status_code=503, detail="No database connection found.")
+    except psycopg2.DatabaseError:
+        raise HTTPException(status_code=500, detail="Database error occured.")
@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+
+import cache
+import db
+from background import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+# Tokens are "<user_id>.<issued_at ms>.<expires_at>.<token_id>.<signature>",
+# signed with HMAC-SHA256, so they are verified without a database lookup.
+# All workers must share AUTH_SECRET for tokens to work across them.
+AUTH_SECRET = os.getenv("AUTH_SECRET")
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", 3600))
+# How often the revocation set is reloaded from token_revocations. Revocations
+# also reach every worker right away through the cache invalidation channel,
+# the reload catches messages missed while a listener reconnected.
+REVOCATION_REFRESH_INTERVAL = float(os.getenv("REVOCATION_REFRESH_INTERVAL", 60))
+ADMIN_USER_IDS = {
+    int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id
+}
+
+if not AUTH_SECRET:
+    logger.warning(
+        "AUTH_SECRET is not set, tokens are signed with a random key and stop "
+        "working on restart and in other workers."
+    )
+    AUTH_SECRET = secrets.token_urlsafe(32)
+
+_key = AUTH_SECRET.encode()
+# Revoked token ids, and per user the time in ms at or before which all
+# tokens issued to them are revoked. Both are replaced whole on refresh.
+_revoked_tokens = set()
+_revoked_users = {}
+_lock = threading.Lock()
+# Messages received while a refresh is querying, replayed onto its result.
+_pending = None
+
+
+def _sign(payload: str):
+    digest = hmac.new(_key, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def issue_token(user_id: int):
+    """
+    Creates a signed token for a user, returned with its expiry time.
+    """
+    issued_at = int(time.time() * 1000)
+    expires_at = issued_at // 1000 + TOKEN_TTL
+    payload = f"{user_id}.{issued_at}.{expires_at}.{secrets.token_hex(16)}"
+    return f"{payload}.{_sign(payload)}", expires_at
+
+
+def _parse(token: str):
+    payload, _, signature = token.rpartition(".")
+    # Bytes, compare_digest raises TypeError on non-ASCII str.
+    if not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+        return None
+    user_id, issued_at, expires_at, token_id = payload.split(".")
+    return int(user_id), int(issued_at), int(expires_at), token_id
+
+
+def verify_token(token: str):
+    """
+    Returns the user_id of a valid token, or None when the token is
+    malformed, has a bad signature, has expired or was revoked.
+    """
+    try:
+        claims = _parse(token)
+    except ValueError:
+        return None
+    if claims is None:
+        return None
+
+    user_id, issued_at, expires_at, token_id = claims
+    if expires_at <= time.time() or token_id in _revoked_tokens:
+        return None
+    if issued_at <= _revoked_users.get(user_id, -1):
+        return None
+    return user_id
+
+
+def bearer_token(authorization: str | None):
+    """
+    Extracts the token of an 'Authorization: Bearer <token>' header.
+    """
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token.strip()
+
+
+def revoke_token(token: str):
+    """
+    Revokes one already verified token (logout) in every worker.
+    """
+    user_id, _, expires_at, token_id = _parse(token)
+    db.revoke_token(user_id, token_id, expires_at)
+
+
+def user_revocation():
+    """
+    Returns (revoked_at, expires_at) revoking every token issued to a user
+    until now, for db functions that store it with their own change.
+    """
+    now = time.time()
+    return int(now * 1000), int(now) + TOKEN_TTL
+
+
+def _apply(key: str, revoked_tokens: set, revoked_users: dict):
+    # "token:<token_id>" or "user:<user_id>:<revoked_at ms>".
+    kind, _, value = key.partition(":")
+    if kind == "token":
+        revoked_tokens.add(value)
+    elif kind == "user":
+        user_id, _, revoked_at = value.partition(":")
+        user_id, revoked_at = int(user_id), int(revoked_at)
+        revoked_users[user_id] = max(revoked_users.get(user_id, -1), revoked_at)
+
+
+def _on_revocation(key: str):
+    if key == "*":
+        _worker.wake()
+        return
+    with _lock:
+        _apply(key, _revoked_tokens, _revoked_users)
+        if _pending is not None:
+            _pending.append(key)
+
+
+def refresh():
+    """
+    Reloads the revocation set from the database, dropping expired entries.
+    """
+    global _revoked_tokens, _revoked_users, _pending
+    with _lock:
+        _pending = []
+    try:
+        rows = db.get_token_revocations()
+    except Exception:
+        with _lock:
+            _pending = None
+        raise
+
+    revoked_tokens, revoked_users = set(), {}
+    for row in rows:
+        if row["token_id"] is not None:
+            revoked_tokens.add(row["token_id"])
+        else:
+            revoked_users[row["user_id"]] = max(
+                revoked_users.get(row["user_id"], -1), row["revoked_at"]
+            )
+    with _lock:
+        for key in _pending:
+            _apply(key, revoked_tokens, revoked_users)
+        _revoked_tokens, _revoked_users = revoked_tokens, revoked_users
+        _pending = None
+
+
+cache.on_message("token_revocation", _on_revocation)
+_worker = PeriodicWorker("token-revocations", REVOCATION_REFRESH_INTERVAL, refresh)
+
+
+def start():
+    _worker.start()
+
+
+def stop():
+    _worker.stop()
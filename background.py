@@ -0,0 +1,48 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker:
+    """
+    Runs a task in a daemon thread every 'interval' seconds, or earlier when
+    woken. The task runs one last time when the worker is stopped.
+    """
+
+    def __init__(self, name: str, interval: float, task):
+        self.name = name
+        self.interval = interval
+        self.task = task
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout: float = 10):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.task()
+            except Exception:
+                logger.exception("Background task '%s' failed.", self.name)
+            if self._stop.is_set():
+                return
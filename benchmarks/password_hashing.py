@@ -0,0 +1,91 @@
+"""
+Measures registration throughput and latency while logins run at the same
+time, with hashing done in the passwords process pool.
+
+Run from the project root (no database needed):
+
+    python -m benchmarks.password_hashing [registrations] [concurrent logins]
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+
+import passwords
+
+
+def _percentile(values: list, percent: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent))]
+
+
+async def _timed(coroutine, latencies: list):
+    start = time.perf_counter()
+    await coroutine
+    latencies.append(time.perf_counter() - start)
+
+
+async def _logins(password_hash: str, stop: asyncio.Event, latencies: list):
+    while not stop.is_set():
+        await _timed(passwords.verify_password("password123", password_hash), latencies)
+
+
+async def _run(registrations: int, concurrent_logins: int):
+    password_hash = await passwords.hash_password("password123")
+    # A heartbeat shows whether the event loop stays responsive.
+    heartbeat_delays = []
+
+    async def heartbeat():
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            heartbeat_delays.append(time.perf_counter() - start - 0.01)
+
+    stop = asyncio.Event()
+    login_latencies, register_latencies = [], []
+    background = [
+        asyncio.create_task(_logins(password_hash, stop, login_latencies))
+        for _ in range(concurrent_logins)
+    ]
+    background.append(asyncio.create_task(heartbeat()))
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            _timed(passwords.hash_password(f"password{i}"), register_latencies)
+            for i in range(registrations)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await asyncio.gather(*background)
+
+    print(
+        f"workers={passwords.PASSWORD_HASH_WORKERS} "
+        f"scrypt n={passwords.SCRYPT_N} r={passwords.SCRYPT_R} p={passwords.SCRYPT_P}"
+    )
+    print(f"registrations: {registrations / elapsed:.1f}/s")
+    for name, latencies in (
+        ("registration", register_latencies),
+        ("login", login_latencies),
+    ):
+        print(
+            f"{name} latency: p50 {statistics.median(latencies) * 1000:.0f} ms, "
+            f"p99 {_percentile(latencies, 0.99) * 1000:.0f} ms"
+        )
+    print(f"event loop max stall: {max(heartbeat_delays) * 1000:.1f} ms")
+
+
+def run(registrations: int = 200, concurrent_logins: int = 8):
+    try:
+        asyncio.run(_run(registrations, concurrent_logins))
+    finally:
+        passwords.stop()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+    )
@@ -0,0 +1,76 @@
+"""
+Compares plain SQL against the prepared statements in db.PREPARED_STATEMENTS.
+
+Run from the project root against a seeded database:
+
+    python -m benchmarks.prepared_statements [iterations]
+"""
+
+import sys
+import time
+
+import db
+from db_setup import get_connection as con
+
+
+def _first_id(cursor, table: str, column: str):
+    cursor.execute(f"SELECT {column} FROM {table} ORDER BY {column} LIMIT 1")
+    row = cursor.fetchone()
+    if row is None:
+        sys.exit(f"Table '{table}' is empty, seed the database first.")
+    return row[0]
+
+
+def _planning_time(cursor, statement: str, params: tuple):
+    """
+    Returns the planning time in ms reported by EXPLAIN ANALYZE.
+    """
+    cursor.execute(f"EXPLAIN (ANALYZE, SUMMARY) {statement}", params)
+    for (line,) in cursor.fetchall():
+        if line.startswith("Planning Time"):
+            return float(line.split(":")[1].split()[0])
+    return 0.0
+
+
+def run(iterations: int = 5000):
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cases = {
+                "get_user_by_id": (_first_id(cursor, "users", "user_id"),),
+                "get_listing_by_id": (
+                    _first_id(cursor, "listings", "listing_id"),
+                ),
+            }
+
+            for name, params in cases.items():
+                _, query = db.PREPARED_STATEMENTS[name]
+                plain = query.replace("$1", "%s")
+
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    cursor.execute(plain, params)
+                    cursor.fetchone()
+                plain_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    db.execute_prepared(cursor, name, params)
+                    cursor.fetchone()
+                prepared_seconds = time.perf_counter() - start
+
+                plain_planning = _planning_time(cursor, plain, params)
+                prepared_planning = _planning_time(
+                    cursor, f"EXECUTE {name}(%s)", params
+                )
+
+                print(
+                    f"{name}: plain {plain_seconds / iterations * 1e6:.1f} us/query "
+                    f"(planning {plain_planning:.3f} ms), "
+                    f"prepared {prepared_seconds / iterations * 1e6:.1f} us/query "
+                    f"(planning {prepared_planning:.3f} ms), "
+                    f"speedup {plain_seconds / prepared_seconds:.2f}x"
+                )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,551 @@
+"""
+Checks the query plans of the queries in db.py against a seeded database.
+
+Every case calls a db.py function on pooled connections that EXPLAIN each
+statement before running it and roll back instead of committing. Every
+public db.py function needs a case, unless it's in NOT_CHECKED. A case
+fails when
+
+- a statement still scans a table sequentially with enable_seqscan off,
+  i.e. no index can serve it, and the case doesn't allow that table
+- the estimated cost of a statement exceeds its recorded budget.
+
+Run from the project root, on a database filled by benchmarks.seed:
+
+    python -m benchmarks.seed
+    python -m benchmarks.query_plans            # exits with 1 on failures
+    python -m benchmarks.query_plans --record   # (re)writes the cost budgets
+
+Costs depend on the size of the seeded data, so record the budgets on the
+database the check runs against.
+"""
+
+import inspect
+import json
+import os
+import sys
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import auth
+import db
+import db_setup
+import order_book
+import psycopg2
+import schemas
+from db_setup import PreparedConnection
+from db_setup import get_connection as con
+from psycopg2.extensions import cursor as Cursor
+from psycopg2.pool import ThreadedConnectionPool
+
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), "query_plan_budgets.json")
+# Recorded budgets leave this much room above the current cost.
+BUDGET_HEADROOM = 1.5
+
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "EXECUTE")
+LOOKUP_TABLES = set(db.LOOKUP_TABLES)
+# Public db.py functions without a case of their own: query builders and
+# helpers that only run inside the functions checked here, and warm_up,
+# which only PREPAREs statements the other cases EXECUTE.
+NOT_CHECKED = {
+    "log_change",
+    "counted_order",
+    "order_rollups",
+    "execute_prepared",
+    "partial_update",
+    "bulk_update_status",
+    "revoke_user_tokens",
+    "warm_up",
+}
+
+# Plans of the statements run by the current case.
+_plans = []
+
+
+def _plan_nodes(node: dict):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from _plan_nodes(child)
+
+
+def _explain(conn, statement: bytes):
+    """
+    Records the estimated cost of a statement and the tables it can only
+    scan sequentially, without running it.
+    """
+    cursor = Cursor(conn)
+    try:
+        cursor.execute(b"EXPLAIN (FORMAT JSON) " + statement)
+        cost = cursor.fetchone()[0][0]["Plan"]["Total Cost"]
+
+        cursor.execute("SAVEPOINT query_plans")
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute(b"EXPLAIN (FORMAT JSON) " + statement)
+        plan = cursor.fetchone()[0][0]["Plan"]
+        cursor.execute("ROLLBACK TO SAVEPOINT query_plans")
+    finally:
+        cursor.close()
+
+    seq_scans = {
+        node["Relation Name"]
+        for node in _plan_nodes(plan)
+        if node["Node Type"] == "Seq Scan"
+    }
+    _plans.append((statement.decode(), cost, seq_scans))
+
+
+_cursor_classes = {}
+
+
+def _explaining_cursor(factory):
+    if factory not in _cursor_classes:
+
+        class ExplainingCursor(factory):
+            def execute(self, query, vars=None):
+                statement = self.mogrify(query, vars)
+                if statement.lstrip().upper().startswith(
+                    tuple(keyword.encode() for keyword in EXPLAINABLE)
+                ):
+                    _explain(self.connection, statement)
+                return super().execute(query, vars)
+
+        _cursor_classes[factory] = ExplainingCursor
+    return _cursor_classes[factory]
+
+
+class DryRunConnection(PreparedConnection):
+    """
+    Connection that EXPLAINs what its cursors execute and ignores commits.
+    Leaving 'with conn:' rolls back too, where psycopg2 would commit.
+    """
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        factory = _explaining_cursor(cursor_factory or self.cursor_factory or Cursor)
+        return super().cursor(*args, cursor_factory=factory, **kwargs)
+
+    def commit(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.rollback()
+        return False
+
+
+def _first(cursor, query: str, table: str):
+    cursor.execute(query)
+    row = cursor.fetchone()
+    if row is None:
+        sys.exit(f"No rows in '{table}' to check with, seed the database first.")
+    return row[0] if len(row) == 1 else row
+
+
+def _cases():
+    """
+    Returns (name, call, tables allowed to be scanned sequentially). Names
+    are the db.py function, optionally followed by ':variant'.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            user_id = _first(
+                cursor,
+                "SELECT user_id FROM users WHERE deleted_at IS NULL LIMIT 1",
+                "users",
+            )
+            username = _first(
+                cursor, f"SELECT username FROM users WHERE user_id = {user_id}", "users"
+            )
+            city_id, postal_code = _first(
+                cursor, "SELECT city_id, postal_code FROM postal_codes LIMIT 1",
+                "postal_codes",
+            )
+            seller_id = _first(
+                cursor,
+                "SELECT seller_id FROM listings WHERE deleted_at IS NULL LIMIT 1",
+                "listings",
+            )
+            listing_id = _first(
+                cursor,
+                "SELECT listing_id FROM listings "
+                "WHERE status_id = 1 AND deleted_at IS NULL LIMIT 1",
+                "listings",
+            )
+            # An ended auction its winner hasn't ordered yet.
+            won_listing_id, winner_id = _first(
+                cursor,
+                """
+                SELECT l.listing_id, top.user_id
+                FROM listings l
+                CROSS JOIN LATERAL (
+                    SELECT user_id FROM bids b
+                    WHERE b.listing_id = l.listing_id
+                    ORDER BY bid_amount DESC, bidded_at
+                    LIMIT 1
+                ) top
+                WHERE l.end_date <= CURRENT_TIMESTAMP AND l.deleted_at IS NULL
+                AND NOT EXISTS (
+                    SELECT 1 FROM orders o WHERE o.listing_id = l.listing_id
+                )
+                LIMIT 1
+                """,
+                "listings",
+            )
+            # A listing one of whose bidders was purged by benchmarks.seed.
+            purged_bid_listing_id = _first(
+                cursor,
+                """
+                SELECT b.listing_id
+                FROM bids b
+                JOIN listings l USING (listing_id)
+                WHERE b.user_id IS NULL AND l.deleted_at IS NULL
+                LIMIT 1
+                """,
+                "bids",
+            )
+            order_id, buyer_id, order_listing_id, order_seller_id = _first(
+                cursor,
+                "SELECT order_id, buyer_id, listing_id, seller_id FROM orders LIMIT 1",
+                "orders",
+            )
+            reviewee_id = _first(
+                cursor, "SELECT reviewee_id FROM reviews LIMIT 1", "reviews"
+            )
+            listing_type_id = _first(
+                cursor,
+                "SELECT listing_type_id FROM listing_types LIMIT 1",
+                "listing_types",
+            )
+            category_id = _first(
+                cursor, "SELECT category_id FROM listing_categories LIMIT 1",
+                "listing_categories",
+            )
+            shipping_id = _first(
+                cursor,
+                "SELECT shipping_id FROM shipping_options LIMIT 1",
+                "shipping_options",
+            )
+            img_id = _first(cursor, "SELECT img_id FROM img LIMIT 1", "img")
+            message_id, sender_id = _first(
+                cursor, "SELECT message_id, sender_id FROM messages LIMIT 1", "messages"
+            )
+            currency_id = _first(
+                cursor,
+                "SELECT currency_id FROM exchange_rates LIMIT 1",
+                "exchange_rates",
+            )
+            # Deleting a payment method that orders use would fail.
+            method_id = _first(
+                cursor,
+                """
+                SELECT method_id FROM payment_methods m
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM orders o WHERE o.payment_id = m.method_id
+                )
+                LIMIT 1
+                """,
+                "payment_methods",
+            )
+
+    today = date.today()
+    end_date = datetime.now(timezone.utc) + timedelta(days=7)
+    revocation = auth.user_revocation()
+    cases = [
+        ("get_lookups", lambda: db.get_lookups(), LOOKUP_TABLES),
+        ("get_all_listings", lambda: db.get_all_listings(), {"listings"}),
+        ("get_all_users", lambda: db.get_all_users(), {"users"}),
+        (
+            "get_most_viewed_listings",
+            lambda: db.get_most_viewed_listings(20),
+            {"listings"},
+        ),
+        ("get_categories", lambda: db.get_categories(), {"categories"}),
+        (
+            "get_category_listings",
+            lambda: db.get_category_listings([category_id]),
+            set(),
+        ),
+        (
+            "get_nearby_listings",
+            lambda: db.get_nearby_listings(59.91, 10.75, 25),
+            set(),
+        ),
+        ("get_user_by_id", lambda: db.get_user_by_id(user_id), set()),
+        ("get_listing_by_id", lambda: db.get_listing_by_id(listing_id), set()),
+        ("get_all_user_listings", lambda: db.get_all_user_listings(seller_id), set()),
+        ("get_user_orders:buyer", lambda: db.get_user_orders(buyer_id, "buyer"), set()),
+        (
+            "get_user_orders:seller",
+            lambda: db.get_user_orders(seller_id, "seller"),
+            set(),
+        ),
+        ("get_user_reviews", lambda: db.get_user_reviews(reviewee_id), set()),
+        ("get_rating_summary", lambda: db.get_rating_summary(reviewee_id), set()),
+        (
+            "get_seller_daily_stats",
+            lambda: db.get_seller_daily_stats(
+                seller_id, today - timedelta(days=30), today
+            ),
+            set(),
+        ),
+        (
+            "get_seller_listing_stats",
+            lambda: db.get_seller_listing_stats(seller_id),
+            set(),
+        ),
+        (
+            "get_primary_thumbnails",
+            lambda: db.get_primary_thumbnails([listing_id]),
+            set(),
+        ),
+        ("get_password_hash", lambda: db.get_password_hash(username=username), set()),
+        ("get_postal_code", lambda: db.get_postal_code(postal_code), set()),
+        ("get_exchange_rates", lambda: db.get_exchange_rates(), {"exchange_rates"}),
+        ("get_order_books:by_id", lambda: db.get_order_books([listing_id]), set()),
+        # GET /listings/{id}/price must still validate after a bidder's
+        # bids lost their user_id.
+        (
+            "get_order_books:purged_bidder",
+            lambda: schemas.ListingPrice.model_validate(
+                order_book.load_price(purged_bid_listing_id)
+            ),
+            set(),
+        ),
+        (
+            "get_order_books:ending",
+            lambda: db.get_order_books(ending_within=3600),
+            {"listings"},
+        ),
+        (
+            "get_token_revocations",
+            lambda: db.get_token_revocations(),
+            {"token_revocations"},
+        ),
+        ("get_changes", lambda: db.get_changes(0, 0, 1000), set()),
+        (
+            "get_changes:by_entity",
+            lambda: db.get_changes(0, 0, 1000, ["listing", "bid"]),
+            set(),
+        ),
+        (
+            "register_user",
+            lambda: db.register_user(
+                "plan_check", "plan_check@example.com", "", "0000000000000",
+                "Plan", "Check", city_id, "Street 1", postal_code, "+46000000000",
+            ),
+            set(),
+        ),
+        ("update_user", lambda: db.update_user(user_id, {"first_name": "Plan"}), set()),
+        ("update_password", lambda: db.update_password("", user_id, revocation), set()),
+        (
+            "revoke_token",
+            lambda: db.revoke_token(user_id, uuid.uuid4().hex, revocation[1]),
+            set(),
+        ),
+        ("add_city", lambda: db.add_city("Plan check", 59.91, 10.75), set()),
+        (
+            "set_city_location",
+            lambda: db.set_city_location(city_id, 59.91, 10.75),
+            set(),
+        ),
+        (
+            "set_postal_code",
+            lambda: db.set_postal_code(postal_code, city_id, 59.91, 10.75),
+            set(),
+        ),
+        ("add_category", lambda: db.add_category("Plan check", None), set()),
+        ("set_exchange_rate", lambda: db.set_exchange_rate(currency_id, "1.5"), set()),
+        ("create_bid", lambda: db.create_bid(listing_id, user_id, 1000000), set()),
+        (
+            "save_order_books",
+            lambda: db.save_order_books([(listing_id, 1000000, 1, user_id)]),
+            set(),
+        ),
+        (
+            "create_listing",
+            lambda: db.create_listing(
+                seller_id, listing_type_id, "Plan check", "Plan check", None, 10,
+                False, end_date,
+            ),
+            set(),
+        ),
+        (
+            "create_order",
+            lambda: db.create_order(
+                winner_id, won_listing_id, shipping_id, "Street 1", "00000",
+                uuid.uuid4().hex,
+            ),
+            set(),
+        ),
+        (
+            "create_review",
+            lambda: db.create_review(
+                order_listing_id, buyer_id, order_seller_id, "Plan check", 5,
+                is_positive=True,
+            ),
+            set(),
+        ),
+        (
+            "update_listing",
+            lambda: db.update_listing(listing_id, {"title": "Plan check"}, seller_id),
+            set(),
+        ),
+        (
+            "update_listing_status",
+            lambda: db.update_listing_status(listing_id, 3, seller_id),
+            set(),
+        ),
+        (
+            "update_order",
+            lambda: db.update_order(
+                order_id, {"shipping_city": "Plan check"}, buyer_id
+            ),
+            set(),
+        ),
+        ("add_listing_views", lambda: db.add_listing_views({listing_id: 1}), set()),
+        (
+            "add_listing_image",
+            lambda: db.add_listing_image(listing_id, "plan_check.jpg"),
+            set(),
+        ),
+        (
+            "add_image_variants",
+            lambda: db.add_image_variants(
+                img_id, 1200, 900, [("small", "plan_check_small.jpg", 200, 150)]
+            ),
+            set(),
+        ),
+        ("delete_image", lambda: db.delete_image(img_id), set()),
+        (
+            "bulk_update_listing_status",
+            lambda: db.bulk_update_listing_status(
+                2, seller_id=seller_id, from_status_id=1
+            ),
+            set(),
+        ),
+        (
+            "bulk_update_order_status",
+            lambda: db.bulk_update_order_status(
+                2, seller_id=seller_id, from_status_id=1
+            ),
+            set(),
+        ),
+        (
+            "rebuild_seller_stats",
+            lambda: db.rebuild_seller_stats(),
+            {
+                "listings",
+                "bids",
+                "orders",
+                "reviews",
+                "seller_daily_stats",
+                "daily_views",
+            },
+        ),
+        (
+            "create_message",
+            lambda: db.create_message(user_id, seller_id, "Plan check", listing_id),
+            set(),
+        ),
+        ("delete_message", lambda: db.delete_message(message_id, sender_id), set()),
+        ("delete_payment_method", lambda: db.delete_payment_method(method_id), set()),
+        ("delete_order", lambda: db.delete_order(order_id, buyer_id), set()),
+        ("delete_listing", lambda: db.delete_listing(listing_id, seller_id), set()),
+        ("delete_user", lambda: db.delete_user(user_id, revocation), set()),
+        ("fan_out_notifications", lambda: db.fan_out_notifications(500, 20), set()),
+        ("deliver_notifications", lambda: db.deliver_notifications(300, 500), set()),
+        ("get_notifications", lambda: db.get_notifications(user_id), set()),
+        (
+            "get_notification_backlog",
+            lambda: db.get_notification_backlog(),
+            {"notification_events", "notification_digests"},
+        ),
+        ("claim_purge", lambda: db.claim_purge(3600, 600), {"purge_queue"}),
+        ("finish_purge", lambda: db.finish_purge("listing", listing_id), set()),
+        ("trim_changelog", lambda: db.trim_changelog(7 * 86400, 500), set()),
+    ]
+    for kind, key in (("listing", listing_id), ("user", user_id)):
+        for index, query in enumerate(db.PURGE_STEPS[kind]):
+            cases.append(
+                (
+                    f"run_purge_step:{kind}_{index}",
+                    lambda query=query, key=key: db.run_purge_step(query, key, 500),
+                    set(),
+                )
+            )
+    return cases
+
+
+def _uncovered(cases: list):
+    """
+    Returns the public db.py functions no case calls.
+    """
+    covered = {name.split(":")[0] for name, _, _ in cases}
+    return sorted(
+        name
+        for name, function in inspect.getmembers(db, inspect.isfunction)
+        if function.__module__ == db.__name__
+        and not name.startswith("_")
+        and name not in covered | NOT_CHECKED
+    )
+
+
+def _dry_run_pool():
+    db_setup.PRIMARY._pool = ThreadedConnectionPool(
+        1,
+        db_setup.POOL_MAX_CONNECTIONS,
+        connection_factory=DryRunConnection,
+        **db_setup.PRIMARY.connect_kwargs,
+    )
+    # Reads are checked on the primary too, its plans are the ones recorded.
+    db_setup.REPLICAS = []
+
+
+def run(record: bool = False):
+    budgets = {}
+    if not record:
+        if not os.path.exists(BUDGETS_PATH):
+            sys.exit(f"No budgets at {BUDGETS_PATH}, run with --record first.")
+        with open(BUDGETS_PATH) as f:
+            budgets = json.load(f)
+
+    cases = _cases()
+    _dry_run_pool()
+    recorded = {}
+    failures = [
+        f"{name}: no case checks its queries, add one to _cases"
+        for name in _uncovered(cases)
+    ]
+    for name, call, allowed_seq_scans in cases:
+        for query_cache in (
+            db.user_cache, db.listing_cache, db.lookup_cache, db.category_cache
+        ):
+            query_cache.clear()
+        _plans.clear()
+        try:
+            call()
+        except (psycopg2.Error, ValueError) as e:
+            failures.append(f"{name}: {type(e).__name__}: {e}".strip())
+
+        for index, (statement, cost, seq_scans) in enumerate(_plans):
+            key = f"{name}[{index}]"
+            recorded[key] = round(cost * BUDGET_HEADROOM, 2)
+            summary = " ".join(statement.split())[:100]
+            for table in sorted(seq_scans - allowed_seq_scans):
+                failures.append(f"{key}: sequential scan on {table}: {summary}")
+            budget = budgets.get(key)
+            if not record and budget is not None and cost > budget:
+                failures.append(f"{key}: cost {cost:.2f} > budget {budget}: {summary}")
+        print(f"{name}: {len(_plans)} statement(s)")
+
+    if record:
+        with open(BUDGETS_PATH, "w") as f:
+            json.dump(recorded, f, indent=2, sort_keys=True)
+        print(f"Recorded {len(recorded)} budgets to {BUDGETS_PATH}")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run(record="--record" in sys.argv[1:])
@@ -0,0 +1,381 @@
+"""
+Fills an empty database with the same generated data on every run, for
+benchmarks.query_plans and the other benchmarks.
+
+Run from the project root, after creating the tables:
+
+    python -m benchmarks.seed [scale]
+
+'scale' multiplies the row counts below (default 1). Dates are relative to
+the time of the run, so auctions that are active or ended stay that way.
+"""
+
+import random
+import sys
+
+import auth
+import db
+import db_setup
+import geo
+import purge
+from db_setup import get_connection as con
+from psycopg2.extras import execute_values
+
+# Rows per unit of scale.
+USERS = 10000
+LISTINGS = 50000
+BIDS = 200000
+MESSAGES = 20000
+WATCHES = 20000
+CITIES = 200
+POSTAL_CODES = 2000
+# Bidders deleted and purged, their bids are kept without a user_id.
+PURGED_BIDDERS = 10
+# Share of listings whose auction has ended, about half of those are ordered.
+ENDED_SHARE = 0.2
+
+SEED = 42
+
+LOOKUPS = {
+    "languages(language_name)": ["Svenska", "English", "Norsk", "Suomi"],
+    "currencies(currency_name)": ["SEK", "EUR", "USD", "NOK"],
+    "listing_types(type_name)": ["Auction", "Buy now"],
+    "payment_methods(method_name)": ["Card", "Invoice", "Swish"],
+    "listing_status(status_name)": ["Active", "Sold", "Ended"],
+    "item_conditions(condition_name)": ["New", "Like new", "Used", "Broken"],
+    "order_status(status_name)": ["Placed", "Shipped", "Delivered", "Cancelled"],
+}
+SHIPPING_OPTIONS = [("Pick up", 0, 0), ("Letter", 3, 29), ("Parcel", 2, 89)]
+EXCHANGE_RATES = [(2, "0.087"), (3, "0.095"), (4, "1.01")]
+CATEGORIES = {
+    "Electronics": ["Phones", "Computers", "Cameras"],
+    "Home": ["Furniture", "Kitchen", "Garden"],
+    "Fashion": ["Shoes", "Bags", "Watches"],
+    "Hobbies": ["Books", "Games", "Music"],
+}
+
+
+def _lookups(cursor):
+    for table, names in LOOKUPS.items():
+        execute_values(cursor, f"INSERT INTO {table} VALUES %s", [(n,) for n in names])
+    execute_values(
+        cursor,
+        "INSERT INTO shipping_options(shipping_name, estimated_days, shipping_cost) "
+        "VALUES %s",
+        SHIPPING_OPTIONS,
+    )
+    execute_values(
+        cursor,
+        "INSERT INTO exchange_rates(currency_id, rate) VALUES %s",
+        EXCHANGE_RATES,
+    )
+
+
+def _places(cursor, rng: random.Random, scale: int):
+    cities = []
+    for index in range(CITIES):
+        latitude, longitude = rng.uniform(55.3, 68.5), rng.uniform(11.1, 24.1)
+        cities.append(
+            (
+                f"City {index + 1}",
+                latitude,
+                longitude,
+                geo.geo_cell(latitude, longitude),
+            )
+        )
+    execute_values(
+        cursor,
+        "INSERT INTO cities(city_name, latitude, longitude, geo_cell) VALUES %s",
+        cities,
+    )
+
+    postal_codes = []
+    for index in range(POSTAL_CODES * scale):
+        city_id = index % CITIES + 1
+        _, latitude, longitude, _ = cities[city_id - 1]
+        latitude += rng.uniform(-0.2, 0.2)
+        longitude += rng.uniform(-0.2, 0.2)
+        postal_codes.append(
+            (
+                f"{index:05d}",
+                city_id,
+                latitude,
+                longitude,
+                geo.geo_cell(latitude, longitude),
+            )
+        )
+    execute_values(
+        cursor,
+        "INSERT INTO postal_codes(postal_code, city_id, latitude, longitude, geo_cell) "
+        "VALUES %s",
+        postal_codes,
+    )
+
+
+def _rows(cursor, scale: int):
+    counts = {
+        "users": USERS * scale,
+        "listings": LISTINGS * scale,
+        "bids": BIDS * scale,
+        "messages": MESSAGES * scale,
+        "watches": WATCHES * scale,
+        "postal_codes": POSTAL_CODES * scale,
+        "cities": CITIES,
+        "categories": sum(len(children) for children in CATEGORIES.values()),
+        "ended_share": ENDED_SHARE,
+        "seed": SEED / 100,
+    }
+    statements = [
+        "SELECT setseed(%(seed)s)",
+        """
+        INSERT INTO users(
+            language_id, currency_id, city_id, username, password_hash, email,
+            social_security_number, first_name, last_name, phone_number,
+            address, postal_code, created_at
+            )
+        SELECT
+            1 + i %% 4,
+            1 + i %% 4,
+            1 + i %% %(cities)s,
+            'user' || i,
+            '',
+            'user' || i || '@example.com',
+            lpad(i::text, 13, '0'),
+            'First' || i,
+            'Last' || i,
+            '+46' || lpad(i::text, 9, '0'),
+            'Street ' || i,
+            lpad((i %% %(postal_codes)s)::text, 5, '0'),
+            CURRENT_TIMESTAMP - make_interval(days => (random() * 1000)::int)
+        FROM generate_series(1, %(users)s) i
+        """,
+        """
+        WITH picks AS MATERIALIZED (
+            SELECT i, random() < %(ended_share)s AS ended
+            FROM generate_series(1, %(listings)s) i
+        )
+        INSERT INTO listings(
+            seller_id, listing_type_id, status_id, product_name, title,
+            description, starting_price, view_count, pick_up_available,
+            start_date, end_date
+            )
+        SELECT
+            1 + (random() * (%(users)s - 1))::int,
+            1,
+            CASE WHEN ended THEN 3 ELSE 1 END,
+            'Product ' || i,
+            'Listing ' || i,
+            'Description of listing ' || i,
+            round((10 + random() * 5000)::numeric, 2),
+            (random() * 1000)::int,
+            random() < 0.2,
+            CURRENT_TIMESTAMP - make_interval(days => 7 + (random() * 60)::int),
+            CASE WHEN ended
+                THEN CURRENT_TIMESTAMP - make_interval(days => 1 + (random() * 30)::int)
+                ELSE CURRENT_TIMESTAMP + make_interval(hours => 1 + (random() * 500)::int)
+            END
+        FROM picks
+        """,
+        """
+        INSERT INTO listing_categories(listing_id, category_id)
+        SELECT l.listing_id, c.category_id
+        FROM listings l
+        JOIN (
+            SELECT category_id, row_number() OVER (ORDER BY category_id) - 1 AS n
+            FROM categories
+            WHERE parent_id IS NOT NULL
+        ) c
+        ON c.n = l.listing_id %% %(categories)s
+        """,
+        """
+        INSERT INTO listing_shipping_options(listing_id, shipping_type_id)
+        SELECT listing_id, 1 + listing_id %% 3 FROM listings
+        """,
+        """
+        WITH picks AS MATERIALIZED (
+            SELECT
+                1 + (random() * (%(listings)s - 1))::int AS listing_id,
+                1 + (random() * (%(users)s - 1))::int AS user_id,
+                random() AS amount,
+                random() AS moment
+            FROM generate_series(1, %(bids)s) i
+        )
+        INSERT INTO bids(listing_id, user_id, bid_amount, bidded_at)
+        SELECT
+            l.listing_id,
+            p.user_id,
+            l.starting_price + round((p.amount * 1000)::numeric, 2),
+            l.start_date + (l.end_date - l.start_date) * p.moment
+        FROM picks p
+        JOIN listings l USING (listing_id)
+        """,
+        """
+        UPDATE listings l
+        SET current_price = top.bid_amount, bid_count = top.bid_count,
+            leader_id = top.user_id
+        FROM (
+            SELECT DISTINCT ON (listing_id)
+                listing_id, bid_amount, user_id,
+                COUNT(*) OVER (PARTITION BY listing_id) AS bid_count
+            FROM bids
+            ORDER BY listing_id, bid_amount DESC, bidded_at
+        ) top
+        WHERE top.listing_id = l.listing_id
+        """,
+        # Every other ended auction with bids is ordered by its winner.
+        """
+        INSERT INTO orders(
+            seller_id, buyer_id, listing_id, shipping_option_id, payment_id,
+            order_status_id, shipping_cost, shipping_address, shipping_city,
+            shipping_postal_code, final_price, discount_amount, total_amount,
+            order_number, idempotency_key, created_at, updated_at
+            )
+        SELECT
+            l.seller_id, l.leader_id, l.listing_id, s.shipping_id, 1,
+            1 + l.listing_id %% 4, s.shipping_cost, 'Street ' || l.leader_id,
+            NULL, '00000', l.current_price, 0, l.current_price + s.shipping_cost,
+            'ORD-SEED-' || l.listing_id, 'seed-' || l.listing_id,
+            l.end_date, l.end_date
+        FROM listings l
+        JOIN shipping_options s ON s.shipping_id = 1 + l.listing_id %% 3
+        WHERE l.status_id = 3 AND l.leader_id IS NOT NULL AND l.listing_id %% 2 = 0
+        """,
+        """
+        UPDATE listings SET status_id = 2
+        WHERE listing_id IN (SELECT listing_id FROM orders)
+        """,
+        """
+        INSERT INTO reviews(
+            listing_id, reviewer_id, reviewee_id, is_negative, is_positive,
+            review_text, rating, created_at
+            )
+        SELECT
+            listing_id, buyer_id, seller_id, rating < 2, rating >= 4,
+            'Review of listing ' || listing_id, rating, created_at + INTERVAL '3 days'
+        FROM (
+            SELECT listing_id, buyer_id, seller_id, created_at,
+                1 + (random() * 4)::int AS rating
+            FROM orders
+            WHERE buyer_id <> seller_id AND order_id %% 3 <> 0
+        ) o
+        """,
+        """
+        WITH images AS (
+            INSERT INTO img(url, width, height)
+            SELECT 'seed/' || listing_id || '.jpg', 1200, 900
+            FROM listings
+            WHERE listing_id %% 2 = 0
+            RETURNING img_id, url
+        )
+        INSERT INTO listing_imgs(img_id, listing_id, position)
+        SELECT img_id, split_part(split_part(url, '/', 2), '.', 1)::int, 0
+        FROM images
+        """,
+        """
+        INSERT INTO img_variants(img_id, variant, url, width, height)
+        SELECT img_id, 'small', replace(url, '.jpg', '_small.jpg'), 200, 150
+        FROM img
+        """,
+        """
+        WITH picks AS MATERIALIZED (
+            SELECT
+                1 + (random() * (%(listings)s - 1))::int AS listing_id,
+                1 + (random() * (%(users)s - 1))::int AS sender_id
+            FROM generate_series(1, %(messages)s) i
+        )
+        INSERT INTO messages(sender_id, reciever_id, listing_id, message_text, sent_at)
+        SELECT
+            p.sender_id,
+            l.seller_id,
+            l.listing_id,
+            'Question about listing ' || l.listing_id,
+            l.start_date + INTERVAL '1 hour'
+        FROM picks p
+        JOIN listings l USING (listing_id)
+        """,
+        """
+        INSERT INTO watchlist(user_id, listing_id)
+        SELECT
+            1 + (random() * (%(users)s - 1))::int,
+            1 + (random() * (%(listings)s - 1))::int
+        FROM generate_series(1, %(watches)s) i
+        ON CONFLICT DO NOTHING
+        """,
+        """
+        INSERT INTO notification_events(kind, listing_id, actor_id, created_at)
+        SELECT 'bid', listing_id, user_id, bidded_at
+        FROM bids
+        WHERE bid_id %% 100 = 0
+        """,
+        """
+        INSERT INTO notifications(
+            user_id, bids, messages, listing_ids, first_at, last_at, created_at
+            )
+        SELECT
+            1 + i %% %(users)s, 1 + i %% 5, i %% 2, ARRAY[1 + i %% %(listings)s],
+            CURRENT_TIMESTAMP - make_interval(mins => i),
+            CURRENT_TIMESTAMP - make_interval(mins => i),
+            CURRENT_TIMESTAMP - make_interval(mins => i)
+        FROM generate_series(1, %(users)s) i
+        """,
+    ]
+    for statement in statements:
+        cursor.execute(statement, counts)
+
+
+def _purge_bidders(count: int):
+    """
+    Deletes the first 'count' bidders and runs purge.py's steps for them and
+    their listings right away.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT user_id FROM bids ORDER BY user_id LIMIT %s", (count,)
+            )
+            user_ids = [user_id for (user_id,) in cursor.fetchall()]
+
+    for user_id in user_ids:
+        db.delete_user(user_id, auth.user_revocation())
+    while True:
+        claimed = db.claim_purge(0, purge.PURGE_LEASE)
+        if claimed is None:
+            break
+        purge.purge(*claimed)
+
+
+def run(scale: int = 1):
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM users)")
+            if cursor.fetchone()[0]:
+                sys.exit("The database already has users, seed an empty one.")
+
+            rng = random.Random(SEED)
+            _lookups(cursor)
+            _places(cursor, rng, scale)
+            conn.commit()
+
+    for root, children in CATEGORIES.items():
+        parent = db.add_category(root)
+        for child in children:
+            db.add_category(child, parent["category_id"])
+
+    with con() as conn:
+        with conn.cursor() as cursor:
+            _rows(cursor, scale)
+            conn.commit()
+
+    _purge_bidders(PURGED_BIDDERS)
+    db.rebuild_seller_stats()
+    with con() as conn:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        conn.autocommit = False
+    print(f"Seeded with scale {scale}.")
+
+
+if __name__ == "__main__":
+    db_setup.create_tables()
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
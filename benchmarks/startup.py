@@ -0,0 +1,74 @@
+"""
+Measures cold start: import time of app.py and time from launching uvicorn
+to the first successful request. Exits with status 1 when the time to first
+request is over STARTUP_BUDGET_SECONDS.
+
+Run from the project root against a seeded database:
+
+    python -m benchmarks.startup [runs]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+PORT = 8766
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", 2.0))
+
+
+def import_time():
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import time; start = time.perf_counter(); import app; "
+            "print(time.perf_counter() - start)",
+        ]
+    )
+    return float(output)
+
+
+def time_to_first_request():
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(PORT)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < 30:
+            try:
+                response = httpx.get(f"http://127.0.0.1:{PORT}/listings", timeout=5)
+                if response.status_code in (200, 404):
+                    return time.perf_counter() - start
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.01)
+        sys.exit("Server didn't answer within 30 seconds.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run(runs: int = 5):
+    imports = [import_time() for _ in range(runs)]
+    first_requests = [time_to_first_request() for _ in range(runs)]
+    median_first_request = statistics.median(first_requests)
+
+    print(f"import app: median {statistics.median(imports) * 1000:.0f} ms")
+    print(
+        f"time to first successful request: median "
+        f"{median_first_request * 1000:.0f} ms, "
+        f"max {max(first_requests) * 1000:.0f} ms "
+        f"(budget {STARTUP_BUDGET_SECONDS * 1000:.0f} ms)"
+    )
+    if median_first_request > STARTUP_BUDGET_SECONDS:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
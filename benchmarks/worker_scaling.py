@@ -0,0 +1,91 @@
+"""
+Measures GET throughput with 1, 2, 4, ... gunicorn workers to check that it
+scales with the number of cores.
+
+Run from the project root against a seeded database:
+
+    python -m benchmarks.worker_scaling [seconds per run] [concurrency]
+"""
+
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+PORT = 8765
+URL = f"http://127.0.0.1:{PORT}"
+
+
+def _worker_counts():
+    counts, count = [], 1
+    while count < multiprocessing.cpu_count():
+        counts.append(count)
+        count *= 2
+    counts.append(multiprocessing.cpu_count())
+    return counts
+
+
+def _start_server(workers: int):
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), BIND=f"127.0.0.1:{PORT}")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{URL}/docs", timeout=1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("Server didn't start within 30 seconds.")
+
+
+async def _load(paths: list, seconds: float, concurrency: int):
+    done = 0
+    deadline = time.monotonic() + seconds
+
+    async def client(client_number: int):
+        nonlocal done
+        async with httpx.AsyncClient(base_url=URL, timeout=10) as http:
+            i = client_number
+            while time.monotonic() < deadline:
+                await http.get(paths[i % len(paths)])
+                done += 1
+                i += concurrency
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return done / seconds
+
+
+def run(seconds: float = 10, concurrency: int = 64):
+    paths = [f"/listings/{listing_id}" for listing_id in range(1, 101)]
+    baseline = None
+    for workers in _worker_counts():
+        server = _start_server(workers)
+        try:
+            throughput = asyncio.run(_load(paths, seconds, concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+
+        baseline = baseline or throughput
+        print(
+            f"{workers} worker(s): {throughput:.0f} req/s, "
+            f"{throughput / baseline:.2f}x of 1 worker "
+            f"({throughput / baseline / workers:.0%} scaling efficiency)"
+        )
+
+
+if __name__ == "__main__":
+    run(
+        float(sys.argv[1]) if len(sys.argv) > 1 else 10,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 64,
+    )
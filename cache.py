@@ -0,0 +1,168 @@
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from db_setup import connect
+
+logger = logging.getLogger(__name__)
+
+# Every worker process keeps its own caches. Writes in db.py send
+# "<cache name>:<key>" (or "<cache name>:*") on this channel with
+# pg_notify, and each process's listener thread drops the matching entries.
+CACHE_CHANNEL = "cache_invalidation"
+CACHE_TTL = float(os.getenv("CACHE_TTL", 30))
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", 10000))
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after 'ttl' seconds.
+    'generation' counts the invalidations, read it before loading a value
+    and pass it to set() so a value loaded while an invalidation came in
+    isn't cached.
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, max_items: int = CACHE_MAX_ITEMS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return MISSING
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return MISSING
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation: int = None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                # Invalidated while the value was loaded, it may be stale.
+                return
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+
+_caches = {}
+_handlers = {}
+
+
+def get_cache(name: str, ttl: float = CACHE_TTL):
+    """
+    Returns the named cache of this process, creating it on first use.
+    """
+    if name not in _caches:
+        _caches[name] = TTLCache(ttl)
+    return _caches[name]
+
+
+def on_message(name: str, handler):
+    """
+    Registers a function that is called with the key of every message sent
+    for 'name', for in-memory state that isn't a plain TTLCache.
+    """
+    _handlers.setdefault(name, []).append(handler)
+
+
+def notify(cursor, name: str, key="*"):
+    """
+    Queues an invalidation message in the cursor's transaction, delivered to
+    every process when it commits. This process handles it as soon as the
+    commit returns, without waiting for the listener, and not at all when
+    the transaction rolls back.
+    """
+    cursor.execute("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, f"{name}:{key}"))
+    cursor.connection.after_commit.append(lambda: _handle(name, str(key)))
+
+
+def _handle(name: str, key: str):
+    cache = _caches.get(name)
+    if cache is not None:
+        if key == "*":
+            cache.clear()
+        else:
+            cache.invalidate(int(key) if key.isdigit() else key)
+    for handler in _handlers.get(name, ()):
+        handler(key)
+
+
+def _clear_all():
+    for cache in _caches.values():
+        cache.clear()
+    for name, handlers in _handlers.items():
+        for handler in handlers:
+            handler("*")
+
+
+_stop = threading.Event()
+_thread = None
+
+
+def _listen():
+    while not _stop.is_set():
+        try:
+            conn = connect()
+        except psycopg2.Error:
+            logger.exception("Cache listener couldn't connect, retrying.")
+            _stop.wait(5)
+            continue
+
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CACHE_CHANNEL}")
+            # Messages sent while we weren't listening are lost, so start
+            # from empty caches.
+            _clear_all()
+            while not _stop.is_set():
+                if select.select([conn], [], [], 1) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    name, _, key = conn.notifies.pop(0).payload.partition(":")
+                    _handle(name, key)
+        except psycopg2.Error:
+            logger.exception("Cache listener lost its connection, reconnecting.")
+        finally:
+            conn.close()
+
+
+def start():
+    global _thread
+    if _thread is None:
+        _stop.clear()
+        _thread = threading.Thread(target=_listen, name="cache-listener", daemon=True)
+        _thread.start()
+
+
+def stop():
+    global _thread
+    if _thread is not None:
+        _stop.set()
+        _thread.join(5)
+        _thread = None
@@ -0,0 +1,46 @@
+import db
+from cache import MISSING
+
+# The category tree is small and read on every category page, so every
+# process keeps it in memory, in db.category_cache. db.add_category drops
+# it in every process and it's rebuilt on the next read.
+
+
+class CategoryTree:
+    """
+    Categories with their children, and the ids of every category's subtree.
+    """
+
+    def __init__(self, rows: list):
+        self.nodes = {
+            row["category_id"]: {**row, "children": []} for row in rows
+        }
+        self.roots = []
+        self.subtrees = {category_id: [] for category_id in self.nodes}
+        # Rows are ordered by path, so parents are added before children.
+        for row in rows:
+            node = self.nodes[row["category_id"]]
+            parent = self.nodes.get(row["parent_id"])
+            (parent["children"] if parent else self.roots).append(node)
+            for ancestor_id in row["path"] or (row["category_id"],):
+                if ancestor_id in self.subtrees:
+                    self.subtrees[ancestor_id].append(row["category_id"])
+
+    def subtree(self, category_id: int):
+        """
+        Returns the ids of a category and all its subcategories, or None if
+        the category doesn't exist.
+        """
+        return self.subtrees.get(category_id)
+
+
+def get_tree():
+    """
+    Returns the category tree, from memory after the first call.
+    """
+    tree = db.category_cache.get("tree")
+    if tree is MISSING:
+        generation = db.category_cache.generation
+        tree = CategoryTree(db.get_categories())
+        db.category_cache.set("tree", tree, generation)
+    return tree
@@ -1,98 +1,757 @@
+import os
+import uuid
+from decimal import Decimal
+
+import cache
+import geo
+from db_setup import PRIMARY, POOL_MIN_CONNECTIONS
 from db_setup import get_connection as con
-from psycopg2.extras import RealDictCursor
+from db_setup import get_read_connection as read_con
+from db_setup import mark_write
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor, execute_values
+
+# Columns that are safe to send to clients, password_hash and
+# social_security_number are never selected for responses.
+USER_COLUMNS = """
+    user_id, language_id, currency_id, profile_picture_id, city_id,
+    username, email, first_name, last_name, phone_number, address,
+    postal_code, seller_rating, total_reviews, translation_on,
+    vacation_mode, is_verified, created_at
+"""
+
+LISTING_COLUMNS = """
+    listing_id, seller_id, listing_type_id, status_id, product_name, title,
+    description, starting_price, view_count, pick_up_available, start_date,
+    end_date, current_price, bid_count
+"""
+
+# LISTING_COLUMNS for pages Postgres builds the JSON of, shown in the
+# viewer's currency. The prices are multiplied by the %(rate)s parameter and
+# rounded to cents by Postgres, and cast to text, since json_agg would write
+# numbers where the other routes send decimals as strings.
+CONVERTED_LISTING_COLUMNS = """
+    listing_id, seller_id, listing_type_id, status_id, product_name, title,
+    description, ROUND(starting_price * %(rate)s, 2)::text AS starting_price,
+    view_count, pick_up_available, start_date, end_date,
+    ROUND(current_price * %(rate)s, 2)::text AS current_price, bid_count,
+    %(currency_id)s AS currency_id
+"""
+
+BID_COLUMNS = """
+    bid_id, listing_id, user_id, bid_amount, bidded_at, is_auto, max_auto_bid
+"""
+
+ORDER_COLUMNS = """
+    order_id, seller_id, buyer_id, listing_id, shipping_option_id, payment_id,
+    order_status_id, shipping_cost, shipping_address, shipping_city,
+    shipping_postal_code, final_price, discount_amount, total_amount,
+    order_number, created_at, updated_at
+"""
+
+# USER_COLUMNS for GET /users, which Postgres builds the JSON of, with the
+# rating cast to text like the prices in CONVERTED_LISTING_COLUMNS.
+JSON_USER_COLUMNS = """
+    user_id, language_id, currency_id, profile_picture_id, city_id,
+    username, email, first_name, last_name, phone_number, address,
+    postal_code, seller_rating::text AS seller_rating, total_reviews,
+    translation_on, vacation_mode, is_verified, created_at
+"""
+
+REVIEW_COLUMNS = """
+    listing_id, reviewer_id, reviewee_id, is_negative, is_positive,
+    review_text, rating, created_at
+"""
+
+# Only columns in the order history indexes, so the query is index-only.
+ORDER_HISTORY_COLUMNS = """
+    order_id, seller_id, buyer_id, listing_id, order_status_id, order_number,
+    total_amount, created_at
+"""
+
+ORDER_HISTORY_ROLES = {"buyer": "buyer_id", "seller": "seller_id"}
+
+SELLER_DAILY_STATS_COLUMNS = """
+    day, views, bids, orders, revenue, reviews, positive_reviews,
+    negative_reviews,
+    CASE WHEN reviews > 0 THEN ROUND(rating_sum / reviews, 2) END AS average_rating,
+    CASE WHEN views > 0 THEN ROUND(orders::numeric / views, 4) END AS conversion_rate
+"""
+
+# Columns that partial_update is allowed to write for each table.
+USER_UPDATABLE_COLUMNS = (
+    "language_id",
+    "currency_id",
+    "profile_picture_id",
+    "city_id",
+    "username",
+    "email",
+    "first_name",
+    "last_name",
+    "phone_number",
+    "address",
+    "postal_code",
+    "translation_on",
+    "vacation_mode",
+)
+
+LISTING_UPDATABLE_COLUMNS = (
+    "listing_type_id",
+    "status_id",
+    "product_name",
+    "title",
+    "description",
+    "starting_price",
+    "pick_up_available",
+    "end_date",
+)
+
+ORDER_UPDATABLE_COLUMNS = (
+    "shipping_option_id",
+    "order_status_id",
+    "shipping_address",
+    "shipping_city",
+    "shipping_postal_code",
+    "final_price",
+    "discount_amount",
+)
+# Order columns that decide what the buyer pays, only the seller may change
+# them.
+ORDER_SELLER_COLUMNS = (
+    "shipping_option_id",
+    "order_status_id",
+    "final_price",
+    "discount_amount",
+)
+
+# Per-process caches of single rows, kept coherent across processes with
+# cache.notify in the write functions below.
+user_cache = cache.get_cache("user")
+listing_cache = cache.get_cache("listing")
+lookup_cache = cache.get_cache("lookups", ttl=3600)
+# Holds the category tree built by categories.py.
+category_cache = cache.get_cache("category", ttl=3600)
+
+# Small reference tables that are loaded at startup and served from memory.
+# Maps table -> (id column, name column).
+LOOKUP_TABLES = {
+    "languages": ("language_id", "language_name"),
+    "currencies": ("currency_id", "currency_name"),
+    "listing_types": ("listing_type_id", "type_name"),
+    "listing_status": ("status_id", "status_name"),
+    "order_status": ("status_id", "status_name"),
+    "payment_methods": ("method_id", "method_name"),
+    "item_conditions": ("condition_id", "condition_name"),
+    "categories": ("category_id", "category_name"),
+    "shipping_options": ("shipping_id", "shipping_name"),
+}
+
+# Max rows changed per transaction by the bulk status updates, so row locks
+# are only held for one batch at a time.
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 1000))
+
+# Comma separated order statuses, e.g. cancelled or refunded, whose orders
+# don't count towards the seller dashboard rollups.
+CANCELLED_ORDER_STATUS_IDS = {
+    int(status_id)
+    for status_id in os.getenv("CANCELLED_ORDER_STATUS_IDS", "").split(",")
+    if status_id
+}
+
+
+
+def log_change(entity: str, op: str, source: str, key_column: str):
+    """
+    Returns an INSERT of every row of the CTE 'source' into changelog, to be
+    used as another CTE so the entry commits together with the change.
+    """
+    return f"""
+        INSERT INTO changelog(entity, entity_id, op, data)
+        SELECT '{entity}', {key_column}, '{op}', to_jsonb({source}) FROM {source}
+        """
+
+
+def counted_order(alias: str):
+    """
+    Returns a condition that is true when the order row 'alias' counts
+    towards the seller dashboard rollups.
+    """
+    status_ids = ", ".join(str(status_id) for status_id in CANCELLED_ORDER_STATUS_IDS)
+    return (
+        f"({alias}.order_status_id IS NULL "
+        f"OR {alias}.order_status_id <> ALL(ARRAY[{status_ids}]::int[]))"
+    )
+
+
+def order_rollups(source: str):
+    """
+    Returns CTEs that add the 'orders' and 'revenue' of every row of the CTE
+    'source' (seller_id, listing_id, day, orders, revenue) to the seller
+    dashboard rollups, so they commit together with the change. Negative
+    values take orders back out.
+    """
+    return f"""
+        daily_rollup AS (
+            INSERT INTO seller_daily_stats(seller_id, day, orders, revenue)
+            SELECT seller_id, day, SUM(orders), SUM(revenue)
+            FROM {source}
+            WHERE seller_id IS NOT NULL
+            GROUP BY seller_id, day
+            HAVING SUM(orders) <> 0 OR SUM(revenue) <> 0
+            ORDER BY seller_id, day
+            ON CONFLICT (seller_id, day)
+            DO UPDATE SET
+                orders = seller_daily_stats.orders + EXCLUDED.orders,
+                revenue = seller_daily_stats.revenue + EXCLUDED.revenue
+        ),
+        listing_rollup AS (
+            INSERT INTO listing_stats(listing_id, seller_id, orders)
+            SELECT listing_id, MIN(seller_id), SUM(orders)
+            FROM {source}
+            GROUP BY listing_id
+            HAVING SUM(orders) <> 0
+            ORDER BY listing_id
+            ON CONFLICT (listing_id)
+            DO UPDATE SET orders = listing_stats.orders + EXCLUDED.orders
+        )
+        """
+
 
+# Hot statements that are PREPAREd once per pooled connection and then
+# executed by name, so Postgres can reuse the plan instead of re-planning.
+# Maps name -> (parameter types, query).
+PREPARED_STATEMENTS = {
+    "get_user_by_id": (
+        "int",
+        f"""
+        SELECT {USER_COLUMNS} FROM users
+        WHERE user_id = $1 AND deleted_at IS NULL
+        """,
+    ),
+    "get_listing_by_id": (
+        "int",
+        f"""
+        SELECT {LISTING_COLUMNS} FROM listings
+        WHERE listing_id = $1 AND deleted_at IS NULL
+        """,
+    ),
+    "create_bid": (
+        "int, int, numeric, boolean, numeric",
+        f"""
+        WITH listing AS (
+            SELECT seller_id FROM listings
+            WHERE listing_id = $1 AND deleted_at IS NULL
+        ),
+        new_bid AS (
+            INSERT INTO bids(listing_id, user_id, bid_amount, is_auto, max_auto_bid)
+            SELECT $1, $2, $3, $4, $5 FROM listing
+            RETURNING {BID_COLUMNS}
+        ),
+        logged AS ({log_change("bid", "insert", "new_bid", "bid_id")}),
+        queued AS (
+            INSERT INTO notification_events(kind, listing_id, actor_id)
+            SELECT 'bid', listing_id, user_id FROM new_bid
+        ),
+        bumped_daily AS (
+            INSERT INTO seller_daily_stats(seller_id, day, bids)
+            SELECT seller_id, CURRENT_DATE, 1 FROM listing
+            ON CONFLICT (seller_id, day)
+            DO UPDATE SET bids = seller_daily_stats.bids + 1
+        ),
+        bumped_listing AS (
+            INSERT INTO listing_stats(listing_id, seller_id, bids, highest_bid)
+            SELECT $1, seller_id, 1, $3 FROM listing
+            ON CONFLICT (listing_id)
+            DO UPDATE SET
+                bids = listing_stats.bids + 1,
+                highest_bid = GREATEST(listing_stats.highest_bid, EXCLUDED.highest_bid)
+        )
+        SELECT * FROM new_bid
+        """,
+    ),
+}
 
-def get_all_listings():
+
+def execute_prepared(cursor, name: str, params: tuple):
+    """
+    Executes a statement from PREPARED_STATEMENTS by name, preparing it on
+    the cursor's connection the first time that connection uses it.
+    """
+    conn = cursor.connection
+    if name not in conn.prepared:
+        types, query = PREPARED_STATEMENTS[name]
+        cursor.execute(f"PREPARE {name}({types}) AS {query}")
+        conn.prepared.add(name)
+
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name}({placeholders})", params)
+
+
+def warm_up():
+    """
+    Opens the primary's minimum number of pooled connections and prepares
+    the hot statements on each, so the first requests don't pay for it.
+    """
+    pool = PRIMARY.get_pool()
+    conns = [pool.getconn() for _ in range(POOL_MIN_CONNECTIONS)]
+    try:
+        for conn in conns:
+            with conn:
+                with conn.cursor() as cursor:
+                    for name, (types, query) in PREPARED_STATEMENTS.items():
+                        if name not in conn.prepared:
+                            cursor.execute(f"PREPARE {name}({types}) AS {query}")
+                            conn.prepared.add(name)
+    finally:
+        for conn in conns:
+            pool.putconn(conn, close=bool(conn.closed))
+
+
+def get_lookups():
+    """
+    Fetches all lookup tables as {table: [{id, name}, ...]}, from memory
+    after the first call.
+    """
+    lookups = lookup_cache.get("all")
+    if lookups is not cache.MISSING:
+        return lookups
+
+    query = " UNION ALL ".join(
+        f"SELECT '{table}' AS lookup, {id_column} AS id, {name_column} AS name "
+        f"FROM {table}"
+        for table, (id_column, name_column) in LOOKUP_TABLES.items()
+    )
+    with read_con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"{query} ORDER BY lookup, id")
+            rows = cursor.fetchall()
+
+    lookups = {table: [] for table in LOOKUP_TABLES}
+    for table, lookup_id, name in rows:
+        lookups[table].append({"id": lookup_id, "name": name})
+    lookup_cache.set("all", lookups)
+    return lookups
+
+
+def get_categories():
     """
-    Fetches all active listings in database.
+    Fetches all categories with their parent and path, the ids from the
+    root down to the category itself. Parents come before their children.
+    Read from the primary, the result is cached for an hour.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            get_all_listings_query = """
-                SELECT *
-                FROM listings 
-                WHERE status_id = 1
-                ORDER BY start_date DESC;
+            cursor.execute(
                 """
-            cursor.execute(get_all_listings_query)
-
+                    SELECT category_id, category_name, parent_id, path
+                    FROM categories
+                    ORDER BY path
+                    """
+            )
             return cursor.fetchall()
 
 
-def get_all_users():
+def partial_update(
+    table: str,
+    key_column: str,
+    key_value: int,
+    changes: dict,
+    allowed_columns: tuple,
+    returning: str,
+    touch_updated_at: bool = False,
+    cache_name: str = None,
+    owner_columns: tuple = (),
+    owner_id: int = None,
+    skip_deleted: bool = False,
+    changelog_entity: str = None,
+):
     """
-    Fetches all users in database.
+    Updates only the columns in 'changes' for one row and returns it.
+    Column names are checked against 'allowed_columns' before they reach the
+    query. Rows whose values would not change are not rewritten, which keeps
+    table and index churn down and lets Postgres use HOT updates.
+    The row is dropped from the 'cache_name' cache in every process.
+    With an 'owner_id' only a row where it is in one of 'owner_columns' is
+    updated or returned, so ownership is checked without another query.
+    With 'skip_deleted' soft deleted rows are treated as missing.
+    With a 'changelog_entity' the updated row is written to changelog.
     """
+    unknown_columns = set(changes) - set(allowed_columns)
+    if unknown_columns:
+        raise ValueError(
+            f"Cannot update column(s): {', '.join(sorted(unknown_columns))}"
+        )
+
+    owner_condition = sql.SQL("")
+    key_params = [key_value]
+    if owner_id is not None:
+        owner_condition = sql.SQL(" AND %s IN ({})").format(
+            sql.SQL(", ").join(sql.Identifier(column) for column in owner_columns)
+        )
+        key_params.append(owner_id)
+    if skip_deleted:
+        owner_condition += sql.SQL(" AND deleted_at IS NULL")
+
+    select_query = sql.SQL(
+        "SELECT {returning} FROM {table} WHERE {key} = %s{owner_condition}"
+    ).format(
+        returning=sql.SQL(returning),
+        table=sql.Identifier(table),
+        key=sql.Identifier(key_column),
+        owner_condition=owner_condition,
+    )
+
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
+            if not changes:
+                cursor.execute(select_query, key_params)
+                return cursor.fetchone()
+
+            columns = [sql.Identifier(column) for column in changes]
+            assignments = [
+                sql.SQL("{} = %s").format(column) for column in columns
+            ]
+            if touch_updated_at:
+                assignments.append(sql.SQL("updated_at = CURRENT_TIMESTAMP"))
+
+            update_query = sql.SQL(
                 """
-                    SELECT * 
-                    FROM users
-                    ORDER BY created_at DESC;
+                    UPDATE {table}
+                    SET {assignments}
+                    WHERE {key} = %s{owner_condition}
+                    AND ({columns}) IS DISTINCT FROM ({values})
+                    RETURNING {returning}
                     """
+            ).format(
+                table=sql.Identifier(table),
+                assignments=sql.SQL(", ").join(assignments),
+                key=sql.Identifier(key_column),
+                owner_condition=owner_condition,
+                columns=sql.SQL(", ").join(columns),
+                values=sql.SQL(", ").join(sql.Placeholder() * len(columns)),
+                returning=sql.SQL(returning),
             )
+            if changelog_entity is not None:
+                update_query = sql.SQL(
+                    "WITH updated AS ({update}), logged AS ({log}) "
+                    "SELECT * FROM updated"
+                ).format(
+                    update=update_query,
+                    log=sql.SQL(
+                        log_change(changelog_entity, "update", "updated", key_column)
+                    ),
+                )
+            values = list(changes.values())
+            cursor.execute(update_query, values + key_params + values)
+            updated_row = cursor.fetchone()
+            if updated_row is not None and cache_name is not None:
+                cache.notify(cursor, cache_name, key_value)
+            conn.commit()
 
-            return cursor.fetchall()
+            if updated_row is None:
+                # Either nothing changed or the row does not exist.
+                cursor.execute(select_query, key_params)
+                return cursor.fetchone()
+
+            return updated_row
+
+
+def get_all_listings(currency_id: int = None, rate: Decimal = 1):
+    """
+    Fetches all active listings in database, with prices multiplied by the
+    'rate' of 'currency_id'.
+    Postgres builds the JSON array itself, so the result is returned as a
+    ready-to-send string instead of a list of rows.
+    """
+    with read_con() as conn:
+        with conn.cursor() as cursor:
+            get_all_listings_query = f"""
+                SELECT COALESCE(json_agg(l ORDER BY l.start_date DESC), '[]')::text
+                FROM (
+                    SELECT {CONVERTED_LISTING_COLUMNS}
+                    FROM listings
+                    WHERE status_id = 1 AND deleted_at IS NULL
+                ) l;
+                """
+            cursor.execute(
+                get_all_listings_query, {"currency_id": currency_id, "rate": rate}
+            )
+
+            return cursor.fetchone()[0]
+
+
+def get_all_users():
+    """
+    Fetches all users in database, without sensitive columns.
+    Returned as a JSON array string built by Postgres.
+    """
+    with read_con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                    SELECT COALESCE(json_agg(u ORDER BY u.created_at DESC), '[]')::text
+                    FROM (
+                        SELECT {JSON_USER_COLUMNS}
+                        FROM users
+                        WHERE deleted_at IS NULL
+                    ) u;
+                    """
+            )
+
+            return cursor.fetchone()[0]
+
+
+def get_most_viewed_listings(
+    limit: int, currency_id: int = None, rate: Decimal = 1
+):
+    """
+    Fetches the most viewed active listings as a JSON array string, with
+    prices multiplied by the 'rate' of 'currency_id'.
+    """
+    with read_con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                    SELECT COALESCE(json_agg(l ORDER BY l.view_count DESC), '[]')::text
+                    FROM (
+                        SELECT {CONVERTED_LISTING_COLUMNS}
+                        FROM listings
+                        WHERE status_id = 1 AND deleted_at IS NULL
+                        ORDER BY view_count DESC
+                        LIMIT %(limit)s
+                    ) l;
+                    """,
+                {"limit": limit, "currency_id": currency_id, "rate": rate},
+            )
+            return cursor.fetchone()[0]
 
 
 def get_user_by_id(user_id: int):
     """
     Fetches a user by user_id.
     """
+    user = user_cache.get(user_id)
+    if user is not cache.MISSING:
+        return user
+
+    # Misses read from the primary, a lagging replica could put a row back
+    # into the cache that was just invalidated.
+    generation = user_cache.generation
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                """
-                SELECT * 
-                FROM users
-                WHERE user_id = %s
-                """,
-                (user_id,),
-            )
+            execute_prepared(cursor, "get_user_by_id", (user_id,))
+            user = cursor.fetchone()
 
-        return cursor.fetchone()
+    if user is not None:
+        user_cache.set(user_id, user, generation)
+    return user
 
 
 def get_listing_by_id(listing_id: int):
     """
     Fetches a listing by listing_id.
     """
+    listing = listing_cache.get(listing_id)
+    if listing is not cache.MISSING:
+        return listing
+
+    # Read from the primary like get_user_by_id.
+    generation = listing_cache.generation
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_listing_by_id", (listing_id,))
+            listing = cursor.fetchone()
+
+    if listing is not None:
+        listing_cache.set(listing_id, listing, generation)
+    return listing
+
+
+def get_all_user_listings(
+    seller_id: int, currency_id: int = None, rate: Decimal = 1
+):
+    """
+    Fetches all listings from one user, with prices multiplied by the
+    'rate' of 'currency_id'.
+    Returned as a JSON array string built by Postgres.
+    """
+    with read_con() as conn:
+        with conn.cursor() as cursor:
             cursor.execute(
-                """
-                    SELECT * 
-                    FROM listings
-                    WHERE listing_id = %s
+                f"""
+                    SELECT COALESCE(json_agg(l ORDER BY l.start_date DESC), '[]')::text
+                    FROM (
+                        SELECT {CONVERTED_LISTING_COLUMNS}
+                        FROM listings
+                        WHERE seller_id = %(seller_id)s AND deleted_at IS NULL
+                    ) l;
                     """,
-                (listing_id,),
+                {"seller_id": seller_id, "currency_id": currency_id, "rate": rate},
             )
+            return cursor.fetchone()[0]
 
-            return cursor.fetchone()
+
+def get_category_listings(
+    category_ids: list, before_listing_id: int = None, limit: int = 20
+):
+    """
+    Fetches a page of active listings in any of 'category_ids', newest
+    first. Pass the listing_id of the last row of a page to get the next one.
+    """
+    condition = ""
+    if before_listing_id is not None:
+        condition = "AND listing_id < %(before_listing_id)s"
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"""
+                    SELECT {LISTING_COLUMNS}
+                    FROM listings
+                    WHERE listing_id IN (
+                        SELECT listing_id
+                        FROM listing_categories
+                        WHERE category_id = ANY(%(category_ids)s)
+                        {condition}
+                    )
+                    AND status_id = 1 AND deleted_at IS NULL
+                    ORDER BY listing_id DESC
+                    LIMIT %(limit)s
+                    """,
+                {
+                    "category_ids": category_ids,
+                    "before_listing_id": before_listing_id,
+                    "limit": limit,
+                },
+            )
+            return cursor.fetchall()
 
 
-def get_all_user_listings(seller_id: int):
+def get_nearby_listings(
+    latitude: float,
+    longitude: float,
+    radius_km: float,
+    after_distance_km=None,
+    after_listing_id: int = None,
+    limit: int = 20,
+):
     """
-    Fetches all listings from one user.
+    Fetches a page of active pick-up listings within 'radius_km' of a
+    coordinate, nearest first. Pass the distance_km and listing_id of the
+    last row of a page to get the next one.
+    Sellers are located at their postal code, or at their city when the
+    postal code has no coordinates. Only the grid cells covering the radius
+    are looked at.
     """
-    with con() as conn:
+    condition = ""
+    if after_distance_km is not None:
+        condition = (
+            "AND (distance_km, listing_id) > "
+            "(%(after_distance_km)s, %(after_listing_id)s)"
+        )
+    with read_con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
-                """
+                f"""
+                    WITH sellers AS (
+                        SELECT u.user_id, p.latitude, p.longitude
+                        FROM postal_codes p
+                        JOIN users u
+                        ON u.postal_code = p.postal_code AND u.deleted_at IS NULL
+                        WHERE p.geo_cell = ANY(%(cells)s)
+                        UNION ALL
+                        SELECT u.user_id, c.latitude, c.longitude
+                        FROM cities c
+                        JOIN users u
+                        ON u.city_id = c.city_id AND u.deleted_at IS NULL
+                        WHERE c.geo_cell = ANY(%(cells)s)
+                        AND NOT EXISTS (
+                            SELECT 1 FROM postal_codes p
+                            WHERE p.postal_code = u.postal_code
+                        )
+                    ),
+                    nearby AS (
+                        SELECT {LISTING_COLUMNS}, round((
+                            2 * %(earth_radius_km)s * asin(least(1, sqrt(
+                                power(sin(radians(s.latitude - %(latitude)s) / 2), 2)
+                                + cos(radians(%(latitude)s))
+                                * cos(radians(s.latitude))
+                                * power(sin(radians(s.longitude - %(longitude)s) / 2), 2)
+                            )))
+                        )::numeric, 3) AS distance_km
+                        FROM sellers s
+                        JOIN listings l
+                        ON l.seller_id = s.user_id
+                        AND l.pick_up_available AND l.status_id = 1
+                        AND l.deleted_at IS NULL
+                    )
                     SELECT *
-                    FROM listings
-                    WHERE seller_id = %s
+                    FROM nearby
+                    WHERE distance_km <= %(radius_km)s
+                    {condition}
+                    ORDER BY distance_km, listing_id
+                    LIMIT %(limit)s
                     """,
-                (seller_id,),
+                {
+                    "cells": geo.cells_within(latitude, longitude, radius_km),
+                    "earth_radius_km": geo.EARTH_RADIUS_KM,
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "radius_km": radius_km,
+                    "after_distance_km": after_distance_km,
+                    "after_listing_id": after_listing_id,
+                    "limit": limit,
+                },
             )
             return cursor.fetchall()
 
 
+def get_user_orders(
+    user_id: int,
+    role: str,
+    status_id: int = None,
+    before_created_at=None,
+    before_order_id: int = None,
+    limit: int = 20,
+):
+    """
+    Fetches a page of a user's orders as buyer or seller, newest first.
+    Pass the created_at and order_id of the last row of a page to get the
+    next one.
+    """
+    role_column = sql.Identifier(ORDER_HISTORY_ROLES[role])
+    conditions = [sql.SQL("{} = %s").format(role_column)]
+    params = [user_id]
+    if status_id is not None:
+        conditions.append(sql.SQL("order_status_id = %s"))
+        params.append(status_id)
+    if before_created_at is not None:
+        conditions.append(sql.SQL("(created_at, order_id) < (%s, %s)"))
+        params.extend([before_created_at, before_order_id])
+    params.append(limit)
+
+    query = sql.SQL(
+        """
+            SELECT {columns}
+            FROM orders
+            WHERE {conditions}
+            ORDER BY created_at DESC, order_id DESC
+            LIMIT %s
+            """
+    ).format(
+        columns=sql.SQL(ORDER_HISTORY_COLUMNS),
+        conditions=sql.SQL(" AND ").join(conditions),
+    )
+
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+
 def register_user(
     username: str,
     email: str,
-    password: str,
+    password_hash: str,
     social_security_number: str,
     first_name: str,
     last_name: str,
@@ -107,7 +766,7 @@ def register_user(
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
-                """
+                f"""
                     INSERT INTO users(
                     username,
                     email,
@@ -121,19 +780,19 @@ def register_user(
                     phone_number
                     )
                     VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING user_id, username, email, first_name, last_name, city_id, address, postal_code, phone_number, created_at
+                    RETURNING {USER_COLUMNS}
                     """,
                 (
                     username,
                     email,
-                    password,
+                    password_hash,
                     social_security_number,
                     first_name,
                     last_name,
                     city_id,
                     address,
                     postal_code,
-                    phone_number
+                    phone_number,
                 ),
             )
             new_user = cursor.fetchone()
@@ -141,19 +800,25 @@ def register_user(
             return new_user
 
 
-def add_city(city_name: str):
+def add_city(city_name: str, latitude: float = None, longitude: float = None):
     """
-    Creates a new city in database.
+    Creates a new city in database, optionally with its coordinates.
     """
+    located = latitude is not None and longitude is not None
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 """
-                    INSERT INTO cities(city_name)
-                    VALUES(%s)
-                    RETURNING city_name
+                    INSERT INTO cities(city_name, latitude, longitude, geo_cell)
+                    VALUES(%s, %s, %s, %s)
+                    RETURNING city_id, city_name, latitude, longitude
                     """,
-                (city_name,),
+                (
+                    city_name,
+                    latitude,
+                    longitude,
+                    geo.geo_cell(latitude, longitude) if located else None,
+                ),
             )
             new_city = cursor.fetchone()
             conn.commit()
@@ -161,6 +826,109 @@ def add_city(city_name: str):
             return new_city
 
 
+def set_city_location(city_id: int, latitude: float, longitude: float):
+    """
+    Sets the coordinates of a city. Returns None if it doesn't exist.
+    """
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    UPDATE cities
+                    SET latitude = %s, longitude = %s, geo_cell = %s
+                    WHERE city_id = %s
+                    RETURNING city_id, city_name, latitude, longitude
+                    """,
+                (latitude, longitude, geo.geo_cell(latitude, longitude), city_id),
+            )
+            city = cursor.fetchone()
+            conn.commit()
+            return city
+
+
+def set_postal_code(postal_code: str, city_id: int, latitude: float, longitude: float):
+    """
+    Creates or replaces the coordinates of a postal code.
+    """
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    INSERT INTO postal_codes(
+                        postal_code, city_id, latitude, longitude, geo_cell
+                    )
+                    VALUES(%s, %s, %s, %s, %s)
+                    ON CONFLICT (postal_code) DO UPDATE SET
+                        city_id = EXCLUDED.city_id,
+                        latitude = EXCLUDED.latitude,
+                        longitude = EXCLUDED.longitude,
+                        geo_cell = EXCLUDED.geo_cell
+                    RETURNING postal_code, city_id, latitude, longitude
+                    """,
+                (
+                    postal_code,
+                    city_id,
+                    latitude,
+                    longitude,
+                    geo.geo_cell(latitude, longitude),
+                ),
+            )
+            location = cursor.fetchone()
+            conn.commit()
+            return location
+
+
+def get_postal_code(postal_code: str):
+    """
+    Fetches the coordinates of a postal code, or None if they're unknown.
+    """
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    SELECT postal_code, city_id, latitude, longitude
+                    FROM postal_codes
+                    WHERE postal_code = %s
+                    """,
+                (postal_code,),
+            )
+            return cursor.fetchone()
+
+
+def add_category(category_name: str, parent_id: int = None):
+    """
+    Creates a category, at the root or below 'parent_id'. Its path is the
+    parent's path followed by its own id.
+    """
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    WITH new_id AS (
+                        SELECT nextval(
+                            pg_get_serial_sequence('categories', 'category_id')
+                        )::smallint AS category_id
+                    )
+                    INSERT INTO categories(category_id, category_name, parent_id, path)
+                    SELECT
+                        new_id.category_id,
+                        %(category_name)s,
+                        %(parent_id)s,
+                        COALESCE(parent.path, '{}') || new_id.category_id
+                    FROM new_id
+                    LEFT JOIN categories parent
+                    ON parent.category_id = %(parent_id)s
+                    RETURNING category_id, category_name, parent_id, path
+                    """,
+                {"category_name": category_name, "parent_id": parent_id},
+            )
+            new_category = cursor.fetchone()
+            cache.notify(cursor, "category")
+            cache.notify(cursor, "lookups")
+            conn.commit()
+            return new_category
+
+
 def create_listing(
     seller_id: int,
     listing_type_id: int,
@@ -177,8 +945,9 @@ def create_listing(
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
-                """
-                    INSERT INTO listings(
+                f"""
+                    WITH new_listing AS (
+                        INSERT INTO listings(
                             seller_id,
                             listing_type_id,
                             product_name,
@@ -189,7 +958,12 @@ def create_listing(
                             end_date   
                             )
                             VALUES(%s, %s, %s, %s, %s, %s, %s, %s)
-                            RETURNING *
+                            RETURNING {LISTING_COLUMNS}
+                    ),
+                    logged AS (
+                        {log_change("listing", "insert", "new_listing", "listing_id")}
+                    )
+                    SELECT * FROM new_listing
                     """,
                 (
                     seller_id,
@@ -204,6 +978,7 @@ def create_listing(
             )
             new_listing = cursor.fetchone()
             conn.commit()
+            mark_write(seller_id)
             return new_listing
 
 
@@ -219,23 +994,300 @@ def create_bid(
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(
+                cursor,
+                "create_bid",
+                (listing_id, user_id, bid_amount, is_auto, max_auto_bid),
+            )
+            new_bid = cursor.fetchone()
+            if new_bid is None:
+                # The listing doesn't exist or was deleted.
+                return None
+            # Every process's order book (order_book.py) picks the bid up.
+            cache.notify(
+                cursor,
+                "bid",
+                f"{listing_id}:{new_bid['bid_id']}:{user_id}:{bid_amount}:"
+                f"{new_bid['bidded_at'].isoformat()}",
+            )
+            conn.commit()
+            mark_write(user_id)
+            return new_bid
+
+
+def get_order_books(
+    listing_ids: list = None, ending_within: float = None, recent_bids: int = 20
+):
+    """
+    Fetches what an in-memory order book needs from 'bids' for the given
+    listings, or for active listings ending within 'ending_within' seconds:
+    bid count, highest bid and its bidder, and the most recent bids.
+    """
+    if listing_ids is not None:
+        condition = sql.SQL("l.listing_id = ANY(%s) AND l.deleted_at IS NULL")
+        params = [recent_bids, listing_ids]
+    else:
+        condition = sql.SQL(
+            """
+            l.status_id = 1
+            AND l.deleted_at IS NULL
+            AND l.end_date > CURRENT_TIMESTAMP
+            AND l.end_date <= CURRENT_TIMESTAMP + make_interval(secs => %s)
+            """
+        )
+        params = [recent_bids, ending_within]
+
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                sql.SQL(
+                    """
+                    SELECT
+                        l.listing_id,
+                        l.starting_price,
+                        (SELECT count(*) FROM bids b
+                         WHERE b.listing_id = l.listing_id) AS bid_count,
+                        leader.bid_amount AS highest_bid,
+                        leader.user_id AS leader_id,
+                        COALESCE(recent.bids, '[]') AS recent_bids
+                    FROM listings l
+                    LEFT JOIN LATERAL (
+                        SELECT bid_amount, user_id
+                        FROM bids b
+                        WHERE b.listing_id = l.listing_id
+                        ORDER BY bid_amount DESC, bid_id
+                        LIMIT 1
+                    ) leader ON TRUE
+                    LEFT JOIN LATERAL (
+                        SELECT json_agg(r ORDER BY r.bid_id) AS bids
+                        FROM (
+                            SELECT bid_id, user_id, bid_amount::text, bidded_at
+                            FROM bids b
+                            WHERE b.listing_id = l.listing_id
+                            ORDER BY bid_id DESC
+                            LIMIT %s
+                        ) r
+                    ) recent ON TRUE
+                    WHERE {condition}
+                    """
+                ).format(condition=condition),
+                params,
+            )
+            return cursor.fetchall()
+
+
+def save_order_books(books: list):
+    """
+    Writes current_price, bid_count and leader_id of listings from
+    (listing_id, current_price, bid_count, leader_id) tuples. Every process
+    writes its own books, a row is only changed by a book that has seen
+    more bids than the row, so a process that is behind can't undo another.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                """
+                    UPDATE listings
+                    SET
+                    current_price = v.current_price,
+                    bid_count = v.bid_count,
+                    leader_id = v.leader_id
+                    FROM (VALUES %s) AS v(listing_id, current_price, bid_count, leader_id)
+                    WHERE listings.listing_id = v.listing_id
+                    AND listings.bid_count < v.bid_count
+                    """,
+                books,
+                template="(%s::int, %s::numeric, %s::int, %s::int)",
+                page_size=BULK_BATCH_SIZE,
+            )
+            conn.commit()
+
+
+def create_order(
+    buyer_id: int,
+    listing_id: int,
+    shipping_option_id: int,
+    shipping_address: str,
+    shipping_postal_code: str,
+    idempotency_key: str,
+    payment_id: int = None,
+    shipping_city: str = None,
+    discount_amount: float = 0,
+):
+    """
+    Creates a new order for a listing whose auction 'buyer_id' won.
+    The price is the highest bid and the shipping cost comes from
+    shipping_options, both looked up in the same statement as the insert.
+    Retrying with the same idempotency_key returns the already created
+    order. The seller's dashboard rollups are bumped in the same statement.
+    Raises ValueError when the auction hasn't ended, was won by someone
+    else or the listing is already ordered, or when the idempotency_key
+    was used for a different order.
+    """
+    order = {
+        "listing_id": listing_id,
+        "shipping_option_id": shipping_option_id,
+        "payment_id": payment_id,
+        "shipping_address": shipping_address,
+        "shipping_city": shipping_city,
+        "shipping_postal_code": shipping_postal_code,
+        "discount_amount": discount_amount,
+    }
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Orders for a listing are created one at a time, and each of
+            # the statements below sees the ones committed before.
             cursor.execute(
                 """
-                    INSERT INTO bids(
+                    SELECT listing_id FROM listings
+                    WHERE listing_id = %s AND deleted_at IS NULL
+                    FOR UPDATE
+                    """,
+                (listing_id,),
+            )
+            if cursor.fetchone() is None:
+                return None
+
+            cursor.execute(
+                f"""
+                    SELECT {ORDER_COLUMNS}
+                    FROM orders
+                    WHERE buyer_id = %s AND idempotency_key = %s
+                    """,
+                (buyer_id, idempotency_key),
+            )
+            existing_order = cursor.fetchone()
+            if existing_order is not None:
+                conn.commit()
+                if any(
+                    existing_order[column] != value for column, value in order.items()
+                ):
+                    raise ValueError("Idempotency-Key was used for another order.")
+                return existing_order
+
+            cursor.execute(
+                f"""
+                    SELECT
+                        l.end_date <= CURRENT_TIMESTAMP AS ended,
+                        (
+                            SELECT user_id
+                            FROM bids
+                            WHERE listing_id = l.listing_id
+                            ORDER BY bid_amount DESC, bidded_at
+                            LIMIT 1
+                        ) AS winner_id,
+                        EXISTS (
+                            SELECT 1 FROM orders o
+                            WHERE o.listing_id = l.listing_id
+                            AND {counted_order("o")}
+                        ) AS ordered
+                    FROM listings l
+                    WHERE l.listing_id = %s
+                    """,
+                (listing_id,),
+            )
+            auction = cursor.fetchone()
+            if not auction["ended"]:
+                raise ValueError("The auction hasn't ended yet.")
+            if auction["winner_id"] != buyer_id:
+                raise ValueError("Only the winner of the auction can order it.")
+            if auction["ordered"]:
+                raise ValueError("The listing has already been ordered.")
+
+            cursor.execute(
+                f"""
+                    WITH listing AS (
+                        SELECT listing_id, seller_id, starting_price
+                        FROM listings
+                        WHERE listing_id = %(listing_id)s AND deleted_at IS NULL
+                    ),
+                    shipping AS (
+                        SELECT COALESCE(shipping_cost, 0) AS shipping_cost
+                        FROM shipping_options
+                        WHERE shipping_id = %(shipping_option_id)s
+                    ),
+                    price AS (
+                        SELECT COALESCE(
+                            (
+                                SELECT bid_amount
+                                FROM bids
+                                WHERE listing_id = %(listing_id)s
+                                ORDER BY bid_amount DESC
+                                LIMIT 1
+                            ),
+                            listing.starting_price
+                        ) AS final_price
+                        FROM listing
+                    ),
+                    new_order AS (
+                    INSERT INTO orders(
+                        seller_id,
+                        buyer_id,
                         listing_id,
-                        user_id,
-                        bid_amount,
-                        is_auto,
-                        max_auto_bid
+                        shipping_option_id,
+                        payment_id,
+                        order_status_id,
+                        shipping_cost,
+                        shipping_address,
+                        shipping_city,
+                        shipping_postal_code,
+                        final_price,
+                        discount_amount,
+                        total_amount,
+                        order_number,
+                        idempotency_key
                         )
-                        VALUES(%s, %s, %s, %s, %s)
-                        RETURNING *
+                        SELECT
+                            listing.seller_id,
+                            %(buyer_id)s,
+                            listing.listing_id,
+                            %(shipping_option_id)s,
+                            %(payment_id)s,
+                            1,
+                            shipping.shipping_cost,
+                            %(shipping_address)s,
+                            %(shipping_city)s,
+                            %(shipping_postal_code)s,
+                            price.final_price,
+                            %(discount_amount)s,
+                            GREATEST(price.final_price - %(discount_amount)s, 0)
+                                + shipping.shipping_cost,
+                            %(order_number)s,
+                            %(idempotency_key)s
+                        FROM listing, shipping, price
+                        RETURNING {ORDER_COLUMNS}
+                    ),
+                    logged AS (
+                        {log_change("order", "insert", "new_order", "order_id")}
+                    ),
+                    order_delta AS (
+                        SELECT seller_id, listing_id, created_at::date AS day,
+                            1 AS orders, total_amount AS revenue
+                        FROM new_order o
+                        WHERE {counted_order("o")}
+                    ),
+                    {order_rollups("order_delta")}
+                    SELECT * FROM new_order
                     """,
-                (listing_id, user_id, bid_amount, is_auto, max_auto_bid),
+                {
+                    "buyer_id": buyer_id,
+                    "listing_id": listing_id,
+                    "shipping_option_id": shipping_option_id,
+                    "payment_id": payment_id,
+                    "shipping_address": shipping_address,
+                    "shipping_city": shipping_city,
+                    "shipping_postal_code": shipping_postal_code,
+                    "discount_amount": discount_amount,
+                    "order_number": f"ORD-{uuid.uuid4().hex[:16].upper()}",
+                    "idempotency_key": idempotency_key,
+                },
             )
-            new_bid = cursor.fetchone()
+            # None when the shipping option does not exist.
+            new_order = cursor.fetchone()
             conn.commit()
-            return new_bid
+            mark_write(buyer_id)
+            return new_order
 
 
 def create_review(
@@ -253,7 +1305,8 @@ def create_review(
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
-                """
+                f"""
+                    WITH new_review AS (
                     INSERT INTO reviews(
                         listing_id,
                         reviewer_id,
@@ -264,10 +1317,88 @@ def create_review(
                         rating
                         )
                         VALUES(%s, %s, %s, %s, %s, %s, %s)
-                        RETURNING *
-                    """,
-                (
-                    listing_id,
+                        RETURNING {REVIEW_COLUMNS}
+                    ),
+                    bumped_daily AS (
+                        INSERT INTO seller_daily_stats(
+                            seller_id,
+                            day,
+                            reviews,
+                            rating_sum,
+                            positive_reviews,
+                            negative_reviews
+                            )
+                            SELECT
+                                reviewee_id,
+                                CURRENT_DATE,
+                                1,
+                                rating,
+                                is_positive::int,
+                                is_negative::int
+                            FROM new_review
+                        ON CONFLICT (seller_id, day)
+                        DO UPDATE SET
+                            reviews = seller_daily_stats.reviews + 1,
+                            rating_sum = seller_daily_stats.rating_sum + EXCLUDED.rating_sum,
+                            positive_reviews = seller_daily_stats.positive_reviews
+                                + EXCLUDED.positive_reviews,
+                            negative_reviews = seller_daily_stats.negative_reviews
+                                + EXCLUDED.negative_reviews
+                    ),
+                    bumped_histogram AS (
+                        INSERT INTO rating_histograms(
+                            user_id,
+                            stars_1,
+                            stars_2,
+                            stars_3,
+                            stars_4,
+                            stars_5,
+                            positive_reviews,
+                            negative_reviews
+                            )
+                            SELECT
+                                reviewee_id,
+                                (star = 1)::int,
+                                (star = 2)::int,
+                                (star = 3)::int,
+                                (star = 4)::int,
+                                (star = 5)::int,
+                                is_positive::int,
+                                is_negative::int
+                            FROM new_review,
+                            LATERAL (
+                                SELECT LEAST(GREATEST(ROUND(rating), 1), 5) AS star
+                            ) stars
+                        ON CONFLICT (user_id)
+                        DO UPDATE SET
+                            stars_1 = rating_histograms.stars_1 + EXCLUDED.stars_1,
+                            stars_2 = rating_histograms.stars_2 + EXCLUDED.stars_2,
+                            stars_3 = rating_histograms.stars_3 + EXCLUDED.stars_3,
+                            stars_4 = rating_histograms.stars_4 + EXCLUDED.stars_4,
+                            stars_5 = rating_histograms.stars_5 + EXCLUDED.stars_5,
+                            positive_reviews = rating_histograms.positive_reviews
+                                + EXCLUDED.positive_reviews,
+                            negative_reviews = rating_histograms.negative_reviews
+                                + EXCLUDED.negative_reviews
+                    ),
+                    bumped_user AS (
+                        UPDATE users
+                        SET
+                            total_reviews = COALESCE(total_reviews, 0) + 1,
+                            seller_rating = ROUND(
+                                (
+                                    COALESCE(seller_rating, 0) * COALESCE(total_reviews, 0)
+                                    + new_review.rating
+                                ) / (COALESCE(total_reviews, 0) + 1),
+                                2
+                            )
+                        FROM new_review
+                        WHERE users.user_id = new_review.reviewee_id
+                    )
+                    SELECT * FROM new_review
+                    """,
+                (
+                    listing_id,
                     reviewer_id,
                     reviewee_id,
                     is_negative,
@@ -277,135 +1408,465 @@ def create_review(
                 ),
             )
             new_review = cursor.fetchone()
+            cache.notify(cursor, "user", reviewee_id)
             conn.commit()
+            mark_write(reviewer_id)
             return new_review
 
 
-def update_listing(
-    listing_type_id: int,
-    product_name: str,
-    title: str,
-    description: str,
-    starting_price: float,
-    pick_up_available: bool,
-    end_date: str,
-    listing_id: int,
+def get_user_reviews(
+    user_id: int,
+    before_created_at=None,
+    before_reviewer_id: int = None,
+    before_listing_id: int = None,
+    limit: int = 20,
 ):
     """
-    Updates a listing.
+    Fetches a page of the reviews a user has received, newest first.
+    Pass created_at, reviewer_id and listing_id of the last row of a page
+    to get the next one.
+    """
+    conditions = "reviewee_id = %s"
+    params = [user_id]
+    if before_created_at is not None:
+        conditions += " AND (created_at, reviewer_id, listing_id) < (%s, %s, %s)"
+        params.extend([before_created_at, before_reviewer_id, before_listing_id])
+    params.append(limit)
+
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"""
+                    SELECT {REVIEW_COLUMNS}
+                    FROM reviews
+                    WHERE {conditions}
+                    ORDER BY created_at DESC, reviewer_id DESC, listing_id DESC
+                    LIMIT %s
+                    """,
+                params,
+            )
+            return cursor.fetchall()
+
+
+def get_rating_summary(user_id: int):
+    """
+    Fetches a user's average rating and precomputed rating histogram.
+    """
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    SELECT
+                        u.user_id,
+                        u.seller_rating,
+                        COALESCE(u.total_reviews, 0) AS total_reviews,
+                        COALESCE(h.stars_1, 0) AS stars_1,
+                        COALESCE(h.stars_2, 0) AS stars_2,
+                        COALESCE(h.stars_3, 0) AS stars_3,
+                        COALESCE(h.stars_4, 0) AS stars_4,
+                        COALESCE(h.stars_5, 0) AS stars_5,
+                        COALESCE(h.positive_reviews, 0) AS positive_reviews,
+                        COALESCE(h.negative_reviews, 0) AS negative_reviews
+                    FROM users u
+                    LEFT JOIN rating_histograms h USING (user_id)
+                    WHERE u.user_id = %s AND u.deleted_at IS NULL
+                    """,
+                (user_id,),
+            )
+            return cursor.fetchone()
+
+
+def update_listing(listing_id: int, changes: dict, seller_id: int = None):
+    """
+    Updates the given columns of a listing, only if it belongs to
+    'seller_id' when that is given.
+    """
+    updated_listing = partial_update(
+        "listings",
+        "listing_id",
+        listing_id,
+        changes,
+        LISTING_UPDATABLE_COLUMNS,
+        LISTING_COLUMNS,
+        cache_name="listing",
+        owner_columns=("seller_id",),
+        owner_id=seller_id,
+        skip_deleted=True,
+        changelog_entity="listing",
+    )
+    if updated_listing:
+        mark_write(updated_listing["seller_id"])
+    return updated_listing
+
+
+def update_user(user_id: int, changes: dict):
+    """
+    Updates the given columns of a user.
+    """
+    updated_user = partial_update(
+        "users",
+        "user_id",
+        user_id,
+        changes,
+        USER_UPDATABLE_COLUMNS,
+        USER_COLUMNS,
+        cache_name="user",
+        skip_deleted=True,
+    )
+    mark_write(user_id)
+    return updated_user
+
+
+def update_listing_status(listing_id: int, status_id: int, seller_id: int = None):
+    """
+    Updates the status of a listing.
+    """
+    return update_listing(listing_id, {"status_id": status_id}, seller_id)
+
+
+def add_listing_views(counts: dict):
+    """
+    Adds buffered view counts to listings in one batched UPDATE, and to the
+    sellers' daily dashboard rollups.
+    'counts' maps listing_id -> number of new views.
     """
+    # Sorted so concurrent flushes from several processes take row locks in
+    # a consistent order.
+    rows = sorted(counts.items())
     with con() as conn:
+        with conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                """
+                    WITH updated AS (
+                        UPDATE listings AS l
+                        SET view_count = COALESCE(l.view_count, 0) + v.views
+                        FROM (VALUES %s) AS v(listing_id, views)
+                        WHERE l.listing_id = v.listing_id
+                        RETURNING l.seller_id, v.views
+                    )
+                    INSERT INTO seller_daily_stats(seller_id, day, views)
+                    SELECT seller_id, CURRENT_DATE, SUM(views)
+                    FROM updated
+                    WHERE seller_id IS NOT NULL
+                    GROUP BY seller_id
+                    ORDER BY seller_id
+                    ON CONFLICT (seller_id, day)
+                    DO UPDATE SET views = seller_daily_stats.views + EXCLUDED.views
+                    """,
+                rows,
+                page_size=len(rows),
+            )
+            conn.commit()
+
+
+def get_seller_daily_stats(seller_id: int, from_day, to_day):
+    """
+    Fetches a seller's daily dashboard rollups between two dates.
+    """
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"""
+                    SELECT {SELLER_DAILY_STATS_COLUMNS}
+                    FROM seller_daily_stats
+                    WHERE seller_id = %s
+                    AND day BETWEEN %s AND %s
+                    ORDER BY day
+                    """,
+                (seller_id, from_day, to_day),
+            )
+            return cursor.fetchall()
+
+
+def get_seller_listing_stats(seller_id: int):
+    """
+    Fetches per listing dashboard rollups for a seller.
+    """
+    with read_con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 """
-                            UPDATE listings
-                            SET 
-                                listing_type_id = %s,
-                                product_name = %s, 
-                                title = %s, 
-                                description = %s,
-                                starting_price = %s,
-                                pick_up_available = %s,
-                                end_date = %s
-                                WHERE listing_id = %s 
-                                RETURNING *
-    """,
-                (
-                    listing_type_id,
-                    product_name,
-                    title,
-                    description,
-                    starting_price,
-                    pick_up_available,
-                    end_date,
-                    listing_id,
-                ),
+                    SELECT
+                        s.listing_id,
+                        l.title,
+                        l.view_count AS views,
+                        s.bids,
+                        s.highest_bid,
+                        s.orders,
+                        CASE WHEN l.view_count > 0
+                            THEN ROUND(s.orders::numeric / l.view_count, 4)
+                        END AS conversion_rate
+                    FROM listing_stats s
+                    JOIN listings l USING (listing_id)
+                    WHERE s.seller_id = %s
+                    ORDER BY s.bids DESC
+                    """,
+                (seller_id,),
             )
+            return cursor.fetchall()
 
-            updated_listing = cursor.fetchone()
+
+def rebuild_seller_stats():
+    """
+    Recomputes all dashboard rollups and rating histograms from the base
+    tables. Only needed to backfill existing data, the rollups are kept up
+    to date on every write.
+    Daily views can't be rebuilt since only the listing totals are stored,
+    so they are kept as they are.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    LOCK TABLE seller_daily_stats, listing_stats, rating_histograms
+                    IN EXCLUSIVE MODE
+                    """
+            )
+            cursor.execute(
+                """
+                    CREATE TEMPORARY TABLE daily_views ON COMMIT DROP AS
+                    SELECT seller_id, day, views
+                    FROM seller_daily_stats
+                    WHERE views > 0
+                    """
+            )
+            cursor.execute(
+                "TRUNCATE seller_daily_stats, listing_stats, rating_histograms"
+            )
+            cursor.execute(
+                """
+                    INSERT INTO rating_histograms(
+                        user_id, stars_1, stars_2, stars_3, stars_4, stars_5,
+                        positive_reviews, negative_reviews
+                        )
+                    SELECT
+                        reviewee_id,
+                        COUNT(*) FILTER (WHERE star = 1),
+                        COUNT(*) FILTER (WHERE star = 2),
+                        COUNT(*) FILTER (WHERE star = 3),
+                        COUNT(*) FILTER (WHERE star = 4),
+                        COUNT(*) FILTER (WHERE star = 5),
+                        COUNT(*) FILTER (WHERE is_positive),
+                        COUNT(*) FILTER (WHERE is_negative)
+                    FROM reviews,
+                    LATERAL (
+                        SELECT LEAST(GREATEST(ROUND(rating), 1), 5) AS star
+                    ) stars
+                    WHERE reviewee_id IS NOT NULL
+                    GROUP BY reviewee_id
+                    """
+            )
+            cursor.execute(
+                f"""
+                    INSERT INTO listing_stats(
+                        listing_id, seller_id, bids, highest_bid, orders
+                        )
+                    SELECT
+                        l.listing_id,
+                        l.seller_id,
+                        COALESCE(b.bids, 0),
+                        b.highest_bid,
+                        COALESCE(o.orders, 0)
+                    FROM listings l
+                    LEFT JOIN (
+                        SELECT listing_id, COUNT(*) AS bids, MAX(bid_amount) AS highest_bid
+                        FROM bids
+                        GROUP BY listing_id
+                    ) b USING (listing_id)
+                    LEFT JOIN (
+                        SELECT listing_id, COUNT(*) AS orders
+                        FROM orders o
+                        WHERE {counted_order("o")}
+                        GROUP BY listing_id
+                    ) o USING (listing_id)
+                    """
+            )
+            cursor.execute(
+                f"""
+                    INSERT INTO seller_daily_stats(
+                        seller_id, day, bids, orders, revenue, reviews,
+                        rating_sum, positive_reviews, negative_reviews
+                        )
+                    SELECT seller_id, day, SUM(bids), SUM(orders), SUM(revenue),
+                        SUM(reviews), SUM(rating_sum), SUM(positive_reviews),
+                        SUM(negative_reviews)
+                    FROM (
+                        SELECT l.seller_id, b.bidded_at::date AS day, 1 AS bids,
+                            0 AS orders, 0 AS revenue, 0 AS reviews, 0 AS rating_sum,
+                            0 AS positive_reviews, 0 AS negative_reviews
+                        FROM bids b
+                        JOIN listings l USING (listing_id)
+                        UNION ALL
+                        SELECT seller_id, created_at::date, 0, 1, total_amount,
+                            0, 0, 0, 0
+                        FROM orders o
+                        WHERE {counted_order("o")}
+                        UNION ALL
+                        SELECT reviewee_id, created_at::date, 0, 0, 0, 1, rating,
+                            is_positive::int, is_negative::int
+                        FROM reviews
+                    ) events
+                    WHERE seller_id IS NOT NULL
+                    GROUP BY seller_id, day
+                    """
+            )
+            cursor.execute(
+                """
+                    INSERT INTO seller_daily_stats(seller_id, day, views)
+                    SELECT seller_id, day, views FROM daily_views
+                    ON CONFLICT (seller_id, day)
+                    DO UPDATE SET views = EXCLUDED.views
+                    """
+            )
             conn.commit()
-            return updated_listing
 
 
-def update_user(
-    language_id: int,
-    currency_id: int,
-    profile_picture_id: int,
-    city_id: int,
-    username: str,
-    email: str,
-    first_name: str,
-    last_name: str,
-    phone_number: str,
-    address: str,
-    postal_code: str,
-    user_id: int,
-):
+def add_listing_image(listing_id: int, url: str):
     """
-    Updates a user.
+    Creates an image and attaches it to a listing, after its other images.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Uploads to the same listing wait for each other here, so the
+            # next one sees this image and takes the position after it.
+            cursor.execute(
+                "SELECT 1 FROM listings WHERE listing_id = %s FOR UPDATE", (listing_id,)
+            )
             cursor.execute(
                 """
-                    UPDATE users
-                    SET 
-                    language_id = %s,
-                    currency_id = %s,
-                    profile_picture_id = %s,
-                    city_id = %s,
-                    
-                    username = %s,
-                    email = %s,
-                    first_name = %s,
-                    last_name = %s,
-                    phone_number = %s,
-                    address = %s,
-                    postal_code = %s,
-                    WHERE user_id = %s
-                    RETURNING *
+                    WITH new_img AS (
+                        INSERT INTO img(url)
+                        VALUES(%s)
+                        RETURNING img_id, url
+                    ),
+                    new_listing_img AS (
+                        INSERT INTO listing_imgs(img_id, listing_id, position)
+                        SELECT
+                            img_id,
+                            %s,
+                            (
+                                SELECT COALESCE(MAX(position) + 1, 0)
+                                FROM listing_imgs
+                                WHERE listing_id = %s
+                            )
+                        FROM new_img
+                        RETURNING img_id, listing_id, position
+                    )
+                    SELECT new_listing_img.*, new_img.url
+                    FROM new_listing_img
+                    JOIN new_img USING (img_id)
                     """,
-                (
-                    language_id,
-                    currency_id,
-                    profile_picture_id,
-                    city_id,
-                    username,
-                    email,
-                    first_name,
-                    last_name,
-                    phone_number,
-                    address,
-                    postal_code,
-                    user_id,
-                ),
+                (url, listing_id, listing_id),
             )
-            updated_user = cursor.fetchone()
+            new_image = cursor.fetchone()
             conn.commit()
-            return updated_user
+            return new_image
 
 
-def update_listing_status(listing_id: int, status_id: int):
+def add_image_variants(img_id: int, width: int, height: int, variants: list):
+    """
+    Saves the size of an image and its thumbnail variants.
+    'variants' is a list of (variant, url, width, height) tuples.
+    """
     with con() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        with conn.cursor() as cursor:
             cursor.execute(
                 """
-                    UPDATE listings
-                    SET 
-                    status_id = %s,
-                    WHERE listing_id = %s
-                    RETURNING *
+                    UPDATE img
+                    SET width = %s, height = %s
+                    WHERE img_id = %s
                     """,
-                (status_id, listing_id),
+                (width, height, img_id),
+            )
+            execute_values(
+                cursor,
+                """
+                    INSERT INTO img_variants(img_id, variant, url, width, height)
+                    VALUES %s
+                    ON CONFLICT (img_id, variant)
+                    DO UPDATE SET
+                        url = EXCLUDED.url,
+                        width = EXCLUDED.width,
+                        height = EXCLUDED.height
+                    """,
+                [(img_id, *variant) for variant in variants],
             )
-            updated_status = cursor.fetchone()
             conn.commit()
-            return updated_status
 
 
-def update_password(password_hash: str, user_id: int):
+def delete_image(img_id: int):
     """
-    Updates a users password.
+    Deletes an image whose thumbnails couldn't be generated, and its link to
+    a listing.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    WITH unlinked AS (
+                        DELETE FROM listing_imgs WHERE img_id = %(img_id)s
+                    ),
+                    variants AS (
+                        DELETE FROM img_variants WHERE img_id = %(img_id)s
+                    )
+                    DELETE FROM img WHERE img_id = %(img_id)s
+                    """,
+                {"img_id": img_id},
+            )
+            conn.commit()
+
+
+def get_primary_thumbnails(listing_ids: list, variant: str = "small"):
+    """
+    Fetches the first image of each listing in one query, as the requested
+    thumbnail variant when it has been generated and the original otherwise.
+    """
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    SELECT DISTINCT ON (li.listing_id)
+                        li.listing_id,
+                        li.img_id,
+                        COALESCE(v.url, i.url) AS url,
+                        COALESCE(v.width, i.width) AS width,
+                        COALESCE(v.height, i.height) AS height
+                    FROM listing_imgs li
+                    JOIN img i USING (img_id)
+                    LEFT JOIN img_variants v
+                        ON v.img_id = li.img_id AND v.variant = %s
+                    WHERE li.listing_id = ANY(%s)
+                    ORDER BY li.listing_id, li.position, li.img_id
+                    """,
+                (variant, listing_ids),
+            )
+            return cursor.fetchall()
+
+
+def get_password_hash(user_id: int = None, username: str = None):
+    """
+    Fetches user_id and password_hash of a user by id or username.
+    Always reads from the primary so a just changed password is seen.
+    """
+    column = "user_id" if user_id is not None else "username"
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"""
+                    SELECT user_id, password_hash
+                    FROM users
+                    WHERE {column} = %s AND deleted_at IS NULL
+                    """,
+                (user_id if user_id is not None else username,),
+            )
+            return cursor.fetchone()
+
+
+def update_password(password_hash: str, user_id: int, revocation: tuple):
+    """
+    Updates a users password and revokes the tokens issued to them, with
+    'revocation' being (revoked_at, expires_at) from auth.user_revocation.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
@@ -420,106 +1881,1034 @@ def update_password(password_hash: str, user_id: int):
                 (password_hash, user_id),
             )
             updated_user = cursor.fetchone()
+            if updated_user is not None:
+                revoke_user_tokens(cursor, user_id, revocation)
             conn.commit()
+            mark_write(user_id)
             return updated_user
 
 
-def update_order(
-    shipping_option_id: int,
-    order_status_id: int,
-    shipping_address: str,
-    shipping_city: str,
-    shipping_postal_code: str,
-    final_price: float,
-    discount_amount: float,
-    order_id: int,
-):
+def get_exchange_rates():
     """
-    Updates a order.
+    Fetches the exchange rate of every currency that has one, from the
+    primary so a refresh right after set_exchange_rate sees the new rate.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 """
-                    UPDATE orders
-                    SET
-                        shipping_option_id = %s
-                        order_status_id = %s
-                        shipping_address = %s
-                        shipping_city = %s
-                        shipping_postal_code = %s
-                        final_price = %s
-                        discount_amount = %s
-                    WHERE order_id = %s 
-                    RETURNING *
+                    SELECT currency_id, rate, updated_at
+                    FROM exchange_rates
+                    """
+            )
+            return cursor.fetchall()
+
+
+def set_exchange_rate(currency_id: int, rate):
+    """
+    Creates or replaces the exchange rate of a currency, every process
+    reloads its rates when this commits.
+    """
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    INSERT INTO exchange_rates(currency_id, rate)
+                    VALUES(%s, %s)
+                    ON CONFLICT (currency_id) DO UPDATE SET
+                        rate = EXCLUDED.rate,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING currency_id, rate, updated_at
                     """,
-                (
-                    shipping_option_id,
-                    order_status_id,
-                    shipping_address,
-                    shipping_city,
-                    shipping_postal_code,
-                    final_price,
-                    discount_amount,
-                    order_id,
-                ),
+                (currency_id, rate),
             )
-            updated_order = cursor.fetchone()
+            exchange_rate = cursor.fetchone()
+            cache.notify(cursor, "exchange_rate", currency_id)
             conn.commit()
-            return updated_order
+            return exchange_rate
 
 
-def delete_listing(listing_id: int):
+def get_token_revocations():
     """
-    Updates a listings.
+    Drops revocations of tokens that have expired anyway and returns the
+    rest. Runs on the primary so a new revocation is never missed.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 """
-                    DELETE FROM listings
-                    WHERE listing_id = %s
-                    RETURNING listing_id, title
+                    DELETE FROM token_revocations
+                    WHERE expires_at <= CURRENT_TIMESTAMP
+                    """
+            )
+            cursor.execute(
+                """
+                    SELECT user_id, token_id, revoked_at
+                    FROM token_revocations
+                    """
+            )
+            revocations = cursor.fetchall()
+            conn.commit()
+            return revocations
+
+
+def revoke_token(user_id: int, token_id: str, expires_at: int):
+    """
+    Revokes a single token in every process.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    INSERT INTO token_revocations
+                    (user_id, token_id, revoked_at, expires_at)
+                    VALUES (%s, %s, 0, to_timestamp(%s))
+                    """,
+                (user_id, token_id, expires_at),
+            )
+            cache.notify(cursor, "token_revocation", f"token:{token_id}")
+            conn.commit()
+
+
+def revoke_user_tokens(cursor, user_id: int, revocation: tuple):
+    """
+    Revokes every token issued to a user before revoked_at, in the
+    transaction of 'cursor'.
+    """
+    revoked_at, expires_at = revocation
+    cursor.execute(
+        """
+            INSERT INTO token_revocations (user_id, revoked_at, expires_at)
+            VALUES (%s, %s, to_timestamp(%s))
+            """,
+        (user_id, revoked_at, expires_at),
+    )
+    cache.notify(cursor, "token_revocation", f"user:{user_id}:{revoked_at}")
+
+
+def update_order(order_id: int, changes: dict, user_id: int = None):
+    """
+    Updates the given columns of an order and recomputes its shipping_cost
+    and total_amount from them. With a 'user_id' only the order's buyer or
+    seller may update it, and only the seller may change
+    ORDER_SELLER_COLUMNS. Raises PermissionError when the buyer tries to.
+    """
+    unknown_columns = set(changes) - set(ORDER_UPDATABLE_COLUMNS)
+    if unknown_columns:
+        raise ValueError(
+            f"Cannot update column(s): {', '.join(sorted(unknown_columns))}"
+        )
+
+    def new_value(column: str):
+        if column in changes:
+            return sql.Placeholder(column)
+        return sql.SQL("o.{}").format(sql.Identifier(column))
+
+    assignments = [
+        sql.SQL("{} = {}").format(sql.Identifier(column), sql.Placeholder(column))
+        for column in changes
+    ]
+    shipping_cost = sql.SQL("o.shipping_cost")
+    if "shipping_option_id" in changes:
+        shipping_cost = sql.SQL(
+            "COALESCE((SELECT shipping_cost FROM shipping_options "
+            "WHERE shipping_id = %(shipping_option_id)s), 0)"
+        )
+        assignments.append(sql.SQL("shipping_cost = {}").format(shipping_cost))
+    assignments += [
+        sql.SQL("total_amount = GREATEST({} - {}, 0) + {}").format(
+            new_value("final_price"), new_value("discount_amount"), shipping_cost
+        ),
+        sql.SQL("updated_at = CURRENT_TIMESTAMP"),
+    ]
+
+    owner_condition = sql.SQL("")
+    seller_changes = [column for column in changes if column in ORDER_SELLER_COLUMNS]
+    if user_id is not None:
+        # The buyer may send seller columns, e.g. in a PUT, as long as they
+        # keep their current values.
+        buyer_condition = sql.SQL("o.buyer_id = %(user_id)s")
+        if seller_changes:
+            buyer_condition += sql.SQL(" AND ({}) IS NOT DISTINCT FROM ({})").format(
+                sql.SQL(", ").join(
+                    sql.SQL("o.{}").format(sql.Identifier(column))
+                    for column in seller_changes
+                ),
+                sql.SQL(", ").join(map(sql.Placeholder, seller_changes)),
+            )
+        owner_condition = sql.SQL(" AND (o.seller_id = %(user_id)s OR ({}))").format(
+            buyer_condition
+        )
+
+    returning = ", ".join(
+        f"o.{column.strip()}" for column in ORDER_COLUMNS.split(",")
+    )
+    # The old row is locked first, so the rollups get the change from the
+    # version that is actually updated.
+    query = sql.SQL(
+        """
+            WITH old AS (
+                SELECT order_id, order_status_id, total_amount
+                FROM orders
+                WHERE order_id = %(order_id)s
+                FOR UPDATE
+            ),
+            updated AS (
+                UPDATE orders o
+                SET {assignments}
+                FROM old
+                WHERE o.order_id = old.order_id{owner_condition}
+                AND ({columns}) IS DISTINCT FROM ({values})
+                RETURNING {returning}
+            ),
+            logged AS ({log}),
+            order_delta AS (
+                SELECT o.seller_id, o.listing_id, o.created_at::date AS day,
+                    {counted}::int - {counted_old}::int AS orders,
+                    CASE WHEN {counted} THEN o.total_amount ELSE 0 END
+                    - CASE WHEN {counted_old} THEN old.total_amount ELSE 0 END
+                    AS revenue
+                FROM updated o
+                JOIN old USING (order_id)
+            ),
+            {rollups}
+            SELECT * FROM updated
+            """
+    ).format(
+        assignments=sql.SQL(", ").join(assignments),
+        owner_condition=owner_condition,
+        columns=sql.SQL(", ").join(
+            sql.SQL("o.{}").format(sql.Identifier(column)) for column in changes
+        ),
+        values=sql.SQL(", ").join(map(sql.Placeholder, changes)),
+        returning=sql.SQL(returning),
+        log=sql.SQL(log_change("order", "update", "updated", "order_id")),
+        counted=sql.SQL(counted_order("o")),
+        counted_old=sql.SQL(counted_order("old")),
+        rollups=sql.SQL(order_rollups("order_delta")),
+    )
+
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            updated_order = None
+            if changes:
+                cursor.execute(
+                    query, {**changes, "order_id": order_id, "user_id": user_id}
+                )
+                updated_order = cursor.fetchone()
+                conn.commit()
+            if updated_order is not None:
+                return updated_order
+
+            # Nothing changed, the order doesn't exist or isn't the user's,
+            # or the buyer tried to change a seller column.
+            cursor.execute(
+                f"SELECT {ORDER_COLUMNS} FROM orders WHERE order_id = %s",
+                (order_id,),
+            )
+            order = cursor.fetchone()
+            if order is None or user_id is None:
+                return order
+            if user_id == order["seller_id"]:
+                return order
+            if user_id != order["buyer_id"]:
+                return None
+            if any(order[column] != changes[column] for column in seller_changes):
+                raise PermissionError("Only the seller can change these columns.")
+            return order
+
+
+def bulk_update_status(
+    table: str,
+    key_column: str,
+    status_column: str,
+    status_id: int,
+    ids: list = None,
+    filters: dict = None,
+    batch_size: int = BULK_BATCH_SIZE,
+    touch_updated_at: bool = False,
+    cache_name: str = None,
+    skip_deleted: bool = False,
+    changelog_entity: str = None,
+    changelog_columns: str = None,
+    rollup: str = None,
+):
+    """
+    Sets the status of many rows, either by a list of ids or by equality
+    filters on other columns. Works through the rows in batches of
+    'batch_size', committing after each one. Returns the number of updated
+    rows. With 'skip_deleted' soft deleted rows are left alone. With a
+    'changelog_entity' the 'changelog_columns' of updated rows are written
+    to changelog. A 'rollup' adds CTEs to the statement that can read the
+    updated rows from 'updated' and their previous status from 'old'.
+    """
+    assignments = [sql.SQL("{} = %s").format(sql.Identifier(status_column))]
+    if touch_updated_at:
+        assignments.append(sql.SQL("updated_at = CURRENT_TIMESTAMP"))
+
+    if ids is not None:
+        conditions = sql.SQL("{} = ANY(%s)").format(sql.Identifier(key_column))
+        limit = sql.SQL("")
+    else:
+        conditions = sql.SQL(" AND ").join(
+            sql.SQL("{} = %s").format(sql.Identifier(column)) for column in filters
+        )
+        limit = sql.SQL(" LIMIT %s")
+
+    ctes = []
+    if changelog_entity is not None:
+        ctes.append(
+            sql.SQL(", logged AS ({})").format(
+                sql.SQL(log_change(changelog_entity, "update", "updated", key_column))
+            )
+        )
+    if rollup is not None:
+        ctes.append(sql.SQL(", {}").format(sql.SQL(rollup)))
+
+    # The rows are locked in 'old' first, so it holds their status from
+    # right before the update.
+    query = sql.SQL(
+        """
+            WITH old AS (
+                SELECT {key}, {status}
+                FROM {table}
+                WHERE {conditions}
+                AND {status} IS DISTINCT FROM %s{live}{limit}
+                FOR UPDATE
+            ),
+            updated AS (
+                UPDATE {table}
+                SET {assignments}
+                WHERE {key} IN (SELECT {key} FROM old)
+                RETURNING {returning}
+            ){ctes}
+            SELECT COUNT(*) FROM updated
+            """
+    ).format(
+        table=sql.Identifier(table),
+        assignments=sql.SQL(", ").join(assignments),
+        key=sql.Identifier(key_column),
+        status=sql.Identifier(status_column),
+        conditions=conditions,
+        live=sql.SQL(" AND deleted_at IS NULL" if skip_deleted else ""),
+        limit=limit,
+        returning=sql.SQL(changelog_columns or key_column),
+        ctes=sql.Composed(ctes),
+    )
+
+    updated = 0
+    with con() as conn:
+        with conn.cursor() as cursor:
+            if ids is not None:
+                for start in range(0, len(ids), batch_size):
+                    batch = ids[start : start + batch_size]
+                    cursor.execute(query, (batch, status_id, status_id))
+                    conn.commit()
+                    updated += cursor.fetchone()[0]
+            else:
+                # Updated rows stop matching the filter, so the same batch
+                # query is repeated until a batch comes back short.
+                params = (*filters.values(), status_id, batch_size, status_id)
+                while True:
+                    cursor.execute(query, params)
+                    count = cursor.fetchone()[0]
+                    conn.commit()
+                    updated += count
+                    if count < batch_size:
+                        break
+
+            if updated and cache_name is not None:
+                cache.notify(cursor, cache_name)
+                conn.commit()
+
+    return updated
+
+
+def bulk_update_listing_status(
+    status_id: int,
+    listing_ids: list = None,
+    seller_id: int = None,
+    from_status_id: int = None,
+    batch_size: int = BULK_BATCH_SIZE,
+):
+    """
+    Sets the status of the given listings, or of all listings of a seller
+    (optionally only those currently in 'from_status_id').
+    """
+    filters = {"seller_id": seller_id}
+    if from_status_id is not None:
+        filters["status_id"] = from_status_id
+
+    return bulk_update_status(
+        "listings",
+        "listing_id",
+        "status_id",
+        status_id,
+        ids=listing_ids,
+        filters=filters,
+        batch_size=batch_size,
+        cache_name="listing",
+        skip_deleted=True,
+        changelog_entity="listing",
+        changelog_columns=LISTING_COLUMNS,
+    )
+
+
+def bulk_update_order_status(
+    order_status_id: int,
+    order_ids: list = None,
+    seller_id: int = None,
+    from_status_id: int = None,
+    batch_size: int = BULK_BATCH_SIZE,
+):
+    """
+    Sets the status of the given orders, or of all orders of a seller
+    (optionally only those currently in 'from_status_id').
+    """
+    filters = {"seller_id": seller_id}
+    if from_status_id is not None:
+        filters["order_status_id"] = from_status_id
+
+    return bulk_update_status(
+        "orders",
+        "order_id",
+        "order_status_id",
+        order_status_id,
+        ids=order_ids,
+        filters=filters,
+        batch_size=batch_size,
+        touch_updated_at=True,
+        changelog_entity="order",
+        changelog_columns=ORDER_COLUMNS,
+        rollup=f"""
+            order_delta AS (
+                SELECT o.seller_id, o.listing_id, o.created_at::date AS day,
+                    {counted_order("o")}::int - {counted_order("old")}::int
+                    AS orders,
+                    ({counted_order("o")}::int - {counted_order("old")}::int)
+                    * o.total_amount AS revenue
+                FROM updated o
+                JOIN old USING (order_id)
+            ),
+            {order_rollups("order_delta")}
+            """,
+    )
+
+
+def delete_listing(listing_id: int, seller_id: int):
+    """
+    Soft deletes a listing of 'seller_id' and queues it for purge.py, which
+    removes its bids, images and other dependent rows later.
+    """
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"""
+                    WITH deleted AS (
+                        UPDATE listings
+                        SET deleted_at = CURRENT_TIMESTAMP
+                        WHERE listing_id = %s AND seller_id = %s
+                        AND deleted_at IS NULL
+                        RETURNING listing_id, title
+                    ),
+                    queued AS (
+                        INSERT INTO purge_queue(kind, id)
+                        SELECT 'listing', listing_id FROM deleted
+                        ON CONFLICT DO NOTHING
+                    ),
+                    logged AS (
+                        {log_change("listing", "delete", "deleted", "listing_id")}
+                    )
+                    SELECT listing_id, title FROM deleted
                     """,
-                (listing_id),
+                (listing_id, seller_id),
             )
             deleted_listing = cursor.fetchone()
+            if deleted_listing is not None:
+                cache.notify(cursor, "listing", listing_id)
             conn.commit()
             return deleted_listing
 
 
-def delete_user(user_id: int):
+def delete_user(user_id: int, revocation: tuple):
     """
-    Deletes a user.
+    Soft deletes a user and their listings, queues them for purge.py and
+    revokes the tokens issued to the user.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
-                """
-                    DELETE FROM users
-                    WHERE user_id = %s
-                    RETURNING user_id, username
+                f"""
+                    WITH deleted_user AS (
+                        UPDATE users
+                        SET deleted_at = CURRENT_TIMESTAMP
+                        WHERE user_id = %(user_id)s AND deleted_at IS NULL
+                        RETURNING user_id, username
+                    ),
+                    deleted_listings AS (
+                        UPDATE listings
+                        SET deleted_at = CURRENT_TIMESTAMP
+                        WHERE seller_id = (SELECT user_id FROM deleted_user)
+                        AND deleted_at IS NULL
+                        RETURNING listing_id
+                    ),
+                    queued AS (
+                        INSERT INTO purge_queue(kind, id)
+                        SELECT 'user', user_id FROM deleted_user
+                        UNION ALL
+                        SELECT 'listing', listing_id FROM deleted_listings
+                        ON CONFLICT DO NOTHING
+                    ),
+                    logged AS (
+                        {log_change("listing", "delete", "deleted_listings", "listing_id")}
+                    )
+                    SELECT user_id, username,
+                        (SELECT count(*) FROM deleted_listings) AS deleted_listings
+                    FROM deleted_user
                     """,
-                (user_id),
+                {"user_id": user_id},
             )
             deleted_user = cursor.fetchone()
+            if deleted_user is not None:
+                cache.notify(cursor, "user", user_id)
+                if deleted_user.pop("deleted_listings"):
+                    cache.notify(cursor, "listing")
+                revoke_user_tokens(cursor, user_id, revocation)
             conn.commit()
             return deleted_user
 
 
-def delete_message(message_id: int):
+# Steps purge.py runs for a soft deleted listing or user, in order. Each
+# query handles at most %(batch_size)s rows and is repeated, one short
+# transaction per batch, until it handles fewer. The last step removes the
+# row itself unless orders or reviews still need it, then it stays behind
+# as a deleted tombstone.
+PURGE_STEPS = {
+    "listing": [
+        """
+        DELETE FROM bids WHERE bid_id IN (
+            SELECT bid_id FROM bids WHERE listing_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM watchlist WHERE (listing_id, user_id) IN (
+            SELECT listing_id, user_id FROM watchlist
+            WHERE listing_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM listing_payment_options WHERE listing_id = %(id)s
+        """,
+        """
+        DELETE FROM listing_shipping_options WHERE listing_id = %(id)s
+        """,
+        """
+        DELETE FROM listing_categories WHERE listing_id = %(id)s
+        """,
+        """
+        UPDATE messages SET listing_id = NULL WHERE message_id IN (
+            SELECT message_id FROM messages
+            WHERE listing_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        # Returns the image keys so purge.py can delete the files.
+        """
+        WITH links AS (
+            DELETE FROM listing_imgs WHERE (img_id, listing_id) IN (
+                SELECT img_id, listing_id FROM listing_imgs
+                WHERE listing_id = %(id)s LIMIT %(batch_size)s
+            )
+            RETURNING img_id
+        ),
+        variants AS (
+            DELETE FROM img_variants
+            WHERE img_id IN (SELECT img_id FROM links)
+            RETURNING url
+        ),
+        images AS (
+            DELETE FROM img
+            WHERE img_id IN (SELECT img_id FROM links)
+            RETURNING url
+        )
+        SELECT url FROM variants UNION ALL SELECT url FROM images
+        """,
+        """
+        DELETE FROM listing_stats WHERE listing_id = %(id)s
+        """,
+        """
+        DELETE FROM listings l
+        WHERE l.listing_id = %(id)s AND l.deleted_at IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.listing_id = l.listing_id)
+        AND NOT EXISTS (SELECT 1 FROM reviews r WHERE r.listing_id = l.listing_id)
+        """,
+    ],
+    "user": [
+        """
+        UPDATE bids SET user_id = NULL WHERE bid_id IN (
+            SELECT bid_id FROM bids WHERE user_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM watchlist WHERE (listing_id, user_id) IN (
+            SELECT listing_id, user_id FROM watchlist
+            WHERE user_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM messages WHERE message_id IN (
+            SELECT message_id FROM messages
+            WHERE sender_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM messages WHERE message_id IN (
+            SELECT message_id FROM messages
+            WHERE reciever_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        # Listings kept as tombstones for their orders or reviews.
+        """
+        UPDATE listings SET seller_id = NULL WHERE listing_id IN (
+            SELECT listing_id FROM listings
+            WHERE seller_id = %(id)s AND deleted_at IS NOT NULL
+            LIMIT %(batch_size)s
+        )
+        """,
+        """
+        UPDATE orders SET buyer_id = NULL WHERE order_id IN (
+            SELECT order_id FROM orders WHERE buyer_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        UPDATE orders SET seller_id = NULL WHERE order_id IN (
+            SELECT order_id FROM orders WHERE seller_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM seller_daily_stats WHERE (seller_id, day) IN (
+            SELECT seller_id, day FROM seller_daily_stats
+            WHERE seller_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM listing_stats WHERE listing_id IN (
+            SELECT listing_id FROM listing_stats
+            WHERE seller_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM rating_histograms WHERE user_id = %(id)s
+        """,
+        """
+        DELETE FROM notifications WHERE notification_id IN (
+            SELECT notification_id FROM notifications
+            WHERE user_id = %(id)s LIMIT %(batch_size)s
+        )
+        """,
+        """
+        DELETE FROM notification_digests WHERE recipient_id = %(id)s
+        """,
+        # Returns the image keys so purge.py can delete the files.
+        """
+        WITH profile AS (
+            SELECT profile_picture_id AS img_id FROM users
+            WHERE user_id = %(id)s AND deleted_at IS NOT NULL
+            AND profile_picture_id IS NOT NULL
+            FOR UPDATE
+        ),
+        cleared AS (
+            UPDATE users SET profile_picture_id = NULL
+            WHERE user_id IN (SELECT %(id)s FROM profile)
+        ),
+        variants AS (
+            DELETE FROM img_variants
+            WHERE img_id IN (SELECT img_id FROM profile)
+            RETURNING url
+        ),
+        images AS (
+            DELETE FROM img
+            WHERE img_id IN (SELECT img_id FROM profile)
+            AND NOT EXISTS (
+                SELECT 1 FROM listing_imgs li WHERE li.img_id = img.img_id
+            )
+            RETURNING url
+        )
+        SELECT url FROM variants UNION ALL SELECT url FROM images
+        """,
+        # Users kept as tombstones for their reviews keep no personal data,
+        # the unique columns get a placeholder.
+        """
+        UPDATE users SET
+            username = 'deleted-' || user_id,
+            email = 'deleted-' || user_id,
+            phone_number = 'deleted-' || user_id,
+            password_hash = '',
+            social_security_number = '',
+            first_name = '',
+            last_name = '',
+            address = '',
+            postal_code = ''
+        WHERE user_id = %(id)s AND deleted_at IS NOT NULL
+        AND username IS DISTINCT FROM 'deleted-' || user_id
+        """,
+        """
+        DELETE FROM users u
+        WHERE u.user_id = %(id)s AND u.deleted_at IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM reviews r WHERE r.reviewer_id = u.user_id)
+        AND NOT EXISTS (SELECT 1 FROM reviews r WHERE r.reviewee_id = u.user_id)
+        """,
+    ],
+}
+
+
+def get_changes(
+    after_txid: int, after_seq: int, limit: int, entities: list = None
+):
     """
-    Deletes a message.
+    Fetches up to 'limit' changelog entries after the position
+    (after_txid, after_seq), as a JSON object string with the entries and
+    the position to continue from.
+    Entries are ordered by the transaction that wrote them, and only
+    transactions older than every one still running are returned. A
+    transaction that commits late can't add entries behind a position a
+    consumer has already passed.
+    """
+    entity_condition = "AND entity = ANY(%(entities)s)" if entities else ""
+    with read_con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                    SELECT json_build_object(
+                        'changes', COALESCE(json_agg(c ORDER BY c.txid, c.seq), '[]'),
+                        'next', COALESCE(
+                            (array_agg(c.txid || '.' || c.seq
+                                ORDER BY c.txid DESC, c.seq DESC))[1],
+                            %(after_txid)s || '.' || %(after_seq)s
+                        )
+                    )::text
+                    FROM (
+                        SELECT txid, seq, entity, entity_id, op, data, changed_at
+                        FROM changelog
+                        WHERE (txid, seq) > (%(after_txid)s, %(after_seq)s)
+                        AND txid < txid_snapshot_xmin(txid_current_snapshot())
+                        {entity_condition}
+                        ORDER BY txid, seq
+                        LIMIT %(limit)s
+                    ) c
+                    """,
+                {
+                    "after_txid": after_txid,
+                    "after_seq": after_seq,
+                    "limit": limit,
+                    "entities": entities,
+                },
+            )
+            return cursor.fetchone()[0]
+
+
+def trim_changelog(retention: float, batch_size: int):
+    """
+    Deletes one batch of changelog entries older than 'retention' seconds.
+    Returns the number of deleted entries.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    DELETE FROM changelog WHERE (txid, seq) IN (
+                        SELECT txid, seq FROM changelog
+                        WHERE changed_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                        LIMIT %s
+                    )
+                    """,
+                (retention, batch_size),
+            )
+            conn.commit()
+            return cursor.rowcount
+
+
+def claim_purge(grace_period: float, lease: float):
+    """
+    Leases the oldest queued purge whose grace period has passed, for
+    'lease' seconds. Listings go first, a user waits until all their
+    listings are purged. Returns (kind, id) or None.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    UPDATE purge_queue
+                    SET claimed_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                    WHERE (kind, id) = (
+                        SELECT q.kind, q.id
+                        FROM purge_queue q
+                        WHERE q.deleted_at
+                            <= CURRENT_TIMESTAMP - make_interval(secs => %s)
+                        AND (q.claimed_until IS NULL
+                            OR q.claimed_until < CURRENT_TIMESTAMP)
+                        AND NOT (q.kind = 'user' AND EXISTS (
+                            SELECT 1
+                            FROM purge_queue pending
+                            JOIN listings ON listings.listing_id = pending.id
+                            WHERE pending.kind = 'listing'
+                            AND listings.seller_id = q.id
+                        ))
+                        ORDER BY q.kind = 'user', q.deleted_at
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING kind, id
+                    """,
+                (lease, grace_period),
+            )
+            claimed = cursor.fetchone()
+            conn.commit()
+            return claimed
+
+
+def run_purge_step(query: str, key: int, batch_size: int):
+    """
+    Runs one batch of a PURGE_STEPS query in its own transaction. Returns
+    the number of rows it handled and the rows it returned, if any.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query, {"id": key, "batch_size": batch_size})
+            rows = cursor.fetchall() if cursor.description else []
+            conn.commit()
+            return cursor.rowcount, rows
+
+
+def finish_purge(kind: str, key: int):
+    """
+    Removes a finished purge from the queue.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM purge_queue WHERE kind = %s AND id = %s", (kind, key)
+            )
+            conn.commit()
+
+
+def create_message(
+    sender_id: int, reciever_id: int, message_text: str, listing_id: int = None
+):
+    """
+    Sends a message and queues a notification for its reciever. Returns
+    None if the reciever doesn't exist or was deleted.
+    """
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    WITH new_message AS (
+                        INSERT INTO messages(
+                            sender_id, reciever_id, listing_id, message_text
+                        )
+                        SELECT %(sender_id)s, user_id, %(listing_id)s, %(message_text)s
+                        FROM users
+                        WHERE user_id = %(reciever_id)s AND deleted_at IS NULL
+                        RETURNING message_id, sender_id, reciever_id, listing_id,
+                            message_text, message_shown, sent_at
+                    ),
+                    queued AS (
+                        INSERT INTO notification_events(
+                            kind, listing_id, actor_id, recipient_id
+                        )
+                        SELECT 'message', listing_id, sender_id, reciever_id
+                        FROM new_message
+                    )
+                    SELECT * FROM new_message
+                    """,
+                {
+                    "sender_id": sender_id,
+                    "reciever_id": reciever_id,
+                    "listing_id": listing_id,
+                    "message_text": message_text,
+                },
+            )
+            new_message = cursor.fetchone()
+            conn.commit()
+            mark_write(sender_id)
+            return new_message
+
+
+def fan_out_notifications(batch_size: int, max_listings: int):
+    """
+    Takes up to 'batch_size' queued notification events and adds each to
+    the digest of every recipient: the seller and watchers of a listing for
+    a bid, the reciever for a message. Events a worker is already handling
+    are skipped, so several workers can run this at once. Digests are
+    upserted in recipient_id order, so concurrent batches lock shared
+    recipients in the same order and can't deadlock.
+    Returns (events taken, digests created or updated).
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    WITH claimed AS (
+                        DELETE FROM notification_events
+                        WHERE event_id IN (
+                            SELECT event_id FROM notification_events
+                            ORDER BY event_id
+                            LIMIT %(batch_size)s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING kind, listing_id, actor_id, recipient_id, created_at
+                    ),
+                    recipients AS (
+                        SELECT l.seller_id AS recipient_id, c.kind, c.listing_id,
+                            c.actor_id, c.created_at
+                        FROM claimed c
+                        JOIN listings l ON l.listing_id = c.listing_id
+                        WHERE c.kind = 'bid'
+                        UNION ALL
+                        SELECT w.user_id, c.kind, c.listing_id, c.actor_id, c.created_at
+                        FROM claimed c
+                        JOIN watchlist w ON w.listing_id = c.listing_id
+                        WHERE c.kind = 'bid'
+                        UNION ALL
+                        SELECT c.recipient_id, c.kind, c.listing_id, c.actor_id,
+                            c.created_at
+                        FROM claimed c
+                        WHERE c.kind = 'message'
+                    ),
+                    digested AS (
+                        INSERT INTO notification_digests AS d(
+                            recipient_id, bids, messages, listing_ids, first_at, last_at
+                        )
+                        SELECT
+                            r.recipient_id,
+                            count(*) FILTER (WHERE r.kind = 'bid'),
+                            count(*) FILTER (WHERE r.kind = 'message'),
+                            COALESCE((array_agg(DISTINCT r.listing_id)
+                                FILTER (WHERE r.listing_id IS NOT NULL)
+                            )[1:%(max_listings)s], '{}'),
+                            min(r.created_at),
+                            max(r.created_at)
+                        FROM recipients r
+                        WHERE r.recipient_id IS DISTINCT FROM r.actor_id
+                        AND r.recipient_id IS NOT NULL
+                        GROUP BY r.recipient_id
+                        ORDER BY r.recipient_id
+                        ON CONFLICT (recipient_id) DO UPDATE SET
+                            bids = d.bids + EXCLUDED.bids,
+                            messages = d.messages + EXCLUDED.messages,
+                            listing_ids = (ARRAY(
+                                SELECT DISTINCT unnest(d.listing_ids || EXCLUDED.listing_ids)
+                            ))[1:%(max_listings)s],
+                            last_at = GREATEST(d.last_at, EXCLUDED.last_at)
+                        RETURNING 1
+                    )
+                    SELECT (SELECT count(*) FROM claimed), (SELECT count(*) FROM digested)
+                    """,
+                {"batch_size": batch_size, "max_listings": max_listings},
+            )
+            counts = cursor.fetchone()
+            conn.commit()
+            return counts
+
+
+def deliver_notifications(window: float, batch_size: int):
+    """
+    Moves up to 'batch_size' digests whose first event is at least 'window'
+    seconds old to the recipients' notifications. Returns how many were
+    delivered.
+    """
+    with con() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    WITH due AS (
+                        DELETE FROM notification_digests
+                        WHERE recipient_id IN (
+                            SELECT recipient_id FROM notification_digests
+                            WHERE first_at
+                                <= CURRENT_TIMESTAMP - make_interval(secs => %s)
+                            ORDER BY first_at
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING *
+                    )
+                    INSERT INTO notifications(
+                        user_id, bids, messages, listing_ids, first_at, last_at
+                    )
+                    SELECT recipient_id, bids, messages, listing_ids, first_at, last_at
+                    FROM due
+                    """,
+                (window, batch_size),
+            )
+            conn.commit()
+            return cursor.rowcount
+
+
+def get_notification_backlog():
+    """
+    Counts queued notification events and pending digests, and the age in
+    seconds of the oldest queued event.
+    """
+    with con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                    SELECT
+                        (SELECT count(*) FROM notification_events) AS events,
+                        (SELECT EXTRACT(EPOCH FROM
+                            CURRENT_TIMESTAMP - min(created_at))::float
+                         FROM notification_events) AS oldest_event_age,
+                        (SELECT count(*) FROM notification_digests) AS digests
+                    """
+            )
+            return cursor.fetchone()
+
+
+def get_notifications(
+    user_id: int, before_notification_id: int = None, limit: int = 20
+):
+    """
+    Fetches a page of a user's delivered notifications, newest first. Pass
+    the notification_id of the last row of a page to get the next one.
+    """
+    condition = ""
+    if before_notification_id is not None:
+        condition = "AND notification_id < %(before_notification_id)s"
+    with read_con() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"""
+                    SELECT notification_id, bids, messages, listing_ids,
+                        first_at, last_at, created_at
+                    FROM notifications
+                    WHERE user_id = %(user_id)s
+                    {condition}
+                    ORDER BY notification_id DESC
+                    LIMIT %(limit)s
+                    """,
+                {
+                    "user_id": user_id,
+                    "before_notification_id": before_notification_id,
+                    "limit": limit,
+                },
+            )
+            return cursor.fetchall()
+
+
+def delete_message(message_id: int, sender_id: int):
+    """
+    Deletes a message sent by 'sender_id'.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
                 """
                     DELETE FROM messages
-                    WHERE message_id = %s
+                    WHERE message_id = %s AND sender_id = %s
                     RETURNING message_id, message_text
                     """,
-                (message_id),
+                (message_id, sender_id),
             )
             deleted_message = cursor.fetchone()
             conn.commit()
@@ -538,101 +2927,40 @@ def delete_payment_method(method_id: int):
                     WHERE method_id = %s
                     RETURNING method_id, method_name
                     """,
-                (method_id),
+                (method_id,),
             )
             deleted_payment_method = cursor.fetchone()
             conn.commit()
             return deleted_payment_method
 
 
-def delete_order(order_id: int):
+def delete_order(order_id: int, user_id: int):
     """
-    Deletes a order.
+    Deletes a order where 'user_id' is the buyer or seller.
     """
     with con() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(
-                    """
-                    DELETE FROM orders
-                    WHERE order_id = %s
-                    RETURNING order_id, order_number
+                f"""
+                    WITH deleted AS (
+                        DELETE FROM orders
+                        WHERE order_id = %s AND %s IN (buyer_id, seller_id)
+                        RETURNING {ORDER_COLUMNS}
+                    ),
+                    logged AS (
+                        {log_change("order", "delete", "deleted", "order_id")}
+                    ),
+                    order_delta AS (
+                        SELECT seller_id, listing_id, created_at::date AS day,
+                            -1 AS orders, -total_amount AS revenue
+                        FROM deleted o
+                        WHERE {counted_order("o")}
+                    ),
+                    {order_rollups("order_delta")}
+                    SELECT order_id, order_number FROM deleted
                     """,
-                (order_id),
+                (order_id, user_id),
             )
             deleted_order = cursor.fetchone()
             conn.commit()
             return deleted_order
-
-
-def partial_update_user(
-    user_id: int,
-    username: str = None,
-    email: str = None,
-    first_name: str = None,
-    last_name: str = None,
-    phone_number: str = None,
-    address: str = None,
-    postal_code: str = None,
-    language_id: int = None,
-    currency_id: int = None,
-    city_id: int = None,
-    profile_picture_id: int = None,
-    translation_on: bool = None,
-    vacation_mode: bool = None,
-):
-    """
-    Partially updates a user based on the input.
-    """
-    with con() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            updated_values = []
-            values = []
-
-            if username:
-                updated_values.append("username = %s")
-                values.append(username)
-            if email:
-                updated_values.append("email = %s")
-                values.append(email)
-            if first_name:
-                updated_values.append("first_name = %s")
-                values.append(first_name)
-            if last_name:
-                updated_values.append("last_name = %s")
-                values.append(last_name)
-            if phone_number:
-                updated_values.append("phone_number = %s")
-                values.append(phone_number)
-            if address:
-                updated_values.append("address = %s")
-                values.append(address)
-            if postal_code:
-                updated_values.append("postal_code = %s")
-                values.append(postal_code)
-            if language_id:
-                updated_values.append("language_id = %s")
-                values.append(language_id)
-            if currency_id:
-                updated_values.append("currency_id = %s")
-                values.append(currency_id)
-            if city_id:
-                updated_values.append("city_id = %s")
-                values.append(city_id)
-            if profile_picture_id:
-                updated_values.append("profile_picture_id = %s")
-                values.append(profile_picture_id)
-            if translation_on is not None:
-                updated_values.append("translation_on = %s")
-                values.append(translation_on)
-            if vacation_mode is not None:
-                updated_values.append("vacation_mode = %s")
-                values.append(vacation_mode)
-
-            values.append(user_id)
-
-            query = f"UPDATE users SET {', '.join(updated_values)} WHERE user_id = %s"
-            cursor.execute(query, values)
-            updated_user = cursor.fetchone()
-            conn.commit()
-
-            return updated_user
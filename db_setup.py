@@ -1,34 +1,321 @@
+import contextvars
+import itertools
 import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 
+import passwords
 import psycopg2
+from background import PeriodicWorker
 from dotenv import load_dotenv
+from psycopg2.extensions import connection as Connection
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
-load_dotenv(override=True)
+# An explicit path skips python-dotenv's search through the call stack and
+# parent directories, which is noticeable at import time.
+load_dotenv(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"), override=True
+)
 
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 PASSWORD = os.getenv("PASSWORD")
+POOL_MIN_CONNECTIONS = int(os.getenv("POOL_MIN_CONNECTIONS", 1))
+POOL_MAX_CONNECTIONS = int(os.getenv("POOL_MAX_CONNECTIONS", 10))
 
+# Comma separated libpq connection strings of read replicas, reads go to the
+# primary when this is empty.
+REPLICA_DSNS = [
+    dsn.strip() for dsn in os.getenv("REPLICA_DSNS", "").split(",") if dsn.strip()
+]
+# Replicas lagging more than this many seconds behind are skipped.
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 5))
+# Seconds to wait for a replica connection, so a replica that is down
+# doesn't hold up its lag check.
+REPLICA_CONNECT_TIMEOUT = int(os.getenv("REPLICA_CONNECT_TIMEOUT", 2))
+# Reads for a user go to the primary for this long after that user wrote.
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
 
-def get_connection():
+
+class PreparedConnection(Connection):
+    """
+    Connection that remembers which statements have been PREPAREd on it,
+    and runs the callbacks in 'after_commit' once its transaction commits.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.after_commit = []
+
+    def commit(self):
+        super().commit()
+        callbacks, self.after_commit = self.after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self.after_commit = []
+        super().rollback()
+
+
+class Database:
+    """
+    A lazily created connection pool for one Postgres server.
+    """
+
+    def __init__(self, **connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+        # Replicas get no reads until their first lag check.
+        self.healthy = False
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+
+    def get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        POOL_MIN_CONNECTIONS,
+                        POOL_MAX_CONNECTIONS,
+                        connection_factory=PreparedConnection,
+                        **self.connect_kwargs,
+                    )
+        return self._pool
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool and hands it back when done.
+        Waits for a free connection instead of failing when the pool is busy.
+        """
+        pool = self.get_pool()
+        with self._slots:
+            conn = pool.getconn()
+            try:
+                with conn:
+                    yield conn
+            finally:
+                # Callbacks of a transaction that was never committed.
+                conn.after_commit = []
+                pool.putconn(conn, close=bool(conn.closed))
+
+    def check_replication_lag(self):
+        """
+        Marks a replica unhealthy when it can't be reached or lags behind
+        the primary by more than REPLICA_MAX_LAG seconds.
+        """
+        try:
+            with self.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        SELECT CASE
+                            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                                THEN 0
+                            ELSE COALESCE(EXTRACT(EPOCH FROM
+                                now() - pg_last_xact_replay_timestamp()), 0)
+                        END
+                        """
+                    )
+                    lag = cursor.fetchone()[0]
+            self.healthy = lag <= REPLICA_MAX_LAG
+        except psycopg2.Error:
+            self.healthy = False
+
+
+PRIMARY = Database(
+    dbname=DATABASE_NAME,
+    user="postgres",
+    password=PASSWORD,
+    host="localhost",
+    port="5432",
+)
+REPLICAS = [
+    Database(dsn=dsn, connect_timeout=REPLICA_CONNECT_TIMEOUT) for dsn in REPLICA_DSNS
+]
+
+_next_replica = itertools.count()
+_recent_writes = {}
+
+
+class RequestReads:
+    """
+    What read routing knows about the current request: the logged in user,
+    and until when (a time.time() timestamp) its client asked for reads
+    from the primary with the READ_YOUR_WRITES_COOKIE. mark_write moves
+    that time on so the response can renew the cookie.
+    """
+
+    def __init__(self, user_id: int = None, primary_until: float = 0.0):
+        self.user_id = user_id
+        self.primary_until = primary_until
+        self.wrote = False
+
+
+READ_YOUR_WRITES_COOKIE = "read_primary_until"
+_request_reads = contextvars.ContextVar("request_reads", default=None)
+
+
+def begin_request(user_id: int = None, primary_until: float = 0.0):
     """
-    Function that returns a single connection.
+    Sets the RequestReads of the current request and returns it.
+    """
+    reads = RequestReads(user_id, primary_until)
+    _request_reads.set(reads)
+    return reads
+
+
+def connect():
+    """
+    Function that opens a new connection outside of the pool.
     """
     return psycopg2.connect(
-        dbname=DATABASE_NAME,
-        user="postgres",
-        password=PASSWORD,
-        host="localhost",
-        port="5432",
+        connection_factory=PreparedConnection, **PRIMARY.connect_kwargs
     )
 
 
+def get_pool():
+    """
+    Returns the primary's connection pool, creating it on first use.
+    """
+    return PRIMARY.get_pool()
+
+
+def get_connection():
+    """
+    Borrows a connection to the primary, use it for anything that writes.
+    """
+    return PRIMARY.connection()
+
+
+def mark_write(user_id: int):
+    """
+    Sends the user's reads to the primary for the next few seconds so they
+    see their own write even if the replicas haven't replayed it yet. This
+    process remembers the user, and the request's client gets a cookie
+    for requests that other processes serve.
+    """
+    if not REPLICAS:
+        return
+    reads = _request_reads.get()
+    if reads is not None:
+        reads.primary_until = time.time() + READ_YOUR_WRITES_SECONDS
+        reads.wrote = True
+    if user_id is None:
+        return
+    now = time.monotonic()
+    _recent_writes[user_id] = now + READ_YOUR_WRITES_SECONDS
+    if len(_recent_writes) > 10000:
+        for key, expires_at in list(_recent_writes.items()):
+            if expires_at < now:
+                _recent_writes.pop(key, None)
+
+
+def _reads_from_primary():
+    reads = _request_reads.get()
+    if reads is None:
+        return False
+    return (
+        reads.primary_until > time.time()
+        or _recent_writes.get(reads.user_id, 0) > time.monotonic()
+    )
+
+
+def get_read_connection():
+    """
+    Borrows a connection for read-only queries. Picks the next healthy
+    replica round-robin, and falls back to the primary when there are no
+    healthy replicas or the requesting user or client wrote something very
+    recently.
+    """
+    if not REPLICAS or _reads_from_primary():
+        return PRIMARY.connection()
+
+    for _ in range(len(REPLICAS)):
+        replica = REPLICAS[next(_next_replica) % len(REPLICAS)]
+        if replica.healthy:
+            return replica.connection()
+
+    return PRIMARY.connection()
+
+
+def check_replicas():
+    for replica in REPLICAS:
+        replica.check_replication_lag()
+
+
+# Lag is checked in the background, never while a request waits.
+_replica_checker = PeriodicWorker(
+    "replica-lag", REPLICA_CHECK_INTERVAL, check_replicas
+)
+
+
+def start():
+    if REPLICAS:
+        _replica_checker.start()
+        _replica_checker.wake()
+
+
+def stop():
+    _replica_checker.stop()
+
+
+def _hash_plaintext_passwords(conn, batch_size: int = 1000):
+    """
+    Replaces passwords stored in plain text, from before passwords.py, with
+    scrypt hashes. Empty hashes belong to purged users and are left alone.
+    """
+    with ProcessPoolExecutor() as pool, conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                """
+                    SELECT user_id, password_hash
+                    FROM users
+                    WHERE password_hash NOT LIKE 'scrypt$%%'
+                    AND password_hash <> ''
+                    LIMIT %s
+                    """,
+                (batch_size,),
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            hashes = pool.map(
+                partial(
+                    passwords.hash_password_sync,
+                    n=passwords.SCRYPT_N,
+                    r=passwords.SCRYPT_R,
+                    p=passwords.SCRYPT_P,
+                ),
+                [password for _, password in rows],
+            )
+            execute_values(
+                cursor,
+                """
+                    UPDATE users u
+                    SET password_hash = v.password_hash
+                    FROM (VALUES %s) AS v(user_id, password_hash)
+                    WHERE u.user_id = v.user_id
+                    """,
+                [
+                    (user_id, password_hash)
+                    for (user_id, _), password_hash in zip(rows, hashes)
+                ],
+            )
+            conn.commit()
+
+
 def create_tables():
     """
     A function to create the necessary tables for the project.
     """
-    conn = get_connection()
-
-    with conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
             (
                 cursor.execute("""
@@ -300,6 +587,333 @@ def create_tables():
                             )
                             """)
 
+            # Leave free space in the pages of frequently updated tables so
+            # updates that don't touch indexed columns can stay HOT.
+            cursor.execute("ALTER TABLE users SET (fillfactor = 90)")
+            cursor.execute("ALTER TABLE listings SET (fillfactor = 90)")
+            cursor.execute("ALTER TABLE orders SET (fillfactor = 90)")
+
+            # Users and listings are soft deleted, purge.py removes them and
+            # their dependent rows later in small batches. Indexes used by
+            # hot queries leave deleted rows out.
+            cursor.execute("""
+                            ALTER TABLE users
+                            ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ
+                            """)
+            cursor.execute("""
+                            ALTER TABLE listings
+                            ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS listings_live_seller_id_idx
+                            ON listings(seller_id)
+                            WHERE deleted_at IS NULL
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS listings_deleted_seller_id_idx
+                            ON listings(seller_id)
+                            WHERE deleted_at IS NOT NULL
+                            """)
+            cursor.execute("DROP INDEX IF EXISTS listings_seller_id_idx")
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS listings_active_start_date_idx
+                            ON listings(start_date DESC)
+                            WHERE status_id = 1 AND deleted_at IS NULL
+                            """)
+
+            # Order history pages are served by index-only scans on these.
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS orders_buyer_history_idx
+                            ON orders(buyer_id, created_at DESC, order_id DESC)
+                            INCLUDE (seller_id, listing_id, order_status_id,
+                                     order_number, total_amount)
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS orders_seller_history_idx
+                            ON orders(seller_id, created_at DESC, order_id DESC)
+                            INCLUDE (buyer_id, listing_id, order_status_id,
+                                     order_number, total_amount)
+                            """)
+
+            # Client supplied key that makes order creation safe to retry.
+            cursor.execute("""
+                            ALTER TABLE orders
+                            ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64)
+                            """)
+            # Keys are only unique per buyer.
+            cursor.execute("DROP INDEX IF EXISTS orders_idempotency_key_idx")
+            cursor.execute("""
+                            CREATE UNIQUE INDEX IF NOT EXISTS
+                            orders_buyer_id_idempotency_key_idx
+                            ON orders(buyer_id, idempotency_key)
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS bids_listing_id_amount_idx
+                            ON bids(listing_id, bid_amount DESC)
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS bids_listing_id_bid_id_idx
+                            ON bids(listing_id, bid_id DESC)
+                            """)
+
+            # Written behind by the in-memory order books (order_book.py).
+            # None of them is indexed, so the frequent updates stay HOT.
+            cursor.execute("""
+                            ALTER TABLE listings
+                            ADD COLUMN IF NOT EXISTS current_price DECIMAL(10,2),
+                            ADD COLUMN IF NOT EXISTS bid_count INT NOT NULL DEFAULT 0,
+                            ADD COLUMN IF NOT EXISTS leader_id INT
+                            """)
+
+            # Seller dashboard rollups, kept up to date by the writes in db.py.
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS seller_daily_stats(
+                            seller_id INT NOT NULL,
+                            day DATE NOT NULL,
+                            views INT NOT NULL DEFAULT 0,
+                            bids INT NOT NULL DEFAULT 0,
+                            orders INT NOT NULL DEFAULT 0,
+                            revenue DECIMAL(12,2) NOT NULL DEFAULT 0,
+                            reviews INT NOT NULL DEFAULT 0,
+                            rating_sum DECIMAL(10,2) NOT NULL DEFAULT 0,
+                            positive_reviews INT NOT NULL DEFAULT 0,
+                            negative_reviews INT NOT NULL DEFAULT 0,
+                            PRIMARY KEY (seller_id, day)
+                            )
+                            """)
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS listing_stats(
+                            listing_id INT PRIMARY KEY,
+                            seller_id INT,
+                            bids INT NOT NULL DEFAULT 0,
+                            highest_bid DECIMAL(8,2),
+                            orders INT NOT NULL DEFAULT 0
+                            )
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS listing_stats_seller_id_idx
+                            ON listing_stats(seller_id)
+                            """)
+
+            # Image sizes and thumbnail variants created by images.py.
+            cursor.execute("ALTER TABLE img ADD COLUMN IF NOT EXISTS width INT")
+            cursor.execute("ALTER TABLE img ADD COLUMN IF NOT EXISTS height INT")
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS img_variants(
+                            img_id INT REFERENCES img(img_id),
+                            variant VARCHAR(20),
+                            url VARCHAR(150) NOT NULL,
+                            width INT NOT NULL,
+                            height INT NOT NULL,
+                            PRIMARY KEY (img_id, variant)
+                            )
+                            """)
+            cursor.execute("""
+                            ALTER TABLE listing_imgs
+                            ADD COLUMN IF NOT EXISTS position SMALLINT NOT NULL DEFAULT 0
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS listing_imgs_listing_position_idx
+                            ON listing_imgs(listing_id, position, img_id)
+                            """)
+
+            # Reviews are read per reviewee, the primary key leads with
+            # reviewer_id so it can't serve that.
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS reviews_reviewee_created_at_idx
+                            ON reviews(reviewee_id, created_at DESC)
+                            """)
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS rating_histograms(
+                            user_id INT PRIMARY KEY,
+                            stars_1 INT NOT NULL DEFAULT 0,
+                            stars_2 INT NOT NULL DEFAULT 0,
+                            stars_3 INT NOT NULL DEFAULT 0,
+                            stars_4 INT NOT NULL DEFAULT 0,
+                            stars_5 INT NOT NULL DEFAULT 0,
+                            positive_reviews INT NOT NULL DEFAULT 0,
+                            negative_reviews INT NOT NULL DEFAULT 0
+                            )
+                            """)
+
+            # Revoked auth tokens, a row with no token_id revokes every token
+            # issued to the user before revoked_at (ms). Rows are kept until
+            # the tokens they revoke would have expired anyway.
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS token_revocations(
+                            user_id INT NOT NULL,
+                            token_id CHAR(32),
+                            revoked_at BIGINT NOT NULL,
+                            expires_at TIMESTAMPTZ NOT NULL
+                            )
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS token_revocations_expires_at_idx
+                            ON token_revocations(expires_at)
+                            """)
+
+            # Soft deleted users and listings waiting for purge.py. A worker
+            # leases an entry by setting claimed_until.
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS purge_queue(
+                            kind VARCHAR(10) NOT NULL,
+                            id INT NOT NULL,
+                            deleted_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                            claimed_until TIMESTAMPTZ,
+                            PRIMARY KEY (kind, id)
+                            )
+                            """)
+            # Listing, bid and order changes for downstream consumers
+            # (GET /changes), written by db.py in the same statement as the
+            # change itself. The key leads with the writing transaction's id
+            # so consumers can read in an order that late commits can't
+            # insert into, see db.get_changes.
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS changelog(
+                            txid BIGINT NOT NULL DEFAULT txid_current(),
+                            seq BIGSERIAL,
+                            entity VARCHAR(20) NOT NULL,
+                            entity_id BIGINT NOT NULL,
+                            op VARCHAR(10) NOT NULL,
+                            data JSONB,
+                            changed_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                            PRIMARY KEY (txid, seq)
+                            )
+                            """)
+            # Rows are appended in time order, so a BRIN index is enough for
+            # trimming old entries.
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS changelog_changed_at_idx
+                            ON changelog USING brin(changed_at)
+                            """)
+
+            # The purge looks dependent rows up by these foreign keys.
+            for table, column in (
+                ("bids", "user_id"),
+                ("watchlist", "user_id"),
+                ("messages", "sender_id"),
+                ("messages", "reciever_id"),
+                ("messages", "listing_id"),
+                ("orders", "listing_id"),
+                ("reviews", "listing_id"),
+                ("listing_categories", "listing_id"),
+                ("listing_shipping_options", "listing_id"),
+            ):
+                cursor.execute(
+                    f"""
+                    CREATE INDEX IF NOT EXISTS {table}_{column}_idx
+                    ON {table}({column})
+                    """
+                )
+
+            # Categories form a tree. path holds the ids from the root down
+            # to the category itself, existing flat categories become roots.
+            # Subtree listings are looked up with category_id = ANY(...) on
+            # the (category_id, listing_id) primary key of listing_categories.
+            cursor.execute("""
+                            ALTER TABLE categories
+                            ADD COLUMN IF NOT EXISTS parent_id SMALLINT
+                            REFERENCES categories(category_id),
+                            ADD COLUMN IF NOT EXISTS path SMALLINT[]
+                            """)
+            cursor.execute("""
+                            UPDATE categories SET path = ARRAY[category_id]
+                            WHERE path IS NULL AND parent_id IS NULL
+                            """)
+
+            # Coordinates of cities and postal codes, bucketed into the grid
+            # cells of geo.py. A seller's listings are located at their
+            # postal code, or at their city when the postal code is unknown.
+            cursor.execute("""
+                            ALTER TABLE cities
+                            ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION,
+                            ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION,
+                            ADD COLUMN IF NOT EXISTS geo_cell INT
+                            """)
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS postal_codes(
+                            postal_code VARCHAR(10) PRIMARY KEY,
+                            city_id INT REFERENCES cities(city_id),
+                            latitude DOUBLE PRECISION NOT NULL,
+                            longitude DOUBLE PRECISION NOT NULL,
+                            geo_cell INT NOT NULL
+                            )
+                            """)
+            for table in ("cities", "postal_codes"):
+                cursor.execute(f"""
+                            CREATE INDEX IF NOT EXISTS {table}_geo_cell_idx
+                            ON {table}(geo_cell)
+                            """)
+            for column in ("postal_code", "city_id"):
+                cursor.execute(f"""
+                            CREATE INDEX IF NOT EXISTS users_live_{column}_idx
+                            ON users({column})
+                            WHERE deleted_at IS NULL
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS listings_pick_up_seller_id_idx
+                            ON listings(seller_id)
+                            WHERE pick_up_available AND status_id = 1
+                            AND deleted_at IS NULL
+                            """)
+
+            # Units of each currency per unit of exchange_rates.BASE_CURRENCY_ID,
+            # the currency prices are stored in.
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS exchange_rates(
+                            currency_id INT PRIMARY KEY
+                            REFERENCES currencies(currency_id),
+                            rate NUMERIC(18, 8) NOT NULL CHECK (rate > 0),
+                            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                            )
+                            """)
+
+            # Notification pipeline (notifications.py). New bids and messages
+            # queue one event each, workers fan them out into one digest per
+            # recipient and deliver due digests to the notifications inbox.
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS notification_events(
+                            event_id BIGSERIAL PRIMARY KEY,
+                            kind VARCHAR(10) NOT NULL,
+                            listing_id INT,
+                            actor_id INT,
+                            recipient_id INT,
+                            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+                            )
+                            """)
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS notification_digests(
+                            recipient_id INT PRIMARY KEY,
+                            bids INT NOT NULL DEFAULT 0,
+                            messages INT NOT NULL DEFAULT 0,
+                            listing_ids INT[] NOT NULL DEFAULT '{}',
+                            first_at TIMESTAMPTZ NOT NULL,
+                            last_at TIMESTAMPTZ NOT NULL
+                            )
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS notification_digests_first_at_idx
+                            ON notification_digests(first_at)
+                            """)
+            cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS notifications(
+                            notification_id BIGSERIAL PRIMARY KEY,
+                            user_id INT NOT NULL,
+                            bids INT NOT NULL,
+                            messages INT NOT NULL,
+                            listing_ids INT[] NOT NULL,
+                            first_at TIMESTAMPTZ NOT NULL,
+                            last_at TIMESTAMPTZ NOT NULL,
+                            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+                            )
+                            """)
+            cursor.execute("""
+                            CREATE INDEX IF NOT EXISTS notifications_user_id_idx
+                            ON notifications(user_id, notification_id DESC)
+                            """)
+
+        _hash_plaintext_passwords(conn)
+
 
 if __name__ == "__main__":
     create_tables()
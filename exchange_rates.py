@@ -0,0 +1,76 @@
+import os
+from decimal import ROUND_HALF_UP, Decimal
+
+import cache
+import db
+from background import PeriodicWorker
+
+# Prices are stored in BASE_CURRENCY_ID. Every process keeps the rates of
+# exchange_rates in memory and converts whole response pages with them, so
+# no request looks a rate up in the database.
+BASE_CURRENCY_ID = int(os.getenv("BASE_CURRENCY_ID", 1))
+EXCHANGE_RATE_REFRESH_INTERVAL = float(os.getenv("EXCHANGE_RATE_REFRESH_INTERVAL", 300))
+
+PRICE_FIELDS = ("starting_price", "current_price", "highest_bid", "bid_amount")
+CENT = Decimal("0.01")
+
+# currency_id -> units of that currency per unit of the base currency,
+# replaced whole on refresh.
+_rates = {}
+
+
+def refresh():
+    """
+    Reloads the exchange rates from the database.
+    """
+    global _rates
+    _rates = {row["currency_id"]: row["rate"] for row in db.get_exchange_rates()}
+
+
+def get_rate(currency_id: int):
+    """
+    Returns the rate of a currency, or None if there is none.
+    """
+    if currency_id == BASE_CURRENCY_ID:
+        return Decimal(1)
+    return _rates.get(currency_id)
+
+
+def _convert_row(row: dict, rate: Decimal):
+    converted = dict(row)
+    for field in PRICE_FIELDS:
+        if row.get(field) is not None:
+            converted[field] = (row[field] * rate).quantize(CENT, ROUND_HALF_UP)
+    if row.get("recent_bids"):
+        converted["recent_bids"] = [
+            _convert_row(bid, rate) for bid in row["recent_bids"]
+        ]
+    return converted
+
+
+def convert(rows: list, currency_id: int):
+    """
+    Returns copies of a page of rows with their prices in 'currency_id'.
+    The rows themselves may be cached and are left as they are. Raises
+    KeyError when there is no rate for the currency.
+    """
+    rate = get_rate(currency_id)
+    if rate is None:
+        raise KeyError(currency_id)
+    return [{**_convert_row(row, rate), "currency_id": currency_id} for row in rows]
+
+
+def _on_change(key: str):
+    _worker.wake()
+
+
+cache.on_message("exchange_rate", _on_change)
+_worker = PeriodicWorker("exchange-rates", EXCHANGE_RATE_REFRESH_INTERVAL, refresh)
+
+
+def start():
+    _worker.start()
+
+
+def stop():
+    _worker.stop()
@@ -0,0 +1,48 @@
+import math
+
+# Cities and postal codes are bucketed into a grid of GEO_CELL_SIZE degree
+# cells, stored in their geo_cell column. A radius search looks up the cells
+# covering the circle's bounding box with one indexed = ANY(...) and then
+# filters by the exact distance. Stored cells depend on the size, change it
+# only together with recomputing geo_cell.
+GEO_CELL_SIZE = 0.1
+EARTH_RADIUS_KM = 6371.0
+
+_ROWS = round(180 / GEO_CELL_SIZE)
+_COLUMNS = round(360 / GEO_CELL_SIZE)
+
+
+def _row(latitude: float):
+    return min(int((latitude + 90) // GEO_CELL_SIZE), _ROWS - 1)
+
+
+def _column(longitude: float):
+    return int(((longitude + 180) % 360) // GEO_CELL_SIZE) % _COLUMNS
+
+
+def geo_cell(latitude: float, longitude: float):
+    """
+    Returns the grid cell of a coordinate.
+    """
+    return _row(latitude) * _COLUMNS + _column(longitude)
+
+
+def cells_within(latitude: float, longitude: float, radius_km: float):
+    """
+    Returns the grid cells that cover every point within 'radius_km' of a
+    coordinate, and some more around it.
+    """
+    delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south, north = max(latitude - delta, -90), min(latitude + delta, 90)
+    rows = range(_row(south), _row(north) + 1)
+
+    # Longitude degrees get shorter towards the poles, use the widest span.
+    widest = math.cos(math.radians(max(abs(south), abs(north))))
+    if widest <= 0 or delta / widest >= 180:
+        columns = range(_COLUMNS)
+    else:
+        west = _column(longitude - delta / widest)
+        count = (_column(longitude + delta / widest) - west) % _COLUMNS + 1
+        columns = [(west + offset) % _COLUMNS for offset in range(count)]
+
+    return [row * _COLUMNS + column for row in rows for column in columns]
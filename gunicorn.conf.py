@@ -0,0 +1,13 @@
+import multiprocessing
+import os
+
+# Multi-process server mode: gunicorn -c gunicorn.conf.py app:app
+# Each worker runs the app's lifespan, so it gets its own connection pools,
+# background workers and cache listener.
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Workers size their process pools by how many of them share the cores.
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn_worker.UvicornWorker"
+graceful_timeout = 30
+keepalive = 5
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Images are stored under MEDIA_ROOT with object-store style keys
+# ("originals/<id>.jpg", "thumbnails/<id>_small.jpg"), and the same keys are
+# saved as urls in the database.
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+
+ALLOWED_CONTENT_TYPES = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+}
+
+THUMBNAIL_SIZES = {
+    "small": (150, 150),
+    "medium": (480, 480),
+}
+
+# The leading bytes of each allowed format, the client's Content-Type
+# isn't trusted.
+SIGNATURES = {
+    "image/jpeg": (b"\xff\xd8\xff",),
+    "image/png": (b"\x89PNG\r\n\x1a\n",),
+}
+
+_executor = None
+# Records finished thumbnails in the database, so a slow write doesn't hold
+# up the process pool's result handling.
+_recorder = None
+_executor_lock = threading.Lock()
+
+
+def content_type(data: bytes):
+    """
+    Returns the allowed content type an upload's bytes are in, or None.
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for allowed_type, signatures in SIGNATURES.items():
+        if data.startswith(signatures):
+            return allowed_type
+    return None
+
+
+def save_original(data: bytes, content_type: str):
+    """
+    Writes an uploaded image to disk and returns its key.
+    """
+    key = f"originals/{uuid.uuid4().hex}.{ALLOWED_CONTENT_TYPES[content_type]}"
+    path = os.path.join(MEDIA_ROOT, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+    return key
+
+
+def delete_file(key: str):
+    try:
+        os.remove(os.path.join(MEDIA_ROOT, key))
+    except FileNotFoundError:
+        pass
+
+
+def make_variants(media_root: str, key: str, sizes: dict):
+    """
+    Creates the resized thumbnails for one image. Runs in a worker process.
+    Returns the original's size and a list of
+    (variant, key, width, height) tuples.
+    """
+    from PIL import Image, ImageOps
+
+    name = os.path.splitext(os.path.basename(key))[0]
+    os.makedirs(os.path.join(media_root, "thumbnails"), exist_ok=True)
+
+    variants = []
+    with Image.open(os.path.join(media_root, key)) as original:
+        original = ImageOps.exif_transpose(original)
+        original_size = original.size
+        for variant, size in sizes.items():
+            thumbnail = original.convert("RGB")
+            thumbnail.thumbnail(size)
+            variant_key = f"thumbnails/{name}_{variant}.jpg"
+            thumbnail.save(os.path.join(media_root, variant_key), "JPEG", quality=85)
+            variants.append((variant, variant_key, *thumbnail.size))
+
+    return original_size, variants
+
+
+def _record_variants(img_id: int, key: str, future):
+    """
+    Saves the thumbnails of an image. An image that couldn't be read is
+    deleted with whatever thumbnails were written for it.
+    """
+    try:
+        width_height, variants = future.result()
+    except Exception:
+        logger.exception("Generating thumbnails of image %s failed.", img_id)
+        try:
+            db.delete_image(img_id)
+        except Exception:
+            logger.exception("Deleting image %s failed.", img_id)
+            return
+        name = os.path.splitext(os.path.basename(key))[0]
+        delete_file(key)
+        for variant in THUMBNAIL_SIZES:
+            delete_file(f"thumbnails/{name}_{variant}.jpg")
+        return
+
+    try:
+        db.add_image_variants(img_id, *width_height, variants)
+    except Exception:
+        logger.exception("Saving thumbnails of image %s failed.", img_id)
+
+
+def process_image(img_id: int, key: str):
+    """
+    Generates the thumbnails of an image in the process pool, off the
+    request path, and records them in the database when done.
+    """
+    global _executor, _recorder
+    # Uploads run in the threadpool, only one of them may start the pools.
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+            _recorder = ThreadPoolExecutor(
+                max_workers=IMAGE_WORKERS, thread_name_prefix="image-variants"
+            )
+        recorder = _recorder
+
+    future = _executor.submit(make_variants, MEDIA_ROOT, key, THUMBNAIL_SIZES)
+    # Done callbacks run on the process pool's management thread.
+    future.add_done_callback(
+        lambda future: recorder.submit(_record_variants, img_id, key, future)
+    )
+
+
+def stop():
+    global _executor, _recorder
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _recorder.shutdown(wait=True)
+            _executor = None
+            _recorder = None
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+from collections import Counter
+
+import db
+from background import PeriodicWorker
+
+# New bids and messages queue one row each in notification_events. A pool
+# of workers fans them out into one digest per recipient, and delivers a
+# digest to the recipient's notifications once its first event is
+# NOTIFICATION_DIGEST_WINDOW seconds old. A bid storm on a watched listing
+# so ends up as one notification per watcher and window, not one per bid.
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS", 2))
+NOTIFICATION_INTERVAL = float(os.getenv("NOTIFICATION_INTERVAL", 1))
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", 500))
+NOTIFICATION_DIGEST_WINDOW = float(os.getenv("NOTIFICATION_DIGEST_WINDOW", 300))
+# Batches a worker runs per stage before sleeping again, so a stop isn't
+# held up by a long backlog.
+NOTIFICATION_MAX_BATCHES = int(os.getenv("NOTIFICATION_MAX_BATCHES", 100))
+# Listings named in one digest.
+DIGEST_MAX_LISTINGS = 20
+
+_counts = Counter()
+_busy_seconds = 0.0
+_lock = threading.Lock()
+_started_at = time.monotonic()
+
+
+def _record(seconds: float, **counts):
+    global _busy_seconds
+    with _lock:
+        _counts.update(counts)
+        _busy_seconds += seconds
+
+
+def fan_out():
+    """
+    Adds queued events to the recipients' digests, a batch at a time.
+    """
+    for _ in range(NOTIFICATION_MAX_BATCHES):
+        start = time.perf_counter()
+        events, digests = db.fan_out_notifications(
+            NOTIFICATION_BATCH_SIZE, DIGEST_MAX_LISTINGS
+        )
+        _record(time.perf_counter() - start, batches=1, events=events, digests=digests)
+        if events < NOTIFICATION_BATCH_SIZE:
+            return
+
+
+def deliver():
+    """
+    Delivers the digests whose window has passed, a batch at a time.
+    """
+    for _ in range(NOTIFICATION_MAX_BATCHES):
+        start = time.perf_counter()
+        delivered = db.deliver_notifications(
+            NOTIFICATION_DIGEST_WINDOW, NOTIFICATION_BATCH_SIZE
+        )
+        _record(time.perf_counter() - start, batches=1, delivered=delivered)
+        if delivered < NOTIFICATION_BATCH_SIZE:
+            return
+
+
+def run():
+    fan_out()
+    deliver()
+
+
+def metrics():
+    """
+    Returns what this process's workers handled since it started, their
+    throughput, and the backlog left in the database.
+    """
+    with _lock:
+        counts, busy_seconds = dict(_counts), _busy_seconds
+    uptime = time.monotonic() - _started_at
+    return {
+        "workers": NOTIFICATION_WORKERS,
+        "batches": counts.get("batches", 0),
+        "events": counts.get("events", 0),
+        "digests_updated": counts.get("digests", 0),
+        "delivered": counts.get("delivered", 0),
+        "busy_seconds": round(busy_seconds, 3),
+        "events_per_second": round(counts.get("events", 0) / uptime, 2),
+        "events_per_busy_second": (
+            round(counts.get("events", 0) / busy_seconds, 2) if busy_seconds else None
+        ),
+        "backlog": db.get_notification_backlog(),
+    }
+
+
+# Workers in every process take batches with SKIP LOCKED, so they never
+# handle the same event or digest twice.
+_workers = [
+    PeriodicWorker(f"notifications-{index}", NOTIFICATION_INTERVAL, run)
+    for index in range(NOTIFICATION_WORKERS)
+]
+
+
+def start():
+    for worker in _workers:
+        worker.start()
+
+
+def stop():
+    for worker in _workers:
+        worker.stop()
@@ -0,0 +1,223 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from decimal import Decimal
+
+import cache
+import db
+from background import PeriodicWorker
+
+# Every process keeps an order book per listing in memory, so price reads of
+# hot auctions don't touch the database. New bids reach every process over
+# the cache invalidation channel, see db.create_bid.
+ORDER_BOOK_MAX_LISTINGS = int(os.getenv("ORDER_BOOK_MAX_LISTINGS", 10000))
+ORDER_BOOK_RECENT_BIDS = int(os.getenv("ORDER_BOOK_RECENT_BIDS", 20))
+# Books of active listings ending within this many seconds are loaded at
+# startup, others on their first read.
+ORDER_BOOK_PRELOAD_WINDOW = float(os.getenv("ORDER_BOOK_PRELOAD_WINDOW", 3600))
+# current_price, bid_count and leader_id are written to listings this often.
+ORDER_BOOK_FLUSH_INTERVAL = float(os.getenv("ORDER_BOOK_FLUSH_INTERVAL", 1))
+
+# A bid arrives twice in the process that made it, once when it's applied
+# locally and once more from the channel. Ids this recent are remembered.
+SEEN_BIDS = 256
+
+
+class OrderBook:
+    """
+    Highest bid, leader, bid count and the most recent bids of a listing.
+    """
+
+    def __init__(self, row: dict):
+        self.listing_id = row["listing_id"]
+        self.starting_price = row["starting_price"]
+        self.highest_bid = row["highest_bid"]
+        self.leader_id = row["leader_id"]
+        self.bid_count = row["bid_count"]
+        self.recent_bids = deque(maxlen=ORDER_BOOK_RECENT_BIDS)
+        self._seen = set()
+        self._seen_order = deque()
+        for bid in row["recent_bids"]:
+            bid = {**bid, "bid_amount": Decimal(bid["bid_amount"])}
+            self.recent_bids.append(bid)
+            self._remember(bid["bid_id"])
+
+    def _remember(self, bid_id: int):
+        self._seen.add(bid_id)
+        self._seen_order.append(bid_id)
+        if len(self._seen_order) > SEEN_BIDS:
+            self._seen.discard(self._seen_order.popleft())
+
+    def add(self, bid: dict):
+        if bid["bid_id"] in self._seen:
+            return
+        self._remember(bid["bid_id"])
+        self.bid_count += 1
+        self.recent_bids.append(bid)
+        # On equal amounts the earlier bid keeps the lead.
+        if self.highest_bid is None or bid["bid_amount"] > self.highest_bid:
+            self.highest_bid = bid["bid_amount"]
+            self.leader_id = bid["user_id"]
+
+    def price(self):
+        return {
+            "listing_id": self.listing_id,
+            "current_price": self.highest_bid or self.starting_price,
+            "starting_price": self.starting_price,
+            "highest_bid": self.highest_bid,
+            "leader_id": self.leader_id,
+            "bid_count": self.bid_count,
+            "recent_bids": list(self.recent_bids),
+        }
+
+
+_books = OrderedDict()
+_dirty = set()
+_lock = threading.Lock()
+# Bids received while books are being loaded, keyed by the listing_id being
+# loaded (None while loading at startup). They are replayed onto the loaded
+# books so no bid committed during the query is lost.
+_loading = {}
+
+
+def _parse_bid(key: str):
+    listing_id, bid_id, user_id, bid_amount, bidded_at = key.split(":", 4)
+    return int(listing_id), {
+        "bid_id": int(bid_id),
+        "user_id": int(user_id),
+        "bid_amount": Decimal(bid_amount),
+        "bidded_at": bidded_at,
+    }
+
+
+def _on_bid(key: str):
+    if key == "*":
+        # Bids may have been missed while the listener reconnected.
+        with _lock:
+            _books.clear()
+        return
+
+    listing_id, bid = _parse_bid(key)
+    with _lock:
+        for loading_key in (listing_id, None):
+            if loading_key in _loading:
+                _loading[loading_key].append((listing_id, bid))
+        book = _books.get(listing_id)
+        if book is not None:
+            book.add(bid)
+            _dirty.add(listing_id)
+
+
+def _on_listing(key: str):
+    # Deleted listings and status changes, the book is reloaded on next read.
+    with _lock:
+        if key == "*":
+            _books.clear()
+        else:
+            _books.pop(int(key), None)
+
+
+def _load(listing_ids: list = None, ending_within: float = None):
+    loading_keys = listing_ids if listing_ids is not None else [None]
+    with _lock:
+        for loading_key in loading_keys:
+            _loading.setdefault(loading_key, [])
+    try:
+        rows = db.get_order_books(
+            listing_ids=listing_ids,
+            ending_within=ending_within,
+            recent_bids=ORDER_BOOK_RECENT_BIDS,
+        )
+    finally:
+        with _lock:
+            pending = []
+            for loading_key in loading_keys:
+                pending.extend(_loading.pop(loading_key, ()))
+
+    with _lock:
+        books = {row["listing_id"]: OrderBook(row) for row in rows}
+        for listing_id, bid in pending:
+            if listing_id in books:
+                books[listing_id].add(bid)
+        for listing_id, book in books.items():
+            _books[listing_id] = book
+            _books.move_to_end(listing_id)
+        while len(_books) > ORDER_BOOK_MAX_LISTINGS:
+            _books.popitem(last=False)
+        return list(books.values())
+
+
+def get_price(listing_id: int):
+    """
+    Returns the current price of a listing if this process has its book,
+    without touching the database.
+    """
+    with _lock:
+        book = _books.get(listing_id)
+        if book is None:
+            return None
+        _books.move_to_end(listing_id)
+        return book.price()
+
+
+def load_price(listing_id: int):
+    """
+    Loads the book of a listing from the database and returns its price,
+    or None if the listing doesn't exist.
+    """
+    books = _load(listing_ids=[listing_id])
+    if not books:
+        return None
+    with _lock:
+        return books[0].price()
+
+
+def rebuild():
+    """
+    Loads the books of active listings ending soon from the bids table.
+    """
+    _load(ending_within=ORDER_BOOK_PRELOAD_WINDOW)
+
+
+def flush():
+    """
+    Writes current_price, bid_count and leader_id of books that changed to
+    listings. If the write fails they are retried on the next flush.
+    """
+    global _dirty
+    with _lock:
+        if not _dirty:
+            return
+        changed, _dirty = _dirty, set()
+        rows = [
+            (
+                book.listing_id,
+                book.highest_bid or book.starting_price,
+                book.bid_count,
+                book.leader_id,
+            )
+            for book in map(_books.get, changed)
+            if book is not None
+        ]
+    if not rows:
+        return
+
+    try:
+        db.save_order_books(rows)
+    except Exception:
+        with _lock:
+            _dirty |= changed
+        raise
+
+
+cache.on_message("bid", _on_bid)
+cache.on_message("listing", _on_listing)
+_worker = PeriodicWorker("order-book", ORDER_BOOK_FLUSH_INTERVAL, flush)
+
+
+def start():
+    _worker.start()
+
+
+def stop():
+    _worker.stop()
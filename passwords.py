@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Passwords are hashed with scrypt from the standard library. The cost can be
+# raised over time, existing hashes keep working since their parameters are
+# stored with them.
+SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", 2**14))
+SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", 8))
+SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", 1))
+# Processes doing the hashing, and how many hashes may wait for one of them
+# before callers wait to submit. Every web worker has its own pool, so by
+# default they share the cores between them.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+PASSWORD_HASH_WORKERS = int(
+    os.getenv(
+        "PASSWORD_HASH_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+    )
+)
+PASSWORD_HASH_QUEUE = int(
+    os.getenv("PASSWORD_HASH_QUEUE", 4 * PASSWORD_HASH_WORKERS)
+)
+
+_executor = None
+_queue_slots = None
+
+
+def _b64(data: bytes):
+    return base64.b64encode(data).decode()
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2**20
+    )
+
+
+def hash_password_sync(password: str, n: int, r: int, p: int):
+    """
+    Hashes a password. Runs in a worker process.
+    """
+    salt = os.urandom(16)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(digest)}"
+
+
+def verify_password_sync(password: str, password_hash: str):
+    """
+    Checks a password against a stored hash. Runs in a worker process.
+    """
+    try:
+        algorithm, n, r, p, salt, digest = password_hash.split("$")
+    except ValueError:
+        return False
+    if algorithm != "scrypt":
+        return False
+    candidate = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(candidate, base64.b64decode(digest))
+
+
+async def _run(function, *args):
+    global _executor, _queue_slots
+    # Runs on the event loop and doesn't await before the pool is set, so
+    # two requests can't both start one.
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+        _queue_slots = asyncio.Semaphore(PASSWORD_HASH_QUEUE)
+
+    async with _queue_slots:
+        return await asyncio.get_running_loop().run_in_executor(
+            _executor, function, *args
+        )
+
+
+async def hash_password(password: str):
+    """
+    Hashes a password in the process pool without blocking the event loop.
+    """
+    return await _run(hash_password_sync, password, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+async def verify_password(password: str, password_hash: str = None):
+    """
+    Checks a password against a stored hash in the process pool.
+    Without a usable hash (unknown or purged user) the password is hashed
+    anyway, so the response takes as long as for a wrong password.
+    """
+    if password_hash is None or not password_hash.startswith("scrypt$"):
+        await hash_password(password)
+        return False
+    return await _run(verify_password_sync, password, password_hash)
+
+
+def stop():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,77 @@
+import logging
+import os
+import time
+
+import db
+import images
+from background import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+# Soft deleted users and listings are purged after PURGE_GRACE_PERIOD
+# seconds. Dependent rows are removed PURGE_BATCH_SIZE at a time with a
+# short pause in between, so no transaction holds locks for long.
+PURGE_INTERVAL = float(os.getenv("PURGE_INTERVAL", 60))
+PURGE_GRACE_PERIOD = float(os.getenv("PURGE_GRACE_PERIOD", 3600))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 500))
+PURGE_BATCH_PAUSE = float(os.getenv("PURGE_BATCH_PAUSE", 0.05))
+# Queued purges handled per run, the rest wait for the next one.
+PURGE_MAX_PER_RUN = int(os.getenv("PURGE_MAX_PER_RUN", 100))
+# Another worker may take over a purge that hasn't finished in this long.
+PURGE_LEASE = 600
+# changelog entries are kept this many seconds.
+CHANGELOG_RETENTION = float(os.getenv("CHANGELOG_RETENTION", 7 * 24 * 3600))
+
+
+def purge(kind: str, key: int):
+    """
+    Runs every PURGE_STEPS query of a listing or user in batches.
+    """
+    for query in db.PURGE_STEPS[kind]:
+        while True:
+            handled, rows = db.run_purge_step(query, key, PURGE_BATCH_SIZE)
+            for (url,) in rows:
+                if url:
+                    images.delete_file(url)
+            if handled < PURGE_BATCH_SIZE:
+                break
+            time.sleep(PURGE_BATCH_PAUSE)
+    db.finish_purge(kind, key)
+
+
+def trim_changelog():
+    """
+    Deletes changelog entries older than CHANGELOG_RETENTION in batches.
+    """
+    while db.trim_changelog(CHANGELOG_RETENTION, PURGE_BATCH_SIZE) >= PURGE_BATCH_SIZE:
+        time.sleep(PURGE_BATCH_PAUSE)
+
+
+def run():
+    """
+    Purges queued users and listings whose grace period has passed, and old
+    changelog entries.
+    """
+    trim_changelog()
+    for _ in range(PURGE_MAX_PER_RUN):
+        claimed = db.claim_purge(PURGE_GRACE_PERIOD, PURGE_LEASE)
+        if claimed is None:
+            return
+        kind, key = claimed
+        try:
+            purge(kind, key)
+        except Exception:
+            # The lease runs out and the purge is retried from the first
+            # step, the steps that already finished find nothing left.
+            logger.exception("Purging %s %s failed.", kind, key)
+
+
+_worker = PeriodicWorker("purge", PURGE_INTERVAL, run)
+
+
+def start():
+    _worker.start()
+
+
+def stop():
+    _worker.stop()
@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from collections import Counter
+
+# Token bucket per client and route: RATE_LIMIT_PER_SECOND requests per
+# second on average, with bursts of up to RATE_LIMIT_BURST.
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", 5))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 10))
+# Requests to limited routes running at the same time in this process,
+# anything above is shed with 503 before it gets a database connection.
+MAX_CONCURRENT_WRITES = int(os.getenv("MAX_CONCURRENT_WRITES", 20))
+
+LIMITED_ROUTES = {
+    ("POST", "/bids"),
+    ("POST", "/new_listing"),
+    ("POST", "/reviews"),
+    ("POST", "/orders"),
+    ("POST", "/messages"),
+    ("POST", "/login"),
+    ("POST", "/new_user"),
+}
+
+# Idle buckets are dropped once there are this many.
+MAX_BUCKETS = 100000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def take(self, now: float):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+_buckets = {}
+_lock = threading.Lock()
+_in_flight = 0
+_rejections = Counter()
+_admitted = Counter()
+
+
+def _prune(now: float):
+    for key, bucket in list(_buckets.items()):
+        bucket.refill(now)
+        if bucket.tokens >= bucket.capacity:
+            del _buckets[key]
+
+
+def admit(client: str, route: tuple):
+    """
+    Decides whether a request may run. Returns None when it is admitted,
+    which must be followed by release(), or the HTTP status to reject it with.
+    """
+    global _in_flight
+    now = time.monotonic()
+    with _lock:
+        # Checked first, a request shed for load doesn't use up the
+        # client's tokens.
+        if _in_flight >= MAX_CONCURRENT_WRITES:
+            _rejections[("overloaded", route)] += 1
+            return 503
+
+        bucket = _buckets.get((client, route))
+        if bucket is None:
+            if len(_buckets) >= MAX_BUCKETS:
+                _prune(now)
+            bucket = _buckets[(client, route)] = TokenBucket(
+                RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST
+            )
+
+        if not bucket.take(now):
+            _rejections[("rate_limited", route)] += 1
+            return 429
+
+        _in_flight += 1
+        _admitted[route] += 1
+        return None
+
+
+def release():
+    global _in_flight
+    with _lock:
+        _in_flight -= 1
+
+
+def metrics():
+    """
+    Returns admitted and rejected request counts per route.
+    """
+    with _lock:
+        return {
+            "in_flight": _in_flight,
+            "admitted": {" ".join(route): count for route, count in _admitted.items()},
+            "rejected": [
+                {"reason": reason, "route": " ".join(route), "count": count}
+                for (reason, route), count in _rejections.items()
+            ],
+        }
@@ -1,3 +1,537 @@
+from datetime import date, datetime
+from decimal import Decimal
+from typing import ClassVar
+
 from pydantic import BaseModel as Base
+from pydantic import (
+    ConfigDict,
+    Field,
+    StrictBool,
+    StrictFloat,
+    StrictInt,
+    StrictStr,
+    model_validator,
+)
+
+# Request models use strict scalar types so pydantic-core can validate them
+# without trying coercions. Response models describe exactly the columns
+# db.py selects, sensitive user columns are never part of them.
+
+
+class Request(Base):
+    model_config = ConfigDict(extra="forbid")
+
+
+class Patch(Request):
+    """
+    Partial update, only the fields sent are changed. Sending null clears
+    one of the 'nullable' columns and is rejected for the others.
+    """
+
+    nullable: ClassVar[tuple] = ()
+
+    @model_validator(mode="after")
+    def check_nulls(self):
+        cleared = sorted(
+            field
+            for field in self.model_fields_set - set(self.nullable)
+            if getattr(self, field) is None
+        )
+        if cleared:
+            raise ValueError(f"Cannot set {', '.join(cleared)} to null.")
+        return self
+
+
+# Users
+
+
+class UserCreate(Request):
+    username: StrictStr = Field(max_length=50)
+    email: StrictStr = Field(max_length=75)
+    password: StrictStr = Field(min_length=8, max_length=255)
+    social_security_number: StrictStr = Field(min_length=13, max_length=13)
+    first_name: StrictStr = Field(max_length=50)
+    last_name: StrictStr = Field(max_length=50)
+    city_id: StrictInt
+    address: StrictStr = Field(max_length=100)
+    postal_code: StrictStr = Field(max_length=10)
+    phone_number: StrictStr = Field(max_length=20)
+
+
+class UserUpdate(Request):
+    language_id: StrictInt
+    currency_id: StrictInt
+    profile_picture_id: StrictInt | None = None
+    city_id: StrictInt
+    username: StrictStr = Field(max_length=50)
+    email: StrictStr = Field(max_length=75)
+    first_name: StrictStr = Field(max_length=50)
+    last_name: StrictStr = Field(max_length=50)
+    phone_number: StrictStr = Field(max_length=20)
+    address: StrictStr = Field(max_length=100)
+    postal_code: StrictStr = Field(max_length=10)
+
+
+class UserPatch(Patch):
+    nullable = ("profile_picture_id",)
+
+    username: StrictStr | None = Field(default=None, max_length=50)
+    email: StrictStr | None = Field(default=None, max_length=75)
+    first_name: StrictStr | None = Field(default=None, max_length=50)
+    last_name: StrictStr | None = Field(default=None, max_length=50)
+    phone_number: StrictStr | None = Field(default=None, max_length=20)
+    address: StrictStr | None = Field(default=None, max_length=100)
+    postal_code: StrictStr | None = Field(default=None, max_length=10)
+    language_id: StrictInt | None = None
+    currency_id: StrictInt | None = None
+    city_id: StrictInt | None = None
+    profile_picture_id: StrictInt | None = None
+    translation_on: StrictBool | None = None
+    vacation_mode: StrictBool | None = None
+
+
+class PasswordUpdate(Request):
+    current_password: StrictStr = Field(max_length=255)
+    new_password: StrictStr = Field(min_length=8, max_length=255)
+
+
+class Login(Request):
+    username: StrictStr = Field(max_length=50)
+    password: StrictStr = Field(max_length=255)
+
+
+class UserOut(Base):
+    user_id: int
+    language_id: int | None
+    currency_id: int | None
+    profile_picture_id: int | None
+    city_id: int
+    username: str
+    email: str
+    first_name: str
+    last_name: str
+    phone_number: str
+    address: str
+    postal_code: str
+    seller_rating: Decimal | None
+    total_reviews: int | None
+    translation_on: bool | None
+    vacation_mode: bool | None
+    is_verified: bool | None
+    created_at: datetime
+
+
+class UserDeleted(Base):
+    user_id: int
+    username: str
+
+
+# Cities
+
+
+class Location(Request):
+    latitude: StrictFloat = Field(ge=-90, le=90)
+    longitude: StrictFloat = Field(ge=-180, le=180)
+
+
+class CityCreate(Request):
+    city_name: StrictStr = Field(max_length=75)
+    latitude: StrictFloat | None = Field(default=None, ge=-90, le=90)
+    longitude: StrictFloat | None = Field(default=None, ge=-180, le=180)
+
+    @model_validator(mode="after")
+    def check_location(self):
+        if (self.latitude is None) != (self.longitude is None):
+            raise ValueError("'latitude' and 'longitude' must be sent together.")
+        return self
+
+
+class CityOut(Base):
+    city_id: int
+    city_name: str
+    latitude: float | None
+    longitude: float | None
+
+
+class PostalCodeLocation(Location):
+    city_id: StrictInt
+
+
+class PostalCodeOut(Base):
+    postal_code: str
+    city_id: int | None
+    latitude: float
+    longitude: float
+
+
+# Categories
+
+
+class CategoryCreate(Request):
+    category_name: StrictStr = Field(max_length=50)
+    parent_id: StrictInt | None = None
+
+
+class CategoryOut(Base):
+    category_id: int
+    category_name: str | None
+    parent_id: int | None
+    path: list[int]
+    children: list["CategoryOut"] = []
+
+
+# Listings
+
+
+class ListingCreate(Request):
+    seller_id: StrictInt
+    listing_type_id: StrictInt
+    product_name: StrictStr = Field(max_length=50)
+    title: StrictStr = Field(max_length=20)
+    description: StrictStr | None = Field(default=None, max_length=500)
+    starting_price: Decimal = Field(gt=0, max_digits=10, decimal_places=2)
+    pick_up_available: StrictBool = False
+    end_date: datetime
+
+
+class ListingUpdate(Request):
+    listing_type_id: StrictInt
+    product_name: StrictStr = Field(max_length=50)
+    title: StrictStr = Field(max_length=20)
+    description: StrictStr | None = Field(default=None, max_length=500)
+    starting_price: Decimal = Field(gt=0, max_digits=10, decimal_places=2)
+    pick_up_available: StrictBool
+    end_date: datetime
+
+
+class ListingPatch(Patch):
+    nullable = ("description",)
+
+    listing_type_id: StrictInt | None = None
+    product_name: StrictStr | None = Field(default=None, max_length=50)
+    title: StrictStr | None = Field(default=None, max_length=20)
+    description: StrictStr | None = Field(default=None, max_length=500)
+    starting_price: Decimal | None = Field(
+        default=None, gt=0, max_digits=10, decimal_places=2
+    )
+    pick_up_available: StrictBool | None = None
+    end_date: datetime | None = None
+
+
+class ListingStatusUpdate(Request):
+    status_id: StrictInt
+
+
+class BulkStatusUpdate(Request):
+    seller_id: StrictInt | None = None
+    from_status_id: StrictInt | None = None
+    batch_size: StrictInt | None = Field(default=None, gt=0, le=10000)
+
+    @model_validator(mode="after")
+    def check_target(self):
+        ids = self.ids()
+        if (ids is None) == (self.seller_id is None):
+            raise ValueError("Provide either a list of ids or a 'seller_id'.")
+        if ids is not None and self.from_status_id is not None:
+            raise ValueError("'from_status_id' can only be used with 'seller_id'.")
+        return self
+
+
+class BulkListingStatusUpdate(BulkStatusUpdate):
+    status_id: StrictInt
+    listing_ids: list[StrictInt] | None = Field(default=None, min_length=1)
+
+    def ids(self):
+        return self.listing_ids
+
+
+class BulkUpdateResult(Base):
+    updated: int
+
+
+class ListingOut(Base):
+    listing_id: int
+    seller_id: int | None
+    listing_type_id: int | None
+    status_id: int | None
+    product_name: str
+    title: str
+    description: str | None
+    starting_price: Decimal
+    view_count: int | None
+    pick_up_available: bool | None
+    start_date: datetime | None
+    end_date: datetime
+    current_price: Decimal | None
+    bid_count: int | None
+    # Set when prices were converted to the viewer's currency.
+    currency_id: int | None = None
+
+
+class NearbyListing(ListingOut):
+    distance_km: Decimal
+
+
+class RecentBid(Base):
+    bid_id: int
+    user_id: int | None
+    bid_amount: Decimal
+    bidded_at: datetime
+
+
+class ListingPrice(Base):
+    listing_id: int
+    current_price: Decimal
+    starting_price: Decimal
+    highest_bid: Decimal | None
+    leader_id: int | None
+    bid_count: int
+    recent_bids: list[RecentBid]
+    currency_id: int | None = None
+
+
+class ListingDeleted(Base):
+    listing_id: int
+    title: str
+
+
+class ListingImageOut(Base):
+    img_id: int
+    listing_id: int
+    position: int
+    url: str
+
+
+class ThumbnailOut(Base):
+    listing_id: int
+    img_id: int
+    url: str
+    width: int | None
+    height: int | None
+
+
+# Exchange rates
+
+
+class ExchangeRateUpdate(Request):
+    rate: Decimal = Field(gt=0, max_digits=18, decimal_places=8)
+
+
+class ExchangeRateOut(Base):
+    currency_id: int
+    rate: Decimal
+    updated_at: datetime
+
+
+# Bids
+
+
+class BidCreate(Request):
+    listing_id: StrictInt
+    user_id: StrictInt
+    bid_amount: Decimal = Field(gt=0, max_digits=8, decimal_places=2)
+    is_auto: StrictBool = False
+    max_auto_bid: Decimal | None = Field(default=None, max_digits=8, decimal_places=2)
+
+
+class BidOut(Base):
+    bid_id: int
+    listing_id: int
+    user_id: int | None
+    bid_amount: Decimal
+    bidded_at: datetime
+    is_auto: bool | None
+    max_auto_bid: Decimal | None
+
+
+# Orders
+
+
+class OrderCreate(Request):
+    buyer_id: StrictInt
+    listing_id: StrictInt
+    shipping_option_id: StrictInt
+    payment_id: StrictInt | None = None
+    shipping_address: StrictStr = Field(max_length=100)
+    shipping_city: StrictStr | None = Field(default=None, max_length=50)
+    shipping_postal_code: StrictStr = Field(max_length=10)
+    discount_amount: Decimal = Field(default=0, ge=0, max_digits=10, decimal_places=2)
+
+
+class OrderUpdate(Request):
+    shipping_option_id: StrictInt
+    order_status_id: StrictInt
+    shipping_address: StrictStr = Field(max_length=100)
+    shipping_city: StrictStr | None = Field(default=None, max_length=50)
+    shipping_postal_code: StrictStr = Field(max_length=10)
+    final_price: Decimal = Field(ge=0, max_digits=10, decimal_places=2)
+    discount_amount: Decimal = Field(default=0, ge=0, max_digits=10, decimal_places=2)
+
+
+class OrderPatch(Patch):
+    nullable = ("shipping_city",)
+
+    shipping_option_id: StrictInt | None = None
+    order_status_id: StrictInt | None = None
+    shipping_address: StrictStr | None = Field(default=None, max_length=100)
+    shipping_city: StrictStr | None = Field(default=None, max_length=50)
+    shipping_postal_code: StrictStr | None = Field(default=None, max_length=10)
+    final_price: Decimal | None = Field(
+        default=None, ge=0, max_digits=10, decimal_places=2
+    )
+    discount_amount: Decimal | None = Field(
+        default=None, ge=0, max_digits=10, decimal_places=2
+    )
+
+
+class BulkOrderStatusUpdate(BulkStatusUpdate):
+    order_status_id: StrictInt
+    order_ids: list[StrictInt] | None = Field(default=None, min_length=1)
+
+    def ids(self):
+        return self.order_ids
+
+
+class OrderOut(Base):
+    order_id: int
+    seller_id: int | None
+    buyer_id: int | None
+    listing_id: int | None
+    shipping_option_id: int | None
+    payment_id: int | None
+    order_status_id: int | None
+    shipping_cost: Decimal
+    shipping_address: str
+    shipping_city: str | None
+    shipping_postal_code: str
+    final_price: Decimal
+    discount_amount: Decimal | None
+    total_amount: Decimal
+    order_number: str
+    created_at: datetime
+    updated_at: datetime
+
+
+class OrderSummary(Base):
+    order_id: int
+    seller_id: int | None
+    buyer_id: int | None
+    listing_id: int | None
+    order_status_id: int | None
+    order_number: str
+    total_amount: Decimal
+    created_at: datetime
+
+
+class OrderDeleted(Base):
+    order_id: int
+    order_number: str
+
+
+# Seller dashboard
+
+
+class SellerDailyStats(Base):
+    day: date
+    views: int
+    bids: int
+    orders: int
+    revenue: Decimal
+    reviews: int
+    positive_reviews: int
+    negative_reviews: int
+    average_rating: Decimal | None
+    conversion_rate: Decimal | None
+
+
+class SellerListingStats(Base):
+    listing_id: int
+    title: str
+    views: int | None
+    bids: int
+    highest_bid: Decimal | None
+    orders: int
+    conversion_rate: Decimal | None
+
+
+# Reviews
+
+
+class ReviewCreate(Request):
+    listing_id: StrictInt
+    reviewer_id: StrictInt
+    reviewee_id: StrictInt
+    review_text: StrictStr | None = Field(default=None, max_length=500)
+    rating: Decimal = Field(ge=0, le=5, max_digits=3, decimal_places=2)
+    is_negative: StrictBool = False
+    is_positive: StrictBool = False
+
+
+class ReviewOut(Base):
+    listing_id: int
+    reviewer_id: int
+    reviewee_id: int
+    is_negative: bool | None
+    is_positive: bool | None
+    review_text: str | None
+    rating: Decimal
+    created_at: datetime
+
+
+class RatingSummary(Base):
+    user_id: int
+    seller_rating: Decimal | None
+    total_reviews: int
+    stars_1: int
+    stars_2: int
+    stars_3: int
+    stars_4: int
+    stars_5: int
+    positive_reviews: int
+    negative_reviews: int
+
+
+# Messages
+
+
+class MessageCreate(Request):
+    sender_id: StrictInt
+    reciever_id: StrictInt
+    listing_id: StrictInt | None = None
+    message_text: StrictStr = Field(max_length=250)
+
+
+class MessageOut(Base):
+    message_id: int
+    sender_id: int | None
+    reciever_id: int | None
+    listing_id: int | None
+    message_text: str | None
+    message_shown: bool | None
+    sent_at: datetime
+
+
+class MessageDeleted(Base):
+    message_id: int
+    message_text: str | None
+
+
+# Notifications
+
+
+class NotificationOut(Base):
+    notification_id: int
+    bids: int
+    messages: int
+    listing_ids: list[int]
+    first_at: datetime
+    last_at: datetime
+    created_at: datetime
+
+
+# Payment methods
 
 
+class PaymentMethodDeleted(Base):
+    method_id: int
+    method_name: str | None
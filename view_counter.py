@@ -0,0 +1,57 @@
+import os
+import threading
+from collections import Counter
+
+import db
+from background import PeriodicWorker
+
+# Views are counted in memory and written in one batched UPDATE every
+# VIEW_FLUSH_INTERVAL seconds, so at most that much is lost on a crash.
+VIEW_FLUSH_INTERVAL = float(os.getenv("VIEW_FLUSH_INTERVAL", 5))
+# Flush early when this many different listings have pending views.
+VIEW_FLUSH_THRESHOLD = int(os.getenv("VIEW_FLUSH_THRESHOLD", 10000))
+
+_pending = Counter()
+_lock = threading.Lock()
+
+
+def record_view(listing_id: int):
+    """
+    Counts one view of a listing.
+    """
+    with _lock:
+        _pending[listing_id] += 1
+        pending_listings = len(_pending)
+
+    if pending_listings >= VIEW_FLUSH_THRESHOLD:
+        _worker.wake()
+
+
+def flush():
+    """
+    Writes all pending views to the database. If the write fails the counts
+    are put back and retried on the next flush.
+    """
+    global _pending
+    with _lock:
+        if not _pending:
+            return
+        counts, _pending = _pending, Counter()
+
+    try:
+        db.add_listing_views(counts)
+    except Exception:
+        with _lock:
+            _pending.update(counts)
+        raise
+
+
+_worker = PeriodicWorker("view-counter", VIEW_FLUSH_INTERVAL, flush)
+
+
+def start():
+    _worker.start()
+
+
+def stop():
+    _worker.stop()